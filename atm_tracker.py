@@ -0,0 +1,200 @@
+# Python Standard Library
+import os
+import json
+from dataclasses import replace
+from datetime import datetime
+
+# Local Library imports
+from models import NfoTokenModel
+from option_chain import INDEX_SYMBOLS
+from instrument_cache import load_instruments
+
+# Parameters
+today = datetime.today().date()
+STRIKE_STEP = 100
+PER_SIDE_STRIKES = {'NIFTY': 5, 'BANKNIFTY': 12, 'FINNIFTY': 5}
+CONTRACT_COLUMNS = ['instrument_token', 'tradingsymbol', 'lot_size', 'name', 'expiry', 'strike', 'segment',
+                    'instrument_type']
+
+
+def load_chains(names: list = tuple(INDEX_SYMBOLS), day=None) -> dict:
+    """Option chains of the nearest expiry of the index derivatives, from the instrument caches of the day.
+
+    Args:
+        names: underlying names, e.g. 'NIFTY'.
+        day: date of the instrument dumps, today by default.
+
+    Returns:
+        {name: {'index_token': instrument_token of the index, 'tokens': {strike: [CE and PE tokens]},
+        'contracts': {token: NfoTokenModel}}}, strikes divisible by STRIKE_STEP only, like the window selected by
+        NfoActiveSymbols. The models are the rows written to NfoTokenTable when a strike is subscribed.
+    """
+
+    day = today if day is None else day
+    nse_cache = load_instruments(f"InstrumentToken/NSE/{day}_NSE.csv", 'NSE', day)
+    nfo_cache = load_instruments(f"InstrumentToken/NFO/{day}_NFO.csv", 'NFO', day)
+
+    chains = {}
+    for name in names:
+        index = nse_cache.chain(INDEX_SYMBOLS[name], 'INDICES', columns=['instrument_token', 'tradingsymbol'])
+        index = index[index['tradingsymbol'] == INDEX_SYMBOLS[name]]
+        expiries = [expiry for expiry in nfo_cache.expiries(name, 'NFO-OPT') if expiry >= day]
+
+        if index.empty or not expiries:
+            print(f"{name}: no option chain for {day}")
+            continue
+
+        options = nfo_cache.chain(name, 'NFO-OPT', expiries[0], columns=CONTRACT_COLUMNS)
+        options = options[options['strike'] % STRIKE_STEP == 0]
+
+        tokens = {}
+        contracts = {}
+        for record in options.to_dict('records'):
+            token = int(record['instrument_token'])
+            tokens.setdefault(int(record['strike']), []).append(token)
+            contracts[token] = NfoTokenModel(**record)
+
+        chains[name] = {'index_token': int(index['instrument_token'].iloc[0]), 'tokens': tokens,
+                        'contracts': contracts}
+
+    return chains
+
+
+class AtmTracker:
+    """
+    Keeps the subscribed option strikes of every underlying centred on the ATM, from the index ticks.
+
+    The window of an underlying is re-centred when the ATM of the index price has moved 'threshold' strikes
+    away from the centre of the window. The strikes leaving the window are unsubscribed, the new ones subscribed,
+    and every change is kept as a json line in 'log_path'. Tokens that are not in a chain, e.g. the futures,
+    are never touched.
+    """
+
+    def __init__(self, chains: dict, subscribed: list, threshold: int = 2, per_side: dict = None,
+                 log_path: str = None):
+        """
+        Args:
+            chains: as returned by load_chains().
+            subscribed: tokens subscribed at the start, the window of every underlying is read from them.
+            threshold: ATM move, in strikes, that re-centres a window.
+            per_side: strikes on each side of the ATM, PER_SIDE_STRIKES by default.
+            log_path: json lines file of the subscription changes, not written when None.
+        """
+
+        self.chains = chains
+        self.threshold = threshold
+        self.per_side = PER_SIDE_STRIKES if per_side is None else per_side
+        self.log_path = log_path
+
+        self.index_names = {chain['index_token']: name for name, chain in chains.items()}
+        self.windows = {}
+        self.atm = {}
+
+        subscribed = set(subscribed)
+        for name, chain in chains.items():
+            strikes = [strike for strike, tokens in chain['tokens'].items() if subscribed.intersection(tokens)]
+
+            self.windows[name] = {token for strike in strikes for token in chain['tokens'][strike]} & subscribed
+            self.atm[name] = round((min(strikes) + max(strikes)) / 2 / STRIKE_STEP) * STRIKE_STEP \
+                if strikes else None
+
+    def watch_tokens(self) -> list:
+        """ Index tokens to subscribe in LTP mode with the recorded tokens """
+
+        return list(self.index_names)
+
+    def __window(self, name: str, atm: int) -> set:
+        reach = self.per_side.get(name, 5) * STRIKE_STEP
+        tokens = self.chains[name]['tokens']
+
+        return {token for strike in range(atm - reach, atm + reach + 1, STRIKE_STEP)
+                for token in tokens.get(strike, [])}
+
+    def process(self, ticks: list) -> tuple:
+        """Re-centre the windows on the index ticks of a batch.
+
+        Returns:
+            (ticks, changes): the batch without the index ticks, and the changes made, each a dictionary with
+            'name', 'previous_atm', 'atm', 'price', 'added' and 'removed' tokens.
+        """
+
+        watched = [tick for tick in ticks if tick['instrument_token'] in self.index_names]
+
+        if not watched:
+            return ticks, []
+
+        changes = []
+        for tick in watched:
+            name = self.index_names[tick['instrument_token']]
+            atm = round(tick['last_price'] / STRIKE_STEP) * STRIKE_STEP
+
+            if self.atm[name] is not None and abs(atm - self.atm[name]) < self.threshold * STRIKE_STEP:
+                continue
+
+            window = self.__window(name, atm)
+            changes.append({'name': name, 'previous_atm': self.atm[name], 'atm': atm, 'price': tick['last_price'],
+                            'added': sorted(window - self.windows[name]),
+                            'removed': sorted(self.windows[name] - window)})
+
+            self.windows[name] = window
+            self.atm[name] = atm
+
+        ticks = [tick for tick in ticks if tick['instrument_token'] not in self.index_names]
+
+        return ticks, changes
+
+    def contracts(self, change: dict) -> list:
+        """ NfoTokenModel of the tokens added by a change, 'position' counted in strikes from its new ATM """
+
+        contracts = self.chains[change['name']].get('contracts', {})
+
+        return [replace(contracts[token], position=int((contracts[token].strike - change['atm']) / STRIKE_STEP),
+                        last_update=datetime.today().date())
+                for token in change['added'] if token in contracts]
+
+    def record(self, changes: list):
+        """ Append the subscription changes to the log file, one json line per change """
+
+        if self.log_path is None or not changes:
+            return
+
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+
+        with open(self.log_path, "a") as log_file:
+            for change in changes:
+                log_file.write(json.dumps({'time': str(datetime.now()), **change}) + "\n")
+
+
+if __name__ == '__main__':
+    import time
+    import random
+
+    # NIFTY moving 800 points in the day: fixed window of the pre-open quote against the re-centred one
+    chains = {'NIFTY': {'index_token': 256265,
+                        'tokens': {strike: [strike * 10 + 1, strike * 10 + 2] for strike in range(18000, 24001, 100)}}}
+    opening = [token for strike in range(20500, 21501, 100) for token in chains['NIFTY']['tokens'][strike]]
+    tracker = AtmTracker(chains, opening)
+
+    price = 21000.0
+    covered = {'fixed': 0, 'tracked': 0}
+    elapsed = 0.0
+
+    for second in range(22_500):
+        price += 800 / 22_500 + random.gauss(0, 0.5)
+        atm_tokens = set(chains['NIFTY']['tokens'][round(price / 100) * 100])
+
+        begin = time.perf_counter()
+        ticks, changes = tracker.process([{'instrument_token': 256265, 'last_price': price}] +
+                                         [{'instrument_token': token, 'last_price': 1.0} for token in opening[:50]])
+        elapsed += time.perf_counter() - begin
+
+        for change in changes:
+            print(f"ATM {change['previous_atm']} -> {change['atm']}: +{len(change['added'])} "
+                  f"-{len(change['removed'])} tokens")
+
+        covered['fixed'] += atm_tokens <= set(opening)
+        covered['tracked'] += atm_tokens <= tracker.windows['NIFTY']
+
+    print(f"ATM in the subscribed strikes: fixed window {covered['fixed'] / 22_500:.0%}, "
+          f"re-centred {covered['tracked'] / 22_500:.0%}, {len(tracker.windows['NIFTY'])} tokens subscribed, "
+          f"{elapsed / 22_500 * 1e6:.1f} us per batch")
@@ -0,0 +1,405 @@
+# Python Standard Library
+import os
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import text
+
+# Local Library imports
+from consumer import TickHandler
+from tick_codec import TickFileReader, read_legacy_file
+from database import candle_engine
+
+# Parameters
+EPOCH = datetime(1970, 1, 1)
+
+# Storage of the candle and day databases: 'token', one token_{n} table per instrument, or 'long', one partitioned
+# 'candles' table per database keyed by (instrument_token, time_stamp), see candle_store.py
+CANDLE_LAYOUT = os.environ.get('CANDLE_LAYOUT', 'token')
+
+
+def upsert_rows(engine, rows: list, layout: str = None) -> int:
+    """Insert or update candle rows, all in one transaction.
+
+    Args:
+        engine: candle or day database engine.
+        rows: dictionaries with 'instrument_token', 'time_stamp' and any of the candle columns. Rows with the
+            same token and columns are written with a single executemany, only the given columns are updated.
+        layout: 'token' writes the token_{n} tables, 'long' the 'candles' table, CANDLE_LAYOUT by default.
+
+    Returns:
+        The number of rows written.
+    """
+
+    layout = CANDLE_LAYOUT if layout is None else layout
+
+    groups = {}
+    for row in rows:
+        row = dict(row)
+
+        # Long layout: the token is a column and all the tokens share one statement
+        token = row.pop('instrument_token') if layout == 'token' else None
+        groups.setdefault((token, tuple(row.keys())), []).append(row)
+
+    with engine.begin() as conn:
+        for (token, columns), group in groups.items():
+            table = f"token_{token}" if layout == 'token' else "candles"
+            names = ", ".join(columns)
+            values = ", ".join(f":{column}" for column in columns)
+            updates = ", ".join(f"{column} = VALUES({column})" for column in columns
+                                if column not in ('instrument_token', 'time_stamp'))
+
+            conn.execute(text(f"INSERT INTO {table} ({names}) VALUES ({values}) "
+                              f"ON DUPLICATE KEY UPDATE {updates}"), group)
+
+    return len(rows)
+
+
+def merge_rows(*row_lists) -> list:
+    """ Merge rows of the same token and minute coming from different stages into a single row """
+
+    merged = {}
+    for rows in row_lists:
+        for row in rows:
+            merged.setdefault((row['instrument_token'], row['time_stamp']), {}).update(row)
+
+    return list(merged.values())
+
+
+class CandleAggregator:
+    """
+    Incremental tick to 1-minute OHLCV aggregation for a whole token universe.
+
+    The state of the open bar of every token lives in numpy arrays indexed by a token slot, and a tick batch is
+    merged with vectorized operations: the batch is grouped by (token, minute), then every group is merged into
+    the open bar of its token or rolls it over. Per-bar volume is the difference of the cumulative
+    'volume_traded' between the end of the bar and the end of the previous bar. The first bar of a token counts
+    from zero, i.e. the volume traded since the open. Completed bars are buffered and written in bulk by flush().
+    """
+
+    def __init__(self, exchange: str, tokens: list = (), engine=None):
+
+        self.exchange = exchange.upper()
+        self.engine = candle_engine(exchange) if engine is None else engine
+
+        # Token slots
+        self.slots = {}
+        self.tokens = np.zeros(0, dtype=np.int64)
+
+        # State of the open bar, one entry per slot
+        self.minute = np.zeros(0, dtype=np.int64)  # minutes since 1970-01-01, -1 before the first tick
+        self.open = np.zeros(0, dtype=np.float64)
+        self.high = np.zeros(0, dtype=np.float64)
+        self.low = np.zeros(0, dtype=np.float64)
+        self.close = np.zeros(0, dtype=np.float64)
+        self.volume_start = np.zeros(0, dtype=np.int64)  # cumulative volume at the end of the previous bar
+        self.volume_last = np.zeros(0, dtype=np.int64)  # last cumulative volume of the open bar
+        self.count = np.zeros(0, dtype=np.int64)  # ticks in the open bar
+        self.emitted = np.zeros(0, dtype=bool)  # open bar already handed to the completed bars
+
+        # Completed bars waiting for flush(), list of column arrays
+        self.completed = []
+        # Rows of a failed flush, written again with the next one
+        self.unwritten = []
+        self.late_ticks = 0
+        self.last_minute = -1
+
+        self.add_tokens(tokens)
+
+    def add_tokens(self, tokens):
+        """ Add slots for new tokens, e.g. strikes subscribed during the day """
+
+        new_tokens = [token for token in dict.fromkeys(tokens) if token not in self.slots]
+        if not new_tokens:
+            return
+
+        for token in new_tokens:
+            self.slots[token] = len(self.slots)
+
+        size = len(new_tokens)
+        self.tokens = np.concatenate([self.tokens, np.array(new_tokens, dtype=np.int64)])
+        self.minute = np.concatenate([self.minute, np.full(size, -1, dtype=np.int64)])
+        self.emitted = np.concatenate([self.emitted, np.zeros(size, dtype=bool)])
+
+        for name in ('open', 'high', 'low', 'close'):
+            setattr(self, name, np.concatenate([getattr(self, name), np.zeros(size, dtype=np.float64)]))
+
+        for name in ('volume_start', 'volume_last', 'count'):
+            setattr(self, name, np.concatenate([getattr(self, name), np.zeros(size, dtype=np.int64)]))
+
+    def update(self, ticks: list):
+        """ Merge a batch of kite tick dictionaries """
+
+        ticks = [tick for tick in ticks if tick.get('exchange_timestamp') is not None]
+        if not ticks:
+            return
+
+        unknown = [tick['instrument_token'] for tick in ticks if tick['instrument_token'] not in self.slots]
+        if unknown:
+            self.add_tokens(unknown)
+
+        slots = self.slots
+        self.update_arrays(
+            np.fromiter((slots[tick['instrument_token']] for tick in ticks), dtype=np.int64, count=len(ticks)),
+            np.fromiter((int((tick['exchange_timestamp'] - EPOCH).total_seconds()) for tick in ticks),
+                        dtype=np.int64, count=len(ticks)),
+            np.fromiter((tick['last_price'] for tick in ticks), dtype=np.float64, count=len(ticks)),
+            np.fromiter((tick.get('volume_traded') or 0 for tick in ticks), dtype=np.int64, count=len(ticks)))
+
+    def update_arrays(self, slots, seconds, prices, volumes):
+        """Merge a batch given as arrays, in arrival order.
+
+        Args:
+            slots: token slot of every tick.
+            seconds: exchange timestamp, seconds since 1970-01-01.
+            prices: last price.
+            volumes: cumulative volume traded, 0 when not available.
+        """
+
+        minutes = seconds // 60
+
+        # Group the batch by (slot, minute), arrival order is kept inside a group
+        order = np.lexsort((minutes, slots))
+        slots, minutes, prices, volumes = slots[order], minutes[order], prices[order], volumes[order]
+
+        boundary = np.ones(len(slots), dtype=bool)
+        boundary[1:] = (slots[1:] != slots[:-1]) | (minutes[1:] != minutes[:-1])
+        starts = np.flatnonzero(boundary)
+        ends = np.append(starts[1:], len(slots)) - 1
+
+        g_slot = slots[starts]
+        g_minute = minutes[starts]
+        g_open = prices[starts]
+        g_close = prices[ends]
+        g_high = np.maximum.reduceat(prices, starts)
+        g_low = np.minimum.reduceat(prices, starts)
+        g_volume = np.maximum.reduceat(volumes, starts)
+        g_count = ends - starts + 1
+
+        # Rank of a group among the groups of its slot, a slot has more than one group only at a minute change
+        slot_start = np.ones(len(g_slot), dtype=bool)
+        slot_start[1:] = g_slot[1:] != g_slot[:-1]
+        first_group = np.maximum.accumulate(np.where(slot_start, np.arange(len(g_slot)), 0))
+        rank = np.arange(len(g_slot)) - first_group
+
+        for current in range(rank.max() + 1):
+            selected = rank == current
+            self.__merge(g_slot[selected], g_minute[selected], g_open[selected], g_high[selected], g_low[selected],
+                         g_close[selected], g_volume[selected], g_count[selected])
+
+        # Exchange time moved on: bars of the tokens without a tick in the new minute are complete
+        self.last_minute = max(self.last_minute, int(minutes.max()))
+        self.__emit(np.flatnonzero((self.minute >= 0) & (self.minute < self.last_minute) & ~self.emitted))
+
+    def __merge(self, slot, minute, open_, high, low, close, volume, count):
+        """ Merge groups into the open bars, every slot appears at most once """
+
+        current = self.minute[slot]
+
+        # Same minute: extend the open bar
+        same = minute == current
+        s = slot[same]
+        self.high[s] = np.maximum(self.high[s], high[same])
+        self.low[s] = np.minimum(self.low[s], low[same])
+        self.close[s] = close[same]
+        self.volume_last[s] = np.maximum(self.volume_last[s], volume[same])
+        self.count[s] += count[same]
+        self.emitted[s] = False
+
+        # Newer minute: complete the open bar, then start a new one
+        newer = minute > current
+        s = slot[newer]
+        self.__emit(s[(self.minute[s] >= 0) & ~self.emitted[s]])
+
+        started = self.minute[s] >= 0
+        self.volume_start[s] = np.where(started, self.volume_last[s], 0)
+        self.minute[s] = minute[newer]
+        self.open[s] = open_[newer]
+        self.high[s] = high[newer]
+        self.low[s] = low[newer]
+        self.close[s] = close[newer]
+        self.volume_last[s] = np.maximum(volume[newer], self.volume_start[s])
+        self.count[s] = count[newer]
+        self.emitted[s] = False
+
+        # Older minute: the bar was already rolled over
+        self.late_ticks += int(count[minute < current].sum())
+
+    def __emit(self, slot):
+        if len(slot) == 0:
+            return
+
+        self.completed.append((self.tokens[slot], self.minute[slot], self.open[slot], self.high[slot],
+                               self.low[slot], self.close[slot], self.volume_last[slot] - self.volume_start[slot],
+                               self.count[slot].copy()))
+        self.emitted[slot] = True
+
+    def finish(self):
+        """ Complete every open bar, at the market close """
+
+        self.__emit(np.flatnonzero((self.minute >= 0) & ~self.emitted))
+
+    def completed_bars(self) -> list:
+        """ Take the completed bars as a list of row dictionaries, grouped by token """
+
+        if not self.completed:
+            return []
+
+        columns = [np.concatenate(column) for column in zip(*self.completed)]
+        self.completed = []
+
+        rows = []
+        for token, minute, open_, high, low, close, volume, count in zip(*(column.tolist() for column in columns)):
+            row = {'instrument_token': token, 'time_stamp': EPOCH + timedelta(minutes=minute), 'open': open_,
+                   'high': high, 'low': low, 'close': close, 'candle_data': json.dumps({'ticks': count})}
+
+            if self.exchange != 'INDEX':
+                row['volume'] = volume
+
+            rows.append(row)
+
+        return rows
+
+    def flush(self, rows: list = None) -> int:
+        """Write the completed bars to the candle database, one executemany per token table in one transaction.
+
+        The rows stay in the aggregator until the transaction commits: when the write fails they are kept, merged
+        with the next rows and written again by the next flush, and the exception is raised.
+        """
+
+        rows = self.completed_bars() if rows is None else rows
+        if self.unwritten:
+            rows = merge_rows(self.unwritten, rows)
+
+        self.unwritten = []
+        if not rows:
+            return 0
+
+        try:
+            return upsert_rows(self.engine, rows)
+
+        except Exception:
+            self.unwritten = rows
+            raise
+
+
+class CandleHandler(TickHandler):
+    """
+    Consumer handler feeding a CandleAggregator and optional profile stages. Every stage has update(ticks),
+    finish() and completed_rows(); their rows are merged with the bars and flushed every 'flush_seconds'.
+    """
+
+    def __init__(self, aggregator: CandleAggregator, stages: list = (), flush_seconds: float = 5.0):
+        self.aggregator = aggregator
+        self.stages = list(stages)
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.monotonic()
+        self.unflushed = 0  # batches handled since the last successful flush
+
+    def handle(self, received, ticks: list):
+        self.aggregator.update(ticks)
+
+        for stage in self.stages:
+            stage.update(ticks)
+
+        self.unflushed += 1
+
+        if time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def pending(self) -> bool:
+        return self.unflushed > 0
+
+    def idle(self):
+        if self.unflushed and time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        rows = merge_rows(self.aggregator.completed_bars(), *(stage.completed_rows() for stage in self.stages))
+
+        # A failed write keeps the rows in the aggregator, retried at the next flush interval
+        try:
+            self.aggregator.flush(rows)
+            self.unflushed = 0
+        finally:
+            self.last_flush = time.monotonic()
+
+    def close(self, attempts: int = 3):
+        self.aggregator.finish()
+
+        for stage in self.stages:
+            stage.finish()
+
+        for attempt in range(1, attempts + 1):
+            try:
+                self.flush()
+                return
+
+            except Exception as e:
+                print(f"Error writing the last candles, attempt {attempt}/{attempts}: {e}")
+                if attempt < attempts:
+                    time.sleep(attempt)
+
+        print(f"{len(self.aggregator.unwritten)} candle rows not written")
+
+
+def aggregate_file(exchange: str, path: str, engine=None, flush_every: int = 50_000) -> CandleAggregator:
+    """Build the candles of a daily tick file, binary capture ('.bin') or json lines of str(ticks) ('.txt').
+
+    Args:
+        exchange: 'NSE', 'NFO' or 'INDEX'.
+        path: tick file path.
+        engine: optional engine, the candle database of the exchange by default.
+        flush_every: flush the completed bars once this many are buffered.
+    """
+
+    aggregator = CandleAggregator(exchange, engine=engine)
+    batches = TickFileReader(path) if path.endswith('.bin') else read_legacy_file(path)
+
+    for _, ticks in batches:
+        aggregator.update(ticks)
+
+        if sum(len(column[0]) for column in aggregator.completed) >= flush_every:
+            aggregator.flush()
+
+    aggregator.finish()
+    aggregator.flush()
+
+    return aggregator
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+
+    if len(sys.argv) == 3:
+        # Build the candles of a daily tick file: python candle_aggregator.py NFO <path>
+        aggregate_file(sys.argv[1], sys.argv[2])
+        sys.exit()
+
+    # Benchmark: cost per tick batch for 600 tokens, 300 ticks per batch
+    tokens = list(range(10_000_000, 10_000_600))
+    aggregator = CandleAggregator('NFO', tokens)
+    market_open = datetime(2023, 12, 18, 9, 15)
+    volume = dict.fromkeys(tokens, 0)
+
+    batches = []
+    for second in range(3_600):
+        batch = []
+        for token in random.sample(tokens, 300):
+            volume[token] += random.randint(0, 500)
+            batch.append({'instrument_token': token, 'exchange_timestamp': market_open + timedelta(seconds=second),
+                          'last_price': 100 + random.random(), 'volume_traded': volume[token]})
+        batches.append(batch)
+
+    begin = time.perf_counter()
+    for batch in batches:
+        aggregator.update(batch)
+    aggregator.finish()
+    elapsed = time.perf_counter() - begin
+
+    bars = aggregator.completed_bars()
+    print(f"{len(batches)} batches, {len(bars)} bars, {elapsed / len(batches) * 1000:.3f} ms per batch")
+    print(f"volume check: {sum(bar['volume'] for bar in bars) == sum(volume.values())}")
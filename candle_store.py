@@ -0,0 +1,240 @@
+# Python Standard Library
+import time
+from datetime import datetime, date
+
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.schema import CreateTable
+from sqlalchemy import Table, Column, MetaData, BigInteger
+
+# Local Library imports
+from schema import COLUMN_SPECS
+from database import candle_engine, day_engine
+from candle_aggregator import CANDLE_LAYOUT
+
+# Parameters
+today = datetime.today().date()
+LONG_TABLE = 'candles'
+
+
+def long_table(exchange: str, metadata: MetaData = None) -> Table:
+    """ Core Table of the long layout: the token columns plus 'instrument_token', keyed by (token, time_stamp) """
+
+    metadata = MetaData() if metadata is None else metadata
+
+    return Table(LONG_TABLE, metadata,
+                 Column('instrument_token', BigInteger, primary_key=True, autoincrement=False),
+                 *[Column(name, column_type, primary_key=(name == 'time_stamp'))
+                   for name, column_type in COLUMN_SPECS[exchange.upper()]])
+
+
+def month_starts(first: date, last: date) -> list:
+    """ First day of every month from the month of 'first' to the month after 'last' """
+
+    months = []
+    year, month = first.year, first.month
+
+    while (year, month) <= (last.year, last.month):
+        month = month + 1 if month < 12 else 1
+        year = year + 1 if month == 1 else year
+        months.append(date(year, month, 1))
+
+    return months
+
+
+def _month_ahead(months: int) -> date:
+    # First day of the month 'months' after the current one
+    index = today.month - 1 + months
+    return date(today.year + index // 12, index % 12 + 1, 1)
+
+
+def _partition(bound: date) -> str:
+    # Partition of the month before 'bound', e.g. p202312 holds December 2023
+    month = date(bound.year - 1, 12, 1) if bound.month == 1 else date(bound.year, bound.month - 1, 1)
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{bound}')"
+
+
+def create_long_table(engine, exchange: str, first: date, months_ahead: int = 3):
+    """Create the 'candles' table of a database, partitioned by month of time_stamp.
+
+    Args:
+        engine: candle or day database engine, MySQL.
+        exchange: 'NSE', 'NFO' or 'INDEX', selects the column spec.
+        first: date of the oldest candle to hold, e.g. the oldest candle of the token tables to migrate.
+        months_ahead: partitions created ahead of today, later ones are added by add_partitions().
+    """
+
+    if LONG_TABLE in inspect(engine).get_table_names():
+        return
+
+    partitions = [_partition(bound) for bound in month_starts(first, _month_ahead(months_ahead))]
+    partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+
+    ddl = str(CreateTable(long_table(exchange)).compile(engine)).strip()
+    ddl += "\nPARTITION BY RANGE COLUMNS(time_stamp) (\n    " + ",\n    ".join(partitions) + "\n)"
+
+    with engine.begin() as conn:
+        conn.execute(text(ddl))
+
+    print(f"{engine.url.database}.{LONG_TABLE} created with {len(partitions)} partitions")
+
+
+def add_partitions(engine, months_ahead: int = 3) -> int:
+    """ Split the catch-all 'pmax' partition so that months up to 'months_ahead' from today have their own """
+
+    with engine.connect() as conn:
+        bounds = conn.execute(text("SELECT PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+                                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table "
+                                   "AND PARTITION_NAME <> 'pmax'"), {'table': LONG_TABLE}).scalars().all()
+
+    # No table yet, or not partitioned by month: create_long_table() makes the partitions
+    if not bounds:
+        print(f"{engine.url.database}.{LONG_TABLE} has no month partitions, none added")
+        return 0
+
+    last_bound = max(datetime.strptime(bound.strip("'")[:10], '%Y-%m-%d').date() for bound in bounds)
+    new_bounds = [bound for bound in month_starts(last_bound, _month_ahead(months_ahead)) if bound > last_bound]
+
+    if not new_bounds:
+        return 0
+
+    partitions = [_partition(bound) for bound in new_bounds]
+    partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {LONG_TABLE} REORGANIZE PARTITION pmax INTO ({', '.join(partitions)})"))
+
+    return len(new_bounds)
+
+
+def migrate_tables(engine, exchange: str, tokens: list = None, drop: bool = False) -> int:
+    """Bulk-copy token_{n} tables into the 'candles' table, inside the database server.
+
+    Every table is copied with one INSERT ... SELECT in its own transaction, so an interrupted migration can be
+    run again: rows already copied are updated with the same values.
+
+    Args:
+        engine: candle or day database engine.
+        exchange: 'NSE', 'NFO' or 'INDEX'.
+        tokens: tokens to migrate, every token_{n} table of the database by default.
+        drop: drop the token tables once copied.
+
+    Returns:
+        The number of rows copied.
+    """
+
+    names = [name for name, _ in COLUMN_SPECS[exchange.upper()]]
+    columns = ", ".join(names)
+    updates = ", ".join(f"{name} = VALUES({name})" for name in names if name != 'time_stamp')
+
+    if tokens is None:
+        tokens = [int(name[6:]) for name in inspect(engine).get_table_names()
+                  if name.startswith('token_') and name[6:].isdigit()]
+
+    # Partitions have to cover the oldest candle
+    if LONG_TABLE not in inspect(engine).get_table_names():
+        with engine.connect() as conn:
+            oldest = [conn.execute(text(f"SELECT MIN(time_stamp) FROM token_{int(token)}")).scalar()
+                      for token in tokens]
+        create_long_table(engine, exchange, min([value for value in oldest if value] or [datetime.today()]).date())
+
+    copied = 0
+    begin = time.perf_counter()
+
+    for number, token in enumerate(tokens, 1):
+        with engine.begin() as conn:
+            result = conn.execute(text(f"INSERT INTO {LONG_TABLE} (instrument_token, {columns}) "
+                                       f"SELECT {int(token)}, {columns} FROM token_{int(token)} "
+                                       f"ON DUPLICATE KEY UPDATE {updates}"))
+            copied += result.rowcount
+
+            if drop:
+                conn.execute(text(f"DROP TABLE token_{int(token)}"))
+
+        if number % 100 == 0:
+            print(f"{number}/{len(tokens)} tables migrated, {time.perf_counter() - begin:.1f}s")
+
+    elapsed = time.perf_counter() - begin
+    print(f"{engine.url.database}: {len(tokens)} tables migrated into {LONG_TABLE} in {elapsed:.1f}s")
+
+    return copied
+
+
+def read_candles(conn, exchange: str, tokens: list, start: datetime, end: datetime, columns: list = None,
+                 layout: str = None) -> dict:
+    """Candles of several tokens in [start, end), ordered by time_stamp.
+
+    Args:
+        conn: connection of the candle or day database.
+        exchange: 'NSE', 'NFO' or 'INDEX'.
+        tokens: instrument tokens.
+        columns: columns to read, all the columns of the exchange by default.
+        layout: 'token' reads the token_{n} tables one by one, 'long' reads the 'candles' table with a single
+            query, CANDLE_LAYOUT by default.
+
+    Returns:
+        {token: [row dictionaries]}, tokens without candles are left out.
+    """
+
+    layout = CANDLE_LAYOUT if layout is None else layout
+    columns = [name for name, _ in COLUMN_SPECS[exchange.upper()]] if columns is None else columns
+    names = ", ".join(['time_stamp'] + [column for column in columns if column != 'time_stamp'])
+    parameters = {'start': start, 'end': end}
+    candles = {}
+
+    if layout == 'token':
+        for token in tokens:
+            try:
+                rows = conn.execute(text(f"SELECT {names} FROM token_{int(token)} "
+                                         f"WHERE time_stamp >= :start AND time_stamp < :end ORDER BY time_stamp"),
+                                    parameters)
+                rows = [dict(row._mapping) for row in rows]
+
+            except ProgrammingError as e:
+                # Missing table, e.g. a token added after the tables were created
+                print(f"token_{token}: candles not read. Error: {e.orig}")
+                conn.rollback()
+                continue
+
+            if rows:
+                candles[token] = rows
+
+        return candles
+
+    # One range scan of the partitions of the period, the primary key orders every token
+    tokens = ", ".join(str(int(token)) for token in tokens)
+    rows = conn.execute(text(f"SELECT instrument_token, {names} FROM {LONG_TABLE} "
+                             f"WHERE instrument_token IN ({tokens}) AND time_stamp >= :start AND time_stamp < :end "
+                             f"ORDER BY instrument_token, time_stamp"), parameters)
+
+    for row in rows:
+        row = dict(row._mapping)
+        candles.setdefault(row.pop('instrument_token'), []).append(row)
+
+    return candles
+
+
+if __name__ == '__main__':
+    import sys
+
+    # Migration: python candle_store.py migrate NFO [--drop], then run with CANDLE_LAYOUT=long
+    if len(sys.argv) >= 3 and sys.argv[1] == 'migrate':
+        exchange = sys.argv[2].upper()
+        for engine in (candle_engine(exchange), day_engine(exchange)):
+            migrate_tables(engine, exchange, drop='--drop' in sys.argv)
+        sys.exit()
+
+    # Monthly maintenance: python candle_store.py partitions
+    if sys.argv[1:] == ['partitions']:
+        for exchange in ('NSE', 'NFO', 'INDEX'):
+            for engine in (candle_engine(exchange), day_engine(exchange)):
+                print(f"{engine.url.database}: {add_partitions(engine)} partitions added")
+        sys.exit()
+
+    # DDL of the NFO candle table from the 2023-11 candles
+    from sqlalchemy.dialects import mysql
+
+    ddl = str(CreateTable(long_table('NFO')).compile(dialect=mysql.dialect())).strip()
+    partitions = [_partition(bound) for bound in month_starts(date(2023, 11, 20), today)]
+    print(ddl + "\nPARTITION BY RANGE COLUMNS(time_stamp) (\n    " + ",\n    ".join(partitions[:3]) + ",\n    ...\n    "
+          + partitions[-1] + ",\n    PARTITION pmax VALUES LESS THAN (MAXVALUE)\n)")
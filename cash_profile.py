@@ -0,0 +1,327 @@
+# Python Standard Library
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Local Library imports
+import tables
+from consumer import TickHandler
+from database import SessionLocalTokens, candle_engine, day_engine
+from option_chain import INDEX_SYMBOLS
+from candle_aggregator import upsert_rows
+from candle_store import read_candles
+
+# Parameters
+EPOCH = datetime(1970, 1, 1)
+
+# Index name -> weight column of NseTokenTable / NseTokenModel, loaded from NIFTY.json, BANKNIFTY.json, FINNIFTY.json
+WEIGHT_COLUMNS = {'NIFTY': 'nifty', 'BANKNIFTY': 'bank_nifty', 'FINNIFTY': 'fin_nifty'}
+
+
+def load_constituents() -> tuple:
+    """Read the NSE stocks with their index weights and the index tokens from the tokens database.
+
+    Returns:
+        (stocks, index_tokens): the NseTokenTable rows with a weight in any index, and {name: index instrument_token}.
+    """
+
+    db = SessionLocalTokens()
+
+    try:
+        stocks = db.query(tables.NseTokenTable).filter((tables.NseTokenTable.nifty > 0) |
+                                                       (tables.NseTokenTable.bank_nifty > 0) |
+                                                       (tables.NseTokenTable.fin_nifty > 0)).all()
+
+        symbols = {symbol: name for name, symbol in INDEX_SYMBOLS.items()}
+        indices = db.query(tables.IndexTokenTable) \
+            .filter(tables.IndexTokenTable.tradingsymbol.in_(list(symbols))).all()
+
+        index_tokens = {symbols[index.tradingsymbol]: index.instrument_token for index in indices}
+
+    finally:
+        db.close()
+
+    return stocks, index_tokens
+
+
+def load_previous_closes(tokens: list, day=None, days_back: int = 10) -> dict:
+    """Read the last close before 'day' of every token from the NSE day database, at startup.
+
+    Args:
+        tokens: instrument tokens of the constituents.
+        day: trading day, today by default.
+        days_back: calendar days searched back, enough to cover weekends and holidays.
+
+    Returns:
+        {token: previous close}, tokens without a day row are left out.
+    """
+
+    day = datetime.now().date() if day is None else day
+    end = datetime.combine(day, datetime.min.time())
+
+    try:
+        with day_engine('NSE').connect() as conn:
+            candles = read_candles(conn, 'NSE', tokens, end - timedelta(days=days_back), end, ['close'])
+
+    except Exception as e:
+        print(f"Previous closes not loaded, the first prices of the day are used. Error: {e}")
+        return {}
+
+    return {token: rows[-1]['close'] for token, rows in candles.items() if rows[-1]['close']}
+
+
+class CashProfileEngine(TickHandler):
+    """
+    Live cash_profile of the indices, computed from the ticks of their constituents and written into the index
+    candle rows.
+
+    The weights are a matrix with one row per index and one column per stock slot, every row normalised to 1, and
+    the constituents keep vectors of their latest price, total buy and total sell quantity. A tick batch updates
+    those vectors with one fancy assignment, then the index figures are matrix-vector products:
+        - change: weighted % change of the constituents since their reference price, the previous close from
+          'previous_closes' when loaded, else the first price of the day,
+        - breadth: advances, declines, unchanged and the weighted breadth sum(weight * sign(change)),
+        - order imbalance: weighted (buy - sell) / (buy + sell) of the constituents.
+    Every minute, the open, high, low and close of the weighted change over the batches, the breadth, the order
+    imbalance and the top contributors of an index are emitted as its cash_profile.
+    """
+
+    def __init__(self, stocks: list, index_tokens: dict, previous_closes: dict = None, engine=None,
+                 flush_seconds: float = 5.0, top: int = 5):
+        self.engine = candle_engine('INDEX') if engine is None else engine
+        self.index_tokens = index_tokens
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.monotonic()
+        self.unflushed = 0  # batches handled since the last successful flush
+        self.top = top
+
+        self.names = [name for name in WEIGHT_COLUMNS if name in index_tokens]
+        stocks = [stock for stock in stocks if any((getattr(stock, WEIGHT_COLUMNS[name]) or 0) > 0
+                                                   for name in self.names)]
+
+        # token -> slot
+        self.slots = {stock.instrument_token: slot for slot, stock in enumerate(stocks)}
+        self.symbols = np.array([stock.tradingsymbol for stock in stocks], dtype=object)
+
+        # Weight matrix, one row per index
+        weights = np.array([[getattr(stock, WEIGHT_COLUMNS[name]) or 0.0 for stock in stocks]
+                            for name in self.names], dtype=np.float64).reshape(len(self.names), len(stocks))
+        totals = weights.sum(axis=1, keepdims=True)
+        self.weights = np.divide(weights, totals, out=np.zeros_like(weights), where=totals > 0)
+        self.members = self.weights > 0
+
+        # Latest state of the constituents
+        size = len(stocks)
+        self.ltp = np.zeros(size, dtype=np.float64)
+        self.reference = np.zeros(size, dtype=np.float64)
+        self.buy = np.zeros(size, dtype=np.float64)
+        self.sell = np.zeros(size, dtype=np.float64)
+        self.seen = np.zeros(size, dtype=bool)
+
+        # Previous closes, e.g. from load_previous_closes(), the binary tick format has no 'ohlc'
+        for token, close in (previous_closes or {}).items():
+            if token in self.slots:
+                self.reference[self.slots[token]] = close
+
+        # Weighted change over the batches of the current minute: open, high, low, close per index
+        self.minute = -1
+        self.change_ohlc = None
+        self.rows = []
+
+    def update(self, ticks: list):
+        """ Apply a batch of NSE ticks, ticks of other tokens are ignored """
+
+        slots = self.slots
+        ticks = [tick for tick in ticks if tick['instrument_token'] in slots]
+        if not ticks:
+            return
+
+        # Exchange time moved on: the previous minute is complete
+        minutes = [int((tick['exchange_timestamp'] - EPOCH).total_seconds()) // 60 for tick in ticks
+                   if tick.get('exchange_timestamp') is not None]
+        minute = max(minutes) if minutes else self.minute
+
+        if minute > self.minute:
+            if self.minute >= 0:
+                self.__emit()
+            self.minute = minute
+
+        count = len(ticks)
+        slot = np.fromiter((slots[tick['instrument_token']] for tick in ticks), dtype=np.int64, count=count)
+        price = np.fromiter((tick['last_price'] for tick in ticks), dtype=np.float64, count=count)
+
+        # Repeated slots keep their last tick
+        self.ltp[slot] = price
+        self.buy[slot] = np.fromiter((tick.get('total_buy_quantity') or 0 for tick in ticks), np.float64, count)
+        self.sell[slot] = np.fromiter((tick.get('total_sell_quantity') or 0 for tick in ticks), np.float64, count)
+
+        # Reference price: the previous close when loaded, else the first price seen
+        first = ~self.seen[slot] & (self.reference[slot] == 0)
+        self.reference[slot[first]] = price[first]
+        self.seen[slot] = True
+
+        change = self.weights @ self.__returns()
+
+        if self.change_ohlc is None:
+            self.change_ohlc = np.stack([change, change, change, change])
+        else:
+            self.change_ohlc[1] = np.maximum(self.change_ohlc[1], change)
+            self.change_ohlc[2] = np.minimum(self.change_ohlc[2], change)
+            self.change_ohlc[3] = change
+
+    def __returns(self):
+        """ % change of every constituent since its reference price, 0 before its first tick """
+
+        return np.divide(self.ltp - self.reference, self.reference, out=np.zeros_like(self.ltp),
+                         where=self.reference > 0) * 100
+
+    def __emit(self):
+        if self.change_ohlc is None:
+            return
+
+        time_stamp = EPOCH + timedelta(minutes=self.minute)
+        returns = self.__returns()
+        sign = np.sign(returns) * self.seen
+
+        # Breadth and order imbalance, one entry per index
+        advances = ((sign > 0) & self.members).sum(axis=1)
+        declines = ((sign < 0) & self.members).sum(axis=1)
+        unchanged = ((sign == 0) & self.seen & self.members).sum(axis=1)
+        weighted_breadth = self.weights @ sign
+
+        book = self.buy + self.sell
+        imbalance = np.divide(self.buy - self.sell, book, out=np.zeros_like(book), where=book > 0)
+        weighted_imbalance = self.weights @ imbalance
+
+        contribution = self.weights * returns
+
+        for index, name in enumerate(self.names):
+            top = np.argsort(-np.abs(contribution[index]))[:self.top]
+            top = top[contribution[index][top] != 0]
+
+            cash_profile = {
+                'change': {key: round(value, 4) for key, value in
+                           zip(('open', 'high', 'low', 'close'), self.change_ohlc[:, index].tolist())},
+                'advances': int(advances[index]),
+                'declines': int(declines[index]),
+                'unchanged': int(unchanged[index]),
+                'weighted_breadth': round(float(weighted_breadth[index]), 4),
+                'order_imbalance': round(float(weighted_imbalance[index]), 4),
+                'top_contributors': dict(zip(self.symbols[top].tolist(),
+                                             np.round(contribution[index][top], 4).tolist())),
+            }
+
+            self.rows.append({'instrument_token': self.index_tokens[name], 'time_stamp': time_stamp,
+                              'cash_profile': json.dumps(cash_profile)})
+
+        self.change_ohlc = None
+
+    def finish(self):
+        """ Emit the last minute, at the market close """
+
+        self.__emit()
+
+    def completed_rows(self) -> list:
+        rows, self.rows = self.rows, []
+        return rows
+
+    def flush(self) -> int:
+        """ Write the completed minutes into the index candle rows, only cash_profile is updated """
+
+        rows = self.completed_rows()
+        self.last_flush = time.monotonic()
+
+        if not rows:
+            self.unflushed = 0
+            return 0
+
+        try:
+            written = upsert_rows(self.engine, rows)
+
+        except Exception:
+            # Kept for the next flush
+            self.rows = rows + self.rows
+            raise
+
+        self.unflushed = 0
+        return written
+
+    # TickHandler interface, to consume the NSE queue directly
+    def handle(self, received, ticks: list):
+        self.update(ticks)
+        self.unflushed += 1
+
+        if time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def pending(self) -> bool:
+        return self.unflushed > 0
+
+    def idle(self):
+        if self.unflushed and time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def close(self):
+        self.finish()
+        self.flush()
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    from models import NseTokenModel
+
+    if len(sys.argv) == 2 and sys.argv[1] == 'live':
+        # NSE candles and the index cash profiles from the same queue: python cash_profile.py live
+        from consumer import RabbitMQConsumer, MultiHandler
+        from candle_aggregator import CandleAggregator, CandleHandler
+
+        stocks, index_tokens = load_constituents()
+        previous_closes = load_previous_closes([stock.instrument_token for stock in stocks])
+
+        handler = MultiHandler([CandleHandler(CandleAggregator('NSE')),
+                                CashProfileEngine(stocks, index_tokens, previous_closes)])
+
+        consumer = RabbitMQConsumer('NSE_queue')
+        consumer.consume_messages(handler)
+        consumer.close_connection()
+        sys.exit()
+
+    # Benchmark: the constituents of the weight files, one hour of 1 second batches
+    weights = {}
+    for name, column in WEIGHT_COLUMNS.items():
+        with open(f"{name}.json", "r") as json_file:
+            for symbol, weight in json.load(json_file).items():
+                weights.setdefault(symbol, {})[column] = weight
+
+    stocks = [NseTokenModel(instrument_token=1_000 + index, tradingsymbol=symbol, name=symbol, **columns)
+              for index, (symbol, columns) in enumerate(weights.items())]
+    engine = CashProfileEngine(stocks, {'NIFTY': 256265, 'BANKNIFTY': 260105, 'FINNIFTY': 257801},
+                               {stock.instrument_token: 1_000.0 for stock in stocks}, engine=object())
+
+    market_open = datetime(2023, 12, 18, 9, 15)
+    prices = {stock.instrument_token: 1_000.0 for stock in stocks}
+
+    batches = []
+    for second in range(3_600):
+        batch = []
+        for token in random.sample(list(prices), 40):
+            prices[token] *= 1 + random.gauss(0, 0.0005)
+            batch.append({'instrument_token': token, 'exchange_timestamp': market_open + timedelta(seconds=second),
+                          'last_price': prices[token],
+                          'total_buy_quantity': random.randint(0, 10**6),
+                          'total_sell_quantity': random.randint(0, 10**6)})
+        batches.append(batch)
+
+    begin = time.perf_counter()
+    for batch in batches:
+        engine.update(batch)
+    engine.finish()
+    elapsed = time.perf_counter() - begin
+
+    rows = engine.completed_rows()
+    print(f"{len(stocks)} constituents, {len(batches)} batches, {len(rows)} index rows, "
+          f"{elapsed / len(batches) * 1000:.3f} ms per batch")
+    print(rows[-1]['cash_profile'])
@@ -1,13 +1,160 @@
+import json
 import pika
 import time
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from tick_codec import is_binary_message, unpack_message, parse_legacy_ticks
+
+
+class TickHandler(ABC):
+    """ Base class of the consumer handlers, receives decoded tick batches instead of raw bytes """
+
+    # True when handle() can run on several consumer worker threads at once, otherwise the calls are serialized
+    thread_safe = False
+
+    @abstractmethod
+    def handle(self, received, ticks: list):
+        """Process one batch.
+
+        Args:
+            received: receive time of the batch on the recorder, datetime for binary messages,
+                'HH:MM:SS.fff' string for json messages.
+            ticks: list of kite tick dictionaries.
+        """
+
+    def pending(self) -> bool:
+        """ True while handled batches are only in memory, their messages are acknowledged once it is False """
+        return False
+
+    def idle(self):
+        """ Called about every 'ack_ms' milliseconds by the consumer, e.g. to flush on a quiet queue """
+        pass
+
+    def close(self):
+        """ Called once when consuming stops """
+        pass
+
+
+class PrintHandler(TickHandler):
+    thread_safe = True
+
+    def handle(self, received, ticks: list):
+        print(f"Received {len(ticks)} ticks at {received}")
+
+
+class MultiHandler(TickHandler):
+    """ Hands every batch to several handlers, e.g. NFO candles and the index option chain from one queue """
+
+    def __init__(self, handlers: list):
+        self.handlers = list(handlers)
+        self.thread_safe = all(handler.thread_safe for handler in self.handlers)
+
+    def handle(self, received, ticks: list):
+        for handler in self.handlers:
+            handler.handle(received, ticks)
+
+    def pending(self) -> bool:
+        return any(handler.pending() for handler in self.handlers)
+
+    def idle(self):
+        for handler in self.handlers:
+            handler.idle()
+
+    def close(self):
+        for handler in self.handlers:
+            handler.close()
+
+
+def decode_message(body: bytes) -> list:
+    """ Decode a broker message into a list of (received, ticks) batches, binary or json of str(ticks) """
+
+    if is_binary_message(body):
+        return [unpack_message(body)]
+
+    return [(received, parse_legacy_ticks(text)) for received, text in json.loads(body).items()]
+
+
+class AckTracker:
+    """
+    Batches the acks of a channel. With parallel workers messages complete out of order, so only the contiguous
+    run of completed delivery tags is acknowledged, with a single 'multiple' ack.
+    """
+
+    def __init__(self, channel, ack_every: int, ack_ms: int):
+        self.channel = channel
+        self.ack_every = ack_every
+        self.ack_ms = ack_ms
+
+        self.acked = 0  # last delivery tag acknowledged
+        self.completed = 0  # last delivery tag of the contiguous completed run
+        self.done = set()  # completed tags above 'completed'
+        self.last_ack = time.monotonic()
+
+    def complete(self, delivery_tag: int):
+        """ Mark a message as processed, must run on the connection thread """
+
+        self.done.add(delivery_tag)
+
+        while self.completed + 1 in self.done:
+            self.completed += 1
+            self.done.remove(self.completed)
+
+        if self.completed - self.acked >= self.ack_every:
+            self.flush()
+
+    def flush(self):
+        if self.completed > self.acked:
+            self.channel.basic_ack(delivery_tag=self.completed, multiple=True)
+            self.acked = self.completed
+
+        self.last_ack = time.monotonic()
+
+    def due(self) -> bool:
+        return (time.monotonic() - self.last_ack) * 1000 >= self.ack_ms
+
 
 class RabbitMQConsumer:
-    def __init__(self, queue_name, host='localhost', username='guest', password='guest'):
+    def __init__(self, queue_name, host='localhost', username='guest', password='guest', prefetch=1000,
+                 ack_every=200, ack_ms=200, workers=0, connection=None):
+        """Queue consumer handing decoded tick batches to a TickHandler.
+
+        Args:
+            prefetch: basic_qos prefetch count, messages in flight without ack.
+            ack_every: acknowledge once this many messages are processed, with one 'multiple' ack.
+            ack_ms: acknowledge at least every this many milliseconds.
+            workers: 0 runs the handler on the connection thread in arrival order, otherwise a pool of this many
+                threads decodes the messages in parallel and batches may be handled out of order. The handler
+                calls are serialized unless the handler is thread_safe.
+
+        A message is acknowledged once the handler has nothing pending from it, i.e. after the flush that wrote
+        its rows for the buffering handlers.
+            connection: an already open connection, e.g. a local broker stand-in.
+        """
+
         self.queue_name = queue_name
         self.host = host
         self.credentials = pika.PlainCredentials(username, password)
         self.connection_params = pika.ConnectionParameters(host=self.host, credentials=self.credentials)
-        self.connection = self.connect()
+
+        # Consumer parameters, the broker would stop delivering before an ack batch could complete
+        self.prefetch = prefetch
+        self.ack_every = min(ack_every, prefetch)
+        self.ack_ms = ack_ms
+        self.workers = workers
+
+        # Counters
+        self.messages = 0
+        self.ticks = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+        # Handler calls of the workers, and the delivery tags handled but not written by the handler yet
+        self.handler_lock = threading.Lock()
+        self.unwritten = []
+
+        self.connection = self.connect() if connection is None else connection
 
     def connect(self):
         try:
@@ -17,15 +164,127 @@ class RabbitMQConsumer:
             print(f"Error connecting to RabbitMQ: {e}")
             return None
 
-    def consume_messages(self):
+    def __handle(self, handler: TickHandler, body: bytes, delivery_tag: int) -> list:
+        """ Decode and handle a message, returns the delivery tags that can be acknowledged """
+
+        try:
+            batches = decode_message(body)
+
+        except Exception as e:
+            # The message is still acknowledged, a bad batch must not block the queue
+            batches = []
+            with self.lock:
+                self.errors += 1
+            print(f"Error decoding message: {e}")
+
+        lock = self.handler_lock if self.workers and not handler.thread_safe else None
+
+        if lock is not None:
+            lock.acquire()
+
+        try:
+            count = 0
+            for received, ticks in batches:
+                handler.handle(received, ticks)
+                count += len(ticks)
+
+            with self.lock:
+                self.messages += 1
+                self.ticks += count
+
+        except Exception as e:
+            # The message is still acknowledged, a bad batch must not block the queue
+            with self.lock:
+                self.errors += 1
+            print(f"Error handling message: {e}")
+
+        finally:
+            written = self.__written(handler, delivery_tag)
+
+            if lock is not None:
+                lock.release()
+
+        return written
+
+    def __written(self, handler: TickHandler, delivery_tag: int = None) -> list:
+        # Tags of the messages handled so far, once the handler has written everything it buffered
+        with self.lock:
+            if delivery_tag is not None:
+                self.unwritten.append(delivery_tag)
+
+            if handler.pending():
+                return []
+
+            tags, self.unwritten = self.unwritten, []
+            return tags
+
+    def __idle(self, handler: TickHandler) -> list:
+        lock = self.handler_lock if self.workers and not handler.thread_safe else None
+
+        if lock is not None:
+            lock.acquire()
+
+        try:
+            handler.idle()
+
+        except Exception as e:
+            print(f"Error flushing the handler: {e}")
+
+        finally:
+            written = self.__written(handler)
+
+            if lock is not None:
+                lock.release()
+
+        return written
+
+    def consume_messages(self, handler: TickHandler = None):
+        handler = PrintHandler() if handler is None else handler
+        pool = ThreadPoolExecutor(max_workers=self.workers) if self.workers else None
+
         try:
             channel = self.connection.channel()
             channel.queue_declare(queue=self.queue_name)
+            channel.basic_qos(prefetch_count=self.prefetch)
+
+            acks = AckTracker(channel, self.ack_every, self.ack_ms)
+
+            def complete(tags):
+                for tag in tags:
+                    acks.complete(tag)
 
             def callback(ch, method, properties, body):
-                print(f"Received message: {body.decode()}")
+                delivery_tag = method.delivery_tag
+
+                if pool is None:
+                    complete(self.__handle(handler, body, delivery_tag))
+                    return
+
+                # The ack has to be sent from the connection thread
+                def work():
+                    tags = self.__handle(handler, body, delivery_tag)
+                    self.connection.add_callback_threadsafe(lambda: complete(tags))
+
+                pool.submit(work)
+
+            def idle_work():
+                tags = self.__idle(handler)
+                self.connection.add_callback_threadsafe(lambda: complete(tags))
+
+            # Time based handler flush and ack flush, so a quiet queue does not keep messages unacknowledged
+            def flush_acks():
+                if pool is None:
+                    complete(self.__idle(handler))
+                else:
+                    pool.submit(idle_work)
+
+                if acks.due():
+                    acks.flush()
+                self.connection.call_later(self.ack_ms / 1000, flush_acks)
 
-            channel.basic_consume(queue=self.queue_name, on_message_callback=callback, auto_ack=True)
+            self.connection.call_later(self.ack_ms / 1000, flush_acks)
+
+            channel.basic_consume(queue=self.queue_name, on_message_callback=callback, auto_ack=False)
 
             print(f"Waiting for messages from queue '{self.queue_name}'. To exit, press CTRL+C")
             channel.start_consuming()
@@ -33,20 +292,146 @@ class RabbitMQConsumer:
         except pika.exceptions.AMQPError as e:
             print(f"Error consuming messages: {e}")
 
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+            handler.close()
+
     def close_connection(self):
         if self.connection and not self.connection.is_closed:
             self.connection.close()
             print("Connection to RabbitMQ closed")
 
+
+class LocalBroker:
+    """
+    In-process stand-in for a RabbitMQ queue with the subset of the blocking pika API used by RabbitMQConsumer,
+    used to size consumer counts without a broker. Delivery respects the prefetch window and consuming stops once
+    every message is acknowledged.
+    """
+
+    class Method:
+        def __init__(self, delivery_tag):
+            self.delivery_tag = delivery_tag
+
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.is_closed = False
+        self.prefetch = 0
+        self.callback = None
+        self.acked = 0
+        self.callbacks = []
+        self.timers = []
+        self.lock = threading.Lock()
+
+    # Connection API
+    def channel(self):
+        return self
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        self.timers.append((time.monotonic() + delay, callback))
+
+    def close(self):
+        self.is_closed = True
+
+    # Channel API
+    def queue_declare(self, queue):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.callback = on_message_callback
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked = delivery_tag
+
+    def start_consuming(self):
+        delivered = 0
+
+        while self.acked < len(self.messages):
+            # Deliver inside the prefetch window
+            while delivered < len(self.messages) and delivered - self.acked < self.prefetch:
+                delivered += 1
+                self.callback(self, self.Method(delivered), None, self.messages[delivered - 1])
+
+            with self.lock:
+                callbacks, self.callbacks = self.callbacks, []
+
+            for callback in callbacks:
+                callback()
+
+            now = time.monotonic()
+            due = [timer for timer in self.timers if timer[0] <= now]
+            self.timers = [timer for timer in self.timers if timer[0] > now]
+
+            for _, callback in due:
+                callback()
+
+            if not callbacks and not due:
+                time.sleep(0.0001)
+
+
 # Example usage for consuming messages from a queue:
 if __name__ == "__main__":
-    # Create an instance of RabbitMQConsumer for your_queue
-    consumer = RabbitMQConsumer('nfo_queue')
+    import sys
+    from datetime import datetime, timedelta
+    from tick_codec import TickLayout, pack_message
+
+    if sys.argv[1:] != ['benchmark']:
+        # Create an instance of RabbitMQConsumer for your_queue
+        consumer = RabbitMQConsumer('nfo_queue')
+
+        # Consume messages from the queue
+        consumer.consume_messages()
+
+        # To stop consuming, press CTRL+C or handle an exit condition
+
+        # Close the connection when done consuming messages
+        consumer.close_connection()
+        sys.exit()
+
+    # Throughput benchmark against the local broker stand-in: python consumer.py benchmark
+    layout = TickLayout(['exchange_timestamp', 'last_price', 'average_traded_price', 'total_buy_quantity',
+                         'total_sell_quantity', 'volume_traded', 'oi'])
+    market_open = datetime(2023, 12, 18, 9, 15)
+
+    def batch(second):
+        return [{'instrument_token': token, 'exchange_timestamp': market_open + timedelta(seconds=second),
+                 'last_price': 101.5, 'average_traded_price': 100.25, 'total_buy_quantity': 5000,
+                 'total_sell_quantity': 4000, 'volume_traded': 100 * second, 'oi': 2500}
+                for token in range(10_000_000, 10_000_100)]
+
+    class CountHandler(TickHandler):
+        thread_safe = True
+
+        def __init__(self, work_ms=0.0):
+            self.work_ms = work_ms
+
+        def handle(self, received, ticks):
+            if self.work_ms:
+                time.sleep(self.work_ms / 1000)
+
+    binary_messages = [pack_message(layout, batch(second)) for second in range(2_000)]
+    json_messages = [json.dumps({'09:15:00.000': str(batch(second))}).encode() for second in range(200)]
+
+    def benchmark(label, messages, **kwargs):
+        work_ms = kwargs.pop('work_ms', 0.0)
+        consumer = RabbitMQConsumer('nfo_queue', connection=LocalBroker(messages), **kwargs)
 
-    # Consume messages from the queue
-    consumer.consume_messages()
+        begin = time.perf_counter()
+        consumer.consume_messages(CountHandler(work_ms))
+        elapsed = time.perf_counter() - begin
 
-    # To stop consuming, press CTRL+C or handle an exit condition
+        print(f"{label:<40} {consumer.messages / elapsed:>10,.0f} msg/sec {consumer.ticks / elapsed:>12,.0f} ticks/sec")
 
-    # Close the connection when done consuming messages
-    consumer.close_connection()
+    benchmark("json str(ticks), serial", json_messages)
+    benchmark("binary, serial", binary_messages)
+    benchmark("binary, 1 ms handler, serial", binary_messages[:500], work_ms=1)
+    benchmark("binary, 1 ms handler, 4 workers", binary_messages[:500], work_ms=1, workers=4)
+    benchmark("binary, 1 ms handler, 8 workers", binary_messages[:500], work_ms=1, workers=8)
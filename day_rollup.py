@@ -0,0 +1,311 @@
+# Python Standard Library
+import os
+import json
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+# Local Library imports
+import tables
+from database import SessionLocalTokens, candle_engine, day_engine
+from candle_store import read_candles
+from candle_aggregator import upsert_rows
+
+# Parameters
+today = datetime.today().date()
+PROFILE_COLUMNS = {
+    'NSE': ['volume', 'liquidity_profile', 'volume_profile', 'order_profile', 'candle_data'],
+    'NFO': ['volume', 'liquidity_profile', 'volume_profile', 'order_profile', 'candle_data'],
+    'INDEX': ['candle_data', 'cash_profile', 'future_profile', 'option_profile', 'option_strike_data'],
+}
+
+
+def updated_tokens(exchange: str, day=None) -> list:
+    """ Tokens of the exchange updated on 'day', today by default """
+
+    token_tables = {'NSE': tables.NseTokenTable, 'NFO': tables.NfoTokenTable, 'INDEX': tables.IndexTokenTable}
+    token_table = token_tables[exchange.upper()]
+    day = today if day is None else day
+
+    db = SessionLocalTokens()
+
+    try:
+        return [item.instrument_token for item in db.query(token_table).filter(token_table.last_update == day)]
+
+    finally:
+        db.close()
+
+
+def _load(value):
+    """ JSON column value as a python object, MySQL JSON columns come back as strings through text() queries """
+
+    if value is None or value == '':
+        return None
+
+    return json.loads(value) if isinstance(value, (str, bytes)) else value
+
+
+def merge_volume_profiles(profiles: list) -> dict:
+    """ Sum the volume traded at every price level """
+
+    merged = {}
+    for profile in profiles:
+        for price, volume in profile.items():
+            merged[price] = merged.get(price, 0) + volume
+
+    return dict(sorted(merged.items(), key=lambda item: float(item[0])))
+
+
+def merge_liquidity_profiles(profiles: list) -> dict:
+    """ Day open, high, low, close and mean of the total buy and sell quantity """
+
+    merged = {}
+    for side in ('buy', 'sell'):
+        sides = [profile[side] for profile in profiles]
+        merged[side] = {'open': sides[0]['open'], 'high': max(item['high'] for item in sides),
+                        'low': min(item['low'] for item in sides), 'close': sides[-1]['close'],
+                        'mean': round(sum(item['mean'] for item in sides) / len(sides), 2)}
+
+    return merged
+
+
+def merge_order_profiles(profiles: list) -> dict:
+    """ Day totals of the order flow, imbalance open / close of the day and mean of the minutes """
+
+    merged = {name: sum(profile[name] for profile in profiles)
+              for name in ('buy_qty_change', 'sell_qty_change', 'net_qty_change', 'aggressive_buy',
+                           'aggressive_sell', 'neutral_volume', 'ticks')}
+
+    aggressive = merged['aggressive_buy'] + merged['aggressive_sell']
+    merged['imbalance_open'] = profiles[0]['imbalance_open']
+    merged['imbalance_close'] = profiles[-1]['imbalance_close']
+    merged['imbalance_mean'] = round(sum(profile['imbalance_mean'] for profile in profiles) / len(profiles), 4)
+    merged['aggressor_ratio'] = round(merged['aggressive_buy'] / aggressive, 4) if aggressive else None
+
+    return merged
+
+
+def merge_cash_profiles(profiles: list) -> dict:
+    """ Change range of the day, breadth, imbalance and contributors of the last minute """
+
+    merged = dict(profiles[-1])
+    merged['change'] = {'open': profiles[0]['change']['open'],
+                        'high': max(profile['change']['high'] for profile in profiles),
+                        'low': min(profile['change']['low'] for profile in profiles),
+                        'close': profiles[-1]['change']['close']}
+
+    return merged
+
+
+def merge_option_profiles(profiles: list) -> dict:
+    """ Open interest of the last minute, oi change and volume summed over the day """
+
+    merged = dict(profiles[-1])
+    for name in ('call_oi_change', 'put_oi_change', 'call_volume', 'put_volume'):
+        merged[name] = sum(profile[name] for profile in profiles)
+
+    merged['pcr_volume'] = round(merged['put_volume'] / merged['call_volume'], 4) if merged['call_volume'] else None
+
+    return merged
+
+
+def merge_contract_snapshots(snapshots: list) -> dict:
+    """ {key: {'ltp', 'oi', 'oi_change', 'volume'}} snapshots, last ltp and oi, oi change and volume summed """
+
+    merged = {}
+    for snapshot in snapshots:
+        for key, contract in snapshot.items():
+            day = merged.setdefault(key, {'oi_change': 0, 'volume': 0})
+            day['ltp'], day['oi'] = contract['ltp'], contract['oi']
+            day['oi_change'] += contract['oi_change']
+            day['volume'] += contract['volume']
+
+    return merged
+
+
+def merge_strike_data(snapshots: list) -> dict:
+    """ Per strike and side, see merge_contract_snapshots """
+
+    sides = {}
+    for snapshot in snapshots:
+        for strike, contracts in snapshot.items():
+            for side, contract in contracts.items():
+                sides.setdefault(side, []).append({strike: contract})
+
+    merged = {}
+    for side, side_snapshots in sides.items():
+        for strike, contract in merge_contract_snapshots(side_snapshots).items():
+            merged.setdefault(strike, {})[side] = contract
+
+    return dict(sorted(merged.items(), key=lambda item: float(item[0])))
+
+
+PROFILE_MERGERS = {
+    'volume_profile': merge_volume_profiles,
+    'liquidity_profile': merge_liquidity_profiles,
+    'order_profile': merge_order_profiles,
+    'cash_profile': merge_cash_profiles,
+    'option_profile': merge_option_profiles,
+    'future_profile': merge_contract_snapshots,
+    'option_strike_data': merge_strike_data,
+}
+
+
+def rollup_candles(exchange: str, token: int, candles: list, day) -> dict:
+    """Build the day row of a token from its minute candles.
+
+    Args:
+        exchange: 'NSE', 'NFO' or 'INDEX'.
+        token: instrument token.
+        candles: minute candle rows of the day, ordered by time_stamp, as dictionaries of the candle columns.
+        day: date of the candles.
+
+    Returns:
+        The day row, time_stamp being the day at 00:00, or None without candles.
+    """
+
+    if not candles:
+        return None
+
+    row = {'instrument_token': token, 'time_stamp': datetime.combine(day, datetime.min.time())}
+
+    # Index rows can hold profiles written before their candle, only the priced ones make the OHLC
+    priced = [candle for candle in candles if candle['open'] is not None]
+    if priced:
+        row.update({'open': priced[0]['open'], 'high': max(candle['high'] for candle in priced),
+                    'low': min(candle['low'] for candle in priced), 'close': priced[-1]['close']})
+
+    columns = PROFILE_COLUMNS[exchange.upper()]
+
+    if 'volume' in columns:
+        row['volume'] = sum(candle.get('volume') or 0 for candle in candles)
+
+    ticks = sum((_load(candle.get('candle_data')) or {}).get('ticks', 0) for candle in candles)
+    row['candle_data'] = json.dumps({'ticks': ticks, 'minutes': len(candles),
+                                     'first': str(candles[0]['time_stamp']), 'last': str(candles[-1]['time_stamp'])})
+
+    for column, merge in PROFILE_MERGERS.items():
+        if column not in columns:
+            continue
+
+        profiles = [profile for profile in (_load(candle.get(column)) for candle in candles) if profile]
+        row[column] = json.dumps(merge(profiles)) if profiles else None
+
+    return row
+
+
+def _init_worker():
+    # Connections of the parent process must not be shared with the forked workers
+    candle_engine('NSE').dispose(close=False)
+    candle_engine('NFO').dispose(close=False)
+    candle_engine('INDEX').dispose(close=False)
+
+
+def _rollup_tokens(exchange: str, tokens: list, day) -> list:
+    """ Worker: read the candles of a chunk of tokens over one connection and build their day rows """
+
+    rows = []
+    start = datetime.combine(day, datetime.min.time())
+    columns = ['open', 'high', 'low', 'close'] + PROFILE_COLUMNS[exchange.upper()]
+
+    with candle_engine(exchange).connect() as conn:
+        try:
+            candles = read_candles(conn, exchange, tokens, start, start + timedelta(days=1), columns)
+
+        except Exception as e:
+            print(f"{exchange}: reading the candles of {len(tokens)} tokens failed. Error: {e}")
+            return rows
+
+    for token, token_candles in candles.items():
+        try:
+            rows.append(rollup_candles(exchange, token, token_candles, day))
+
+        except Exception as e:
+            print(f"token_{token}: day rollup failed. Error: {e}")
+
+    return rows
+
+
+def rollup_day(exchange: str, day=None, workers: int = None, chunk_size: int = 25) -> int:
+    """Roll the minute candles of every token updated on 'day' up into the day database.
+
+    Args:
+        exchange: 'NSE', 'NFO' or 'INDEX'.
+        day: date to roll up, today by default.
+        workers: processes of the pool, os.cpu_count() by default.
+        chunk_size: tokens handled by a worker per task, over one database connection.
+
+    Returns:
+        The number of day rows written.
+    """
+
+    exchange = exchange.upper()
+    day = today if day is None else day
+    tokens = updated_tokens(exchange, day)
+
+    chunks = [tokens[index:index + chunk_size] for index in range(0, len(tokens), chunk_size)]
+    rows = []
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker) as pool:
+        for chunk_rows in pool.map(_rollup_tokens, [exchange] * len(chunks), chunks, [day] * len(chunks)):
+            rows.extend(chunk_rows)
+
+    # One transaction, one statement per token table
+    written = upsert_rows(day_engine(exchange), rows) if rows else 0
+    print(f"{exchange}: {written} of {len(tokens)} tokens rolled up for {day}")
+
+    return written
+
+
+def rollup_all(day=None, workers: int = None) -> dict:
+    """ End-of-day job: roll up NSE, NFO and INDEX """
+
+    return {exchange: rollup_day(exchange, day, workers) for exchange in ('NSE', 'NFO', 'INDEX')}
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+
+    if sys.argv[1:] != ['benchmark']:
+        # Run after the market close, before the next preprocessing()
+        begin = time.perf_counter()
+        rollup_all()
+        print(f"Day rollup finished in {time.perf_counter() - begin:.1f}s")
+        sys.exit()
+
+    # Benchmark of the rollup itself: 700 NFO tokens with 375 minute candles and their profiles
+    day = datetime(2023, 12, 18).date()
+    market_open = datetime(2023, 12, 18, 9, 15)
+
+    def candles():
+        price = 100.0
+        for minute in range(375):
+            price += random.choice((-0.5, 0, 0.5))
+            yield {'time_stamp': market_open + timedelta(minutes=minute), 'open': price, 'high': price + 1,
+                   'low': price - 1, 'close': price, 'volume': 1_000,
+                   'candle_data': json.dumps({'ticks': 60}),
+                   'volume_profile': json.dumps({str(price): 600, str(price + 0.5): 400}),
+                   'liquidity_profile': json.dumps({side: {'open': 1, 'high': 3, 'low': 1, 'close': 2, 'mean': 2.0}
+                                                    for side in ('buy', 'sell')}),
+                   'order_profile': json.dumps({'buy_qty_change': 10, 'sell_qty_change': 5, 'net_qty_change': 5,
+                                                'imbalance_open': 0.1, 'imbalance_close': 0.2, 'imbalance_mean': 0.15,
+                                                'aggressive_buy': 600, 'aggressive_sell': 400, 'neutral_volume': 0,
+                                                'aggressor_ratio': 0.6, 'ticks': 60})}
+
+    tokens = {token: list(candles()) for token in range(700)}
+
+    begin = time.perf_counter()
+    rows = [rollup_candles('NFO', token, token_candles, day) for token, token_candles in tokens.items()]
+    elapsed = time.perf_counter() - begin
+
+    print(f"{len(rows)} tokens rolled up in {elapsed:.2f}s on one process")
+
+    begin = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        rows = list(pool.map(rollup_candles, ['NFO'] * len(tokens), list(tokens), list(tokens.values()),
+                             [day] * len(tokens), chunksize=25))
+    elapsed = time.perf_counter() - begin
+
+    print(f"{len(rows)} tokens rolled up in {elapsed:.2f}s on {os.cpu_count()} processes")
+    print({key: value for key, value in rows[0].items() if key != 'volume_profile'})
@@ -0,0 +1,67 @@
+# Python Standard Library
+import os
+import sys
+import time
+import subprocess
+
+# Local Library imports
+# __none__
+
+# Parameters
+DEFAULT_MODULES = ['kite_websocket', 'record_ticks', 'main', 'database']
+
+
+def import_report(module: str, top: int = 10) -> dict:
+    """Import a module in a fresh interpreter with '-X importtime' and collect the slowest imports.
+
+    Args:
+        module: module of this folder, e.g. 'kite_websocket'.
+        top: number of imports kept, by cumulative time.
+
+    Returns:
+        {'module', 'wall' seconds of the interpreter, 'total' cumulative import seconds of the module,
+         'imports': [(cumulative seconds, self seconds, name)], 'error': stderr tail when the import failed}.
+    """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    begin = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=folder, capture_output=True, text=True)
+    wall = time.perf_counter() - begin
+
+    imports = []
+    errors = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            errors.append(line)
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            continue  # header line
+
+        imports.append((int(fields[1]) / 1e6, int(fields[0]) / 1e6, fields[2].strip()))
+
+    total = next((cumulative for cumulative, _, name in imports if name == module), 0.0)
+    imports.sort(reverse=True)
+
+    return {'module': module, 'wall': wall, 'total': total, 'imports': imports[:top],
+            'error': "\n".join(errors[-5:]) if result.returncode else None}
+
+
+def print_report(report: dict):
+    print(f"\n{report['module']}: interpreter {report['wall'] * 1000:.0f} ms, "
+          f"module import {report['total'] * 1000:.0f} ms")
+
+    if report['error']:
+        print(f"    import failed:\n{report['error']}")
+
+    for cumulative, self_time, name in report['imports']:
+        print(f"    {cumulative * 1000:8.1f} ms cumulative {self_time * 1000:8.1f} ms self  {name}")
+
+
+if __name__ == '__main__':
+    # Import time of the recorder modules: python import_time.py [module ...]
+    for name in sys.argv[1:] or DEFAULT_MODULES:
+        print_report(import_report(name))
@@ -0,0 +1,236 @@
+# Python Standard Library
+import os
+import json
+import shutil
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Local Library imports
+
+
+# Parameters
+CACHE_FOLDER = "InstrumentCache"
+EPOCH_DATE = date(1970, 1, 1)
+CATEGORICAL_COLUMNS = ['name', 'segment', 'exchange', 'instrument_type']
+INDEX_COLUMNS = ['name', 'segment', 'expiry']
+
+
+class InstrumentCache:
+    """
+    Parsed instrument master of one exchange and day, stored as one '.npy' file per column and loaded memory-mapped.
+
+    Columns are typed once, when the cache is built from the kite CSV dump:
+        - 'expiry' as days since 1970-01-01, -1 when empty, given back as datetime.date,
+        - numeric columns as int64 / float64,
+        - 'name', 'segment', 'exchange' and 'instrument_type' as category codes,
+        - other text columns as fixed width unicode.
+    Rows are sorted by (name, segment, expiry, strike) and 'meta.json' keeps the row range of every
+    (name, segment, expiry), so selecting a chain is a lookup and a slice of the mapped columns.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+        with open(os.path.join(folder, 'meta.json'), 'r') as json_file:
+            meta = json.load(json_file)
+
+        self.columns = meta['columns']
+        self.categories = meta['categories']
+        self.index = {tuple(key.split('|')): tuple(rows) for key, rows in meta['index'].items()}
+        self.size = meta['rows']
+
+        # Memory-mapped columns, nothing is read before a slice is used
+        self.arrays = {column: np.load(os.path.join(folder, f'{column}.npy'), mmap_mode='r')
+                       for column in self.columns}
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def build(csv_path: str, folder: str) -> 'InstrumentCache':
+        """ Parse a kite instruments CSV dump once and write its cache into 'folder' """
+
+        data_frame = pd.read_csv(csv_path)
+
+        # Typed columns
+        expiry = pd.to_datetime(data_frame['expiry'], errors='coerce') if 'expiry' in data_frame else None
+        if expiry is not None:
+            days = (expiry - pd.Timestamp(EPOCH_DATE)).dt.days
+            data_frame['expiry'] = days.fillna(-1).astype(np.int64)
+
+        for column in CATEGORICAL_COLUMNS:
+            if column in data_frame:
+                data_frame[column] = data_frame[column].astype('category')
+
+        # Sorted by chain, then strike
+        sort_columns = [column for column in INDEX_COLUMNS + ['strike'] if column in data_frame]
+        data_frame = data_frame.sort_values(sort_columns, kind='stable').reset_index(drop=True)
+
+        os.makedirs(folder, exist_ok=True)
+        categories = {}
+
+        for column in data_frame.columns:
+            series = data_frame[column]
+
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                categories[column] = [str(value) for value in series.cat.categories]
+                array = series.cat.codes.to_numpy(dtype=np.int32)
+            elif pd.api.types.is_numeric_dtype(series):
+                array = series.to_numpy()
+            else:
+                array = series.fillna('').astype(str).to_numpy(dtype=str)
+
+            np.save(os.path.join(folder, f'{column}.npy'), array)
+
+        # Row range of every (name, segment, expiry)
+        index = {}
+        if all(column in data_frame for column in INDEX_COLUMNS):
+            keys = data_frame[INDEX_COLUMNS].astype(str)
+            keys = (keys['name'] + '|' + keys['segment'] + '|' + keys['expiry']).to_numpy()
+
+            starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+            ends = np.append(starts[1:], len(keys))
+
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                name, segment, days = keys[start].split('|')
+                day = (EPOCH_DATE + timedelta(days=int(days))).isoformat() if int(days) >= 0 else ''
+                index[f"{name}|{segment}|{day}"] = [start, end]
+
+        meta = {'columns': list(data_frame.columns), 'categories': categories, 'index': index,
+                'rows': len(data_frame), 'source': csv_path, 'created': str(datetime.now())}
+
+        # meta.json last, a cache without it is incomplete and gets rebuilt
+        with open(os.path.join(folder, 'meta.json'), 'w') as json_file:
+            json.dump(meta, json_file)
+
+        return InstrumentCache(folder)
+
+    def __column(self, column: str, rows: slice):
+        array = self.arrays[column][rows]
+
+        if column in self.categories:
+            return pd.Categorical.from_codes(np.asarray(array), categories=self.categories[column])
+
+        if column == 'expiry':
+            # Days to python dates, the empty ones to None
+            days = np.asarray(array)
+            dates = days.astype('datetime64[D]')
+            dates[days < 0] = np.datetime64('NaT')
+            return dates.astype(object)
+
+        if array.dtype.kind == 'U':
+            # Empty text back to None, as read_csv gives NaN for empty cells
+            values = np.asarray(array).astype(object)
+            values[values == ''] = None
+            return values
+
+        return np.asarray(array)
+
+    def frame(self, columns: list = None, rows: slice = slice(None)) -> pd.DataFrame:
+        """ DataFrame of the given columns and rows, every column by default, 'expiry' as datetime.date """
+
+        columns = self.columns if columns is None else [column for column in columns if column in self.arrays]
+        return pd.DataFrame({column: self.__column(column, rows) for column in columns})
+
+    def expiries(self, name: str, segment: str) -> list:
+        """ Sorted expiry dates of a (name, segment) """
+
+        return sorted(date.fromisoformat(key[2]) for key in self.index if key[:2] == (name, segment) and key[2])
+
+    def chain(self, name: str, segment: str, expiry: date = None, columns: list = None) -> pd.DataFrame:
+        """Rows of a (name, segment), all the expiries or one, sorted by expiry then strike.
+
+        The rows of a (name, segment) are contiguous, so this is a slice of the mapped columns.
+        """
+
+        if expiry is not None:
+            start, end = self.index.get((name, segment, str(expiry)), (0, 0))
+        else:
+            ranges = [rows for key, rows in self.index.items() if key[:2] == (name, segment)]
+            start, end = (min(rows[0] for rows in ranges), max(rows[1] for rows in ranges)) if ranges else (0, 0)
+
+        return self.frame(columns, slice(start, end))
+
+
+def load_instruments(csv_path: str, exchange: str, day: date = None) -> InstrumentCache:
+    """Cache of a daily instruments CSV, built on the first call of the day and memory-mapped afterwards.
+
+    Args:
+        csv_path: kite instruments dump, 'InstrumentToken/{exchange}/{day}_{exchange}.csv'.
+        exchange: 'NSE' or 'NFO'.
+        day: day of the dump, today by default.
+
+    Returns:
+        The InstrumentCache, kept in 'InstrumentCache/{exchange}/{day}', the caches of earlier days are removed.
+    """
+
+    day = datetime.today().date() if day is None else day
+    exchange_folder = os.path.join(CACHE_FOLDER, exchange)
+    folder = os.path.join(exchange_folder, str(day))
+
+    if os.path.exists(os.path.join(folder, 'meta.json')):
+        return InstrumentCache(folder)
+
+    # Remove the caches of the earlier days
+    if os.path.isdir(exchange_folder):
+        for name in os.listdir(exchange_folder):
+            if name != str(day):
+                shutil.rmtree(os.path.join(exchange_folder, name), ignore_errors=True)
+
+    cache = InstrumentCache.build(csv_path, folder)
+    print(f"{csv_path}: instrument cache built, {len(cache)} rows")
+
+    return cache
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import tempfile
+
+    # Benchmark: CSV parsing against the cache on a synthetic NFO dump of 80,000 rows
+    rows = 80_000
+    names = np.array(['NIFTY', 'BANKNIFTY', 'FINNIFTY'] + [f'STOCK{index}' for index in range(180)])
+    folder = tempfile.mkdtemp() if len(sys.argv) < 2 else sys.argv[1]
+    csv_path = os.path.join(folder, 'NFO.csv')
+
+    pd.DataFrame({
+        'instrument_token': np.arange(10_000_000, 10_000_000 + rows),
+        'exchange_token': np.arange(rows),
+        'tradingsymbol': [f'SYMBOL{index}' for index in range(rows)],
+        'name': names[np.random.randint(0, len(names), rows)],
+        'last_price': 0.0,
+        'expiry': np.random.choice(['2023-12-21', '2023-12-28', '2024-01-25'], rows),
+        'strike': np.random.randint(100, 500, rows) * 100.0,
+        'tick_size': 0.05,
+        'lot_size': np.random.choice([15, 25, 40, 50], rows),
+        'instrument_type': np.random.choice(['CE', 'PE'], rows),
+        'segment': 'NFO-OPT',
+        'exchange': 'NFO',
+    }).to_csv(csv_path, index=False)
+
+    # Daily CSV path: parse, copy and filter the whole frame for a chain
+    begin = time.perf_counter()
+    data_frame = pd.read_csv(csv_path)
+    data_frame['expiry'] = pd.to_datetime(data_frame['expiry']).dt.date
+    chain = data_frame[(data_frame['name'] == 'BANKNIFTY') & (data_frame['segment'] == 'NFO-OPT')]
+    csv_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    InstrumentCache.build(csv_path, os.path.join(folder, 'cache'))
+    build_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    cache = InstrumentCache(os.path.join(folder, 'cache'))
+    load_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    cached_chain = cache.chain('BANKNIFTY', 'NFO-OPT')
+    chain_time = time.perf_counter() - begin
+
+    print(f"read_csv + filter {csv_time * 1000:.0f} ms, cache build {build_time * 1000:.0f} ms (once a day), "
+          f"cache load {load_time * 1000:.2f} ms, chain lookup {chain_time * 1000:.2f} ms")
+    print(f"same chain: {sorted(chain['instrument_token']) == sorted(cached_chain['instrument_token'])}, "
+          f"expiries: {cache.expiries('BANKNIFTY', 'NFO-OPT')}")
@@ -1,25 +1,71 @@
 # Standard Python library imports
+import os
 import json
 import time
 import datetime
+from functools import lru_cache
 
 # Pyotp
 from pyotp import TOTP
 
 # Kite Connect
 from kiteconnect import KiteConnect
+from kiteconnect.exceptions import TokenException
 
-# Selenium
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+# Selenium, imported by the browser login only
 
 # Local library imports
 # __none__
 
 
+class FileLock:
+    """ Exclusive lock on a file, shared by every process of the machine, e.g. the recorder processes """
+
+    def __init__(self, path: str, timeout: float = 600.0, poll: float = 0.2):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self.file = None
+
+    def __acquire(self) -> bool:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+
+        except OSError:
+            return False
+
+    def __enter__(self):
+        self.file = open(self.path, "a+")
+        deadline = time.monotonic() + self.timeout
+
+        # The holder may be in the browser login, which takes a while
+        while not self.__acquire():
+            if time.monotonic() > deadline:
+                self.file.close()
+                raise TimeoutError(f"Lock on {self.path} not acquired in {self.timeout}s")
+            time.sleep(self.poll)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if os.name == 'nt':
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+        self.file.close()
+
+
 class BaseClass:
     """ Base class for other operations """
 
@@ -181,6 +227,12 @@ class KiteUser(BaseClass):
         return results
 
     def __auto_login(self):
+        from selenium import webdriver
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.chrome.service import Service
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
         api_key = self.user_data['api_key']
         api_secret = self.user_data['api_secret']
         user_id = self.user_data['username']
@@ -246,71 +298,114 @@ class KiteUser(BaseClass):
 
         return access_token
 
+    def validate_access_token(self, access_token: str):
+        """Check an access token with a profile call, the cheapest authenticated request of the API.
+
+        Returns:
+            True when the token is accepted, False when it is rejected, None when the check itself failed,
+            e.g. no network.
+        """
+
+        if not access_token:
+            return False
+
+        kite = KiteConnect(api_key=self.user_data['api_key'])
+        kite.set_access_token(access_token)
+
+        try:
+            kite.profile()
+            return True
+
+        except TokenException:
+            return False
+
+        except Exception as e:
+            print(f"Access token not validated. Error: {e}")
+            return None
+
+    def __reload_user_data(self):
+        # Credentials as saved by the last process that logged in
+        with open(self.folder + self.file_name, "r") as data:
+            self.user_data_file = json.load(data)
+
+        self.user_data = self.user_data_file['user'][self.user_name]
+
     def __fetch_access_token(self):
 
-        last_update = self.user_data["last_update"]
+        # One process at a time: the others wait and then reuse the token it saved
+        with FileLock(self.folder + self.file_name + ".lock"):
+            self.__reload_user_data()
 
-        # Convert the string to a date object
-        date_object = datetime.datetime.strptime(last_update, "%Y-%m-%d").date()
+            valid = self.validate_access_token(self.user_data.get("access_token"))
 
-        if date_object < self.date:
-            access_token = None
-            try:
-                # Get the current time
-                current_time = time.localtime()
+            if valid is None:
+                # Profile call not possible, a token of today is taken as valid
+                last_update = datetime.datetime.strptime(self.user_data["last_update"], "%Y-%m-%d").date()
+                valid = last_update >= self.date
 
-                # Calculate the time remaining until the next minute
-                time_remaining = 60 - current_time.tm_sec
+            if not valid:
+                self.__login()
 
-                print(f"Waiting for {time_remaining} sec")
+    def __login(self):
 
-                # Wait for the new minute to start
-                time.sleep(time_remaining)
+        access_token = None
+        try:
+            # Get the current time
+            current_time = time.localtime()
 
-                access_token = self.__auto_login()
+            # Calculate the time remaining until the next minute
+            time_remaining = 60 - current_time.tm_sec
 
-            except Exception as e:
-                print(e)
-                print(f"Looks like we are facing an issue with 'auto_login' process\n")
+            print(f"Waiting for {time_remaining} sec")
 
-                choice = input("Do you want to rerun auto login? (yes/no): ").lower()
+            # Wait for the new minute to start
+            time.sleep(time_remaining)
 
-                if choice == "yes":
+            access_token = self.__auto_login()
 
-                    # Get the current time
-                    current_time = time.localtime()
-                    # Calculate the time remaining until the next minute
-                    time_remaining = 60 - current_time.tm_sec
-                    print(f"Waiting for {time_remaining} sec")
-                    # Wait for the new minute to start
-                    time.sleep(time_remaining)
+        except Exception as e:
+            print(e)
+            print(f"Looks like we are facing an issue with 'auto_login' process\n")
 
-                    access_token = self.__auto_login()
+            choice = input("Do you want to rerun auto login? (yes/no): ").lower()
 
-                else:
-                    access_token = self.__manual_login()
+            if choice == "yes":
 
-            finally:
+                # Get the current time
+                current_time = time.localtime()
+                # Calculate the time remaining until the next minute
+                time_remaining = 60 - current_time.tm_sec
+                print(f"Waiting for {time_remaining} sec")
+                # Wait for the new minute to start
+                time.sleep(time_remaining)
 
-                if access_token is not None:
+                access_token = self.__auto_login()
 
-                    new_date = self.date
-                    json_file = self.user_data_file
-                    new_access_token = access_token
+            else:
+                access_token = self.__manual_login()
 
-                    path = self.folder + self.file_name
+        finally:
 
-                    json_file['user'][self.user_name]["last_update"] = str(new_date)
-                    json_file['user'][self.user_name]["access_token"] = new_access_token
+            if access_token is not None:
 
-                    self.user_data_file = json_file
-                    self.user_data = json_file['user'][self.user_name]
+                new_date = self.date
+                json_file = self.user_data_file
+                new_access_token = access_token
+
+                path = self.folder + self.file_name
+
+                json_file['user'][self.user_name]["last_update"] = str(new_date)
+                json_file['user'][self.user_name]["access_token"] = new_access_token
 
-                    final_data = json_file
+                self.user_data_file = json_file
+                self.user_data = json_file['user'][self.user_name]
 
-                    # Write the updated data back to the file
-                    with open(path, 'w') as file:
-                        json.dump(final_data, file)
+                final_data = json_file
+
+                # Write the updated data back to the file, renamed in place so that readers never see half a file
+                with open(path + ".tmp", 'w') as file:
+                    json.dump(final_data, file)
+                os.replace(path + ".tmp", path)
 
     def __fetch_credentials(self):
 
@@ -325,19 +420,43 @@ class KiteUser(BaseClass):
         self.mysql_password = mysql_data['password']
 
 
+@lru_cache(maxsize=None)
+def kite_user(user_name: str) -> KiteUser:
+    """ KiteUser of the process, the credentials file is read and the login done on first use only """
+
+    return KiteUser(user_name)
+
+
 class LoginCredentials:
-    """ To create access token and other details """
+    """ To create access token and other details, resolved on first use and cached per process """
+
+    def __init__(self, user_name: str = "WV0236"):
+        self.user_name = user_name
+
+    @property
+    def user(self) -> KiteUser:
+        return kite_user(self.user_name)
+
+    # Access properties using self.user instead of user directly
+    @property
+    def api_key(self):
+        return self.user.api_key
+
+    @property
+    def api_secret(self):
+        return self.user.api_secret
 
-    def __init__(self):
-        self.user = KiteUser("WV0236")  # Define user as an instance attribute
+    @property
+    def access_token(self):
+        return self.user.access_token
 
-        # Access properties using self.user instead of user directly
-        self.api_key = self.user.api_key
-        self.api_secret = self.user.api_secret
-        self.access_token = self.user.access_token
+    @property
+    def mysql_username(self):
+        return self.user.mysql_username
 
-        self.mysql_username = self.user.mysql_username
-        self.mysql_password = self.user.mysql_password
+    @property
+    def mysql_password(self):
+        return self.user.mysql_password
 
 
 if __name__ == "__main__":
@@ -8,21 +8,60 @@ from kiteconnect import KiteTicker
 
 # local library import
 import tables
+import schema
+import token_diff
 from kite_login import LoginCredentials
 from sqllite_local import Sqlite3Server
+from tick_codec import TickFileWriter, TickLayout, pack_message
+from tick_queue import TickQueue
+from tick_spool import MessageSpool
 from database import SessionLocalTokens
+from atm_tracker import AtmTracker, load_chains
+from tick_shards import ShardedTicker, check_connections, shards_needed
 
 # Parameters
 log = LoginCredentials()
 
 
 class RabbitMQQueue:
-    def __init__(self, exchange_name, queue_name, host='localhost', username='guest', password='guest'):
+    def __init__(self, exchange_name, queue_name, host='localhost', username='guest', password='guest',
+                 confirm='none', batch_size=100, batch_ms=200, max_backoff=30):
+        """Publisher keeping a single long-lived channel.
+
+        Args:
+            confirm: 'none' publishes without broker confirmation,
+                'message' waits for a publisher confirm after every message,
+                'batch' confirms every 'batch_size' messages or 'batch_ms' milliseconds with one transaction
+                commit. The blocking pika connection only supports synchronous confirms, so batches are
+                confirmed through an AMQP transaction, one broker round trip per batch. The messages of the open
+                transaction are kept until the commit, a failed commit or a lost channel hands them back through
+                take_rolled_back(), and flush_due() commits a batch whose 'batch_ms' has passed on a quiet feed.
+            max_backoff: upper bound in seconds of the wait between two reconnection attempts.
+        """
+
         self.exchange_name = exchange_name
         self.queue_name = queue_name
         self.host = host
         self.credentials = pika.PlainCredentials(username, password)
         self.connection_params = pika.ConnectionParameters(host=self.host, credentials=self.credentials)
+
+        if confirm not in ('none', 'message', 'batch'):
+            raise ValueError("Invalid confirm. Valid options are 'none', 'message' or 'batch'.")
+
+        # Publisher parameters
+        self.confirm = confirm
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.max_backoff = max_backoff
+
+        self.channel = None
+        self.unconfirmed = 0
+        self.uncommitted = []  # messages of the open transaction, in publish order
+        self.rolled_back = []  # messages of a transaction the broker did not commit
+        self.batch_started = None
+        self.backoff = 0
+        self.next_attempt = 0
+
         self.connection = self.connect()
 
     def connect(self):
@@ -34,9 +73,33 @@ class RabbitMQQueue:
             print(f"Error connecting to RabbitMQ: {e}")
             return None
 
+    def get_channel(self):
+        """ Return the open channel, opening it (and the connection) when needed """
+
+        if self.channel is not None and self.channel.is_open:
+            return self.channel
+
+        if self.connection is None or self.connection.is_closed:
+            self.connection = self.connect()
+
+            if self.connection is None:
+                raise pika.exceptions.AMQPConnectionError(f"RabbitMQ is not reachable at {self.host}")
+
+        # A transaction left open on the previous channel was rolled back by the broker
+        self.__roll_back()
+        self.channel = self.connection.channel()
+
+        if self.confirm == 'message':
+            self.channel.confirm_delivery()
+
+        elif self.confirm == 'batch':
+            self.channel.tx_select()
+
+        return self.channel
+
     def declare_exchange(self):
         try:
-            channel = self.connection.channel()
+            channel = self.get_channel()
             channel.exchange_declare(exchange=self.exchange_name, exchange_type='direct')
             print(f"Exchange '{self.exchange_name}' declared successfully")
 
@@ -45,7 +108,7 @@ class RabbitMQQueue:
 
     def declare_queue(self):
         try:
-            channel = self.connection.channel()
+            channel = self.get_channel()
             channel.queue_declare(queue=self.queue_name)
             print(f"Queue '{self.queue_name}' declared successfully")
 
@@ -54,34 +117,128 @@ class RabbitMQQueue:
 
     def bind_queue_to_exchange(self):
         try:
-            channel = self.connection.channel()
+            channel = self.get_channel()
             channel.queue_bind(exchange=self.exchange_name, queue=self.queue_name, routing_key=self.queue_name)
             print(f"Queue '{self.queue_name}' bound to exchange '{self.exchange_name}'")
 
         except Exception as e:
             print(f"Error binding queue to exchange: {e}")
 
-    def publish_message(self, message):
+    def __reconnect(self):
+        """ Open a new connection and redeclare the topology, attempts are spaced by an exponential backoff """
+
+        if time.monotonic() < self.next_attempt:
+            raise pika.exceptions.AMQPConnectionError(
+                f"RabbitMQ unavailable, next attempt in {self.next_attempt - time.monotonic():.1f}s")
+
+        try:
+            self.channel = None
+            self.get_channel()
+            self.declare_exchange()
+            self.declare_queue()
+            self.bind_queue_to_exchange()
+
+            if self.backoff:
+                print(f"Reconnected to RabbitMQ for '{self.queue_name}'")
+
+            self.backoff = 0
+
+        except Exception:
+            self.channel = None
+            self.backoff = min(max(self.backoff * 2, 1), self.max_backoff)
+            self.next_attempt = time.monotonic() + self.backoff
+            print(f"Error reconnecting to RabbitMQ, retrying in {self.backoff}s")
+            raise
+
+    def publish_message(self, message) -> bool:
+        """Publish on the persistent channel, raises when the message could not be handed to the broker.
+
+        Returns:
+            True when the message and every message before it are final: always outside of the 'batch' confirm
+            mode, in the 'batch' mode only when this publish committed the transaction.
+        """
+
+        if self.channel is None or not self.channel.is_open:
+            if self.uncommitted:
+                # The open transaction was lost with the channel, its messages have to be sent again first
+                self.channel = None
+                self.__roll_back()
+                raise pika.exceptions.AMQPChannelError("Channel closed with an uncommitted batch")
+
+            self.__reconnect()
+
+        try:
+            self.channel.basic_publish(exchange=self.exchange_name, routing_key=self.queue_name, body=message)
+
+        except (pika.exceptions.AMQPError, OSError):
+            # Drop the channel, the next publish reconnects
+            self.channel = None
+            self.__roll_back()
+            raise
+
+        if self.confirm == 'batch':
+            if self.unconfirmed == 0:
+                self.batch_started = time.monotonic()
+
+            self.uncommitted.append(message)
+            self.unconfirmed += 1
+
+            if self.unconfirmed >= self.batch_size \
+                    or (time.monotonic() - self.batch_started) * 1000 >= self.batch_ms:
+                try:
+                    self.flush()
+
+                except (pika.exceptions.AMQPError, OSError):
+                    # The caller keeps the current message, the last one, only the earlier ones are handed back
+                    self.rolled_back.pop()
+                    raise
+
+                return True
 
-        channel = self.connection.channel()
-        channel.basic_publish(exchange=self.exchange_name, routing_key=self.queue_name, body=message)
+            return False
 
-        # try:
-        #     channel = self.connection.channel()
-        #     channel.basic_publish(exchange=self.exchange_name, routing_key=self.queue_name, body=message)
-        #
-        # except Exception as e:
-        #     print(f"Error publishing message: {e}")
+        return True
 
-        # try:
-        #     channel = self.connection.channel()
-        #     channel.basic_publish(exchange=self.exchange_name, routing_key=self.queue_name, body=message)
-        #     # print(f"Message sent to exchange '{self.exchange_name}' with routing key '{self.queue_name}': {message}")
-        # except pika.exceptions.AMQPError as e:
-        #     print(f"Error publishing message: {e}")
+    def __roll_back(self):
+        # Messages of the open transaction, lost with the channel, go back to the caller
+        self.rolled_back.extend(self.uncommitted)
+        self.uncommitted = []
+        self.unconfirmed = 0
+
+    def take_rolled_back(self) -> list:
+        """ Messages published in a transaction the broker did not commit, oldest first, to publish again """
+
+        rolled_back, self.rolled_back = self.rolled_back, []
+        return rolled_back
+
+    def flush(self):
+        """ Commit the open batch of the 'batch' confirm mode """
+
+        if self.confirm == 'batch' and self.unconfirmed and self.channel is not None:
+            try:
+                self.channel.tx_commit()
+
+            except (pika.exceptions.AMQPError, OSError):
+                self.channel = None
+                self.__roll_back()
+                raise
+
+            self.uncommitted = []
+            self.unconfirmed = 0
+
+    def flush_due(self):
+        """ Commit the open batch once 'batch_ms' has passed, called on a quiet feed when no publish comes """
+
+        if self.unconfirmed and (time.monotonic() - self.batch_started) * 1000 >= self.batch_ms:
+            self.flush()
 
     def close_connection(self):
         if self.connection and not self.connection.is_closed:
+            try:
+                self.flush()
+            except pika.exceptions.AMQPError as e:
+                print(f"Error confirming the last batch: {e}")
+
             self.connection.close()
             print("Connection to RabbitMQ closed")
 
@@ -110,6 +267,36 @@ class TickData:
         self.nfo_txt_file = f'E:/Market Analysis/Programs/Deployed/utility/Ticks_txt/NFO/{self.today}.txt'
         self.index_txt_file = f'E:/Market Analysis/Programs/Deployed/utility/Ticks_txt/INDEX/{self.today}.txt'
 
+        # Sink queues between the websocket callbacks and the disk / broker writers
+        self.queue_size = 50_000  # tick batches kept in memory per sink
+        self.overflow = 'spill'  # 'block', 'drop_oldest' or 'spill'
+        self.spill_folder = 'E:/Market Analysis/Programs/Deployed/utility/Ticks_spill'
+
+        # Batches not delivered to rabbit_mq are kept here till the broker is back
+        self.spool_folder = 'E:/Market Analysis/Programs/Deployed/utility/Ticks_spool'
+
+        # Websocket connections per exchange, raised when the tokens exceed the cap of a connection
+        self.shards = 1
+        self.shard_processes = False  # one process per connection, spreads the tick parsing over cores
+        self.shard_report_s = 60  # seconds between two reports of the message rates
+        self.recorded_exchanges = ('NSE', 'NFO', 'INDEX')  # recorded at once with the api_key, by record_ticks
+
+        # NFO option strikes follow the ATM of the index ticks, changes are kept in this folder
+        self.recenter_options = True
+        self.recenter_threshold = 2  # ATM move in strikes
+        self.subscription_folder = 'E:/Market Analysis/Programs/Deployed/utility/Subscriptions'
+
+        # rabbit_mq publisher confirms: 'none', 'message' or 'batch'
+        self.broker_confirm = 'none'
+
+        # rabbit_mq message format: 'json' for json of str(ticks), 'bin' for tick_codec.pack_message
+        self.broker_format = 'json'
+
+        # Binary capture files, format described in tick_codec
+        self.nse_bin_file = f'E:/Market Analysis/Programs/Deployed/utility/Ticks_bin/NSE/{self.today}.bin'
+        self.nfo_bin_file = f'E:/Market Analysis/Programs/Deployed/utility/Ticks_bin/NFO/{self.today}.bin'
+        self.index_bin_file = f'E:/Market Analysis/Programs/Deployed/utility/Ticks_bin/INDEX/{self.today}.bin'
+
     # Custom JSON encoder to handle datetime objects
     class DateTimeEncoder(json.JSONEncoder):
         def default(self, obj):
@@ -184,8 +371,7 @@ class TickData:
         # Return the list of token numbers.
         return tokens_
 
-    @staticmethod
-    def tcp_connection(_tokens: list, function: object, end: str, exchange: str):
+    def tcp_connection(self, _tokens: list, function: object, end: str, exchange: str):
 
         # Create a KiteTicker object with the api_key and access_token.
         kws = KiteTicker(log.api_key, log.access_token)
@@ -193,10 +379,15 @@ class TickData:
         # Convert the end date time string to a datetime object.
         end_time = datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
 
+        # The function passed in to the tcp_connection() method runs on a sink worker thread.
+        sink_queue = TickQueue(lambda ticks, received: function(ticks), f'{exchange}_sqlite',
+                               maxsize=self.queue_size, overflow=self.overflow,
+                               spill_path=f'{self.spill_folder}/{exchange}_sqlite_{self.today}.spill')
+
         # Define a callback function to be called when the websocket receives a tick message.
         def on_ticks(ws, ticks):
-            # Call the function passed in to the tcp_connection() method with the tick data.
-            function(ticks)
+            # Hand over the tick data to the sink worker.
+            sink_queue.put(ticks)
 
         # Define a callback function to be called when the websocket connects to the Kite Connect server.
         def on_connect(ws, response):
@@ -223,6 +414,10 @@ class TickData:
             # close the websocket connection and break out of the loop.
             if current_time >= end_time.time():
                 kws.close()
+
+                # Write the ticks still queued
+                sink_queue.close()
+
                 break
 
             # Otherwise, sleep for the difference between the current time and the end time.
@@ -233,79 +428,165 @@ class TickData:
         # Print a message to indicate that the program has stopped.
         print(f"{exchange}: recording stopped at {current_time}")
 
-    def tcp_connection_beta(self, _tokens: list, file_path: str, end: str, exchange: str):
+    def tcp_connection_beta(self, _tokens: list, file_path: str, end: str, exchange: str, column_dict: dict = None,
+                            tracker: AtmTracker = None):
+        """Record ticks to a capture file and publish them to rabbit_mq.
 
-        # Create a KiteTicker object with the api_key and access_token.
-        kws = KiteTicker(log.api_key, log.access_token)
+        Args:
+            _tokens: instrument tokens to subscribe.
+            file_path: capture file path.
+            end: end date time string, '%Y-%m-%d %H:%M:%S'.
+            exchange: 'NSE', 'NFO' or 'INDEX'.
+            column_dict: when given, ticks are written in the binary format of tick_codec using these columns,
+                otherwise each batch is written as a json line of str(ticks).
+            tracker: when given, its index tokens are watched in LTP mode with the other tokens, and the option
+                strikes are subscribed and unsubscribed as the ATM moves. The added strikes are written to
+                NfoTokenTable and get their candle and day tables first. Index ticks are not recorded.
+
+        The tokens are spread over self.shards connections, more when an exchange has more tokens than a
+        connection takes, in one process each with self.shard_processes. All of them feed the same sinks.
+        """
 
         # Convert the end date time string to a datetime object.
         end_time = datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
 
-        message_broker = True
+        # Implementation of rabbit_mq, a broker down at startup is retried with backoff by the publisher
+        exchange_queue = RabbitMQQueue(exchange, f'{exchange}_queue', confirm=self.broker_confirm)
 
-        try:
-            # Implementation of rabbit_mq
-            exchange_queue = RabbitMQQueue(exchange, f'{exchange}_queue')
-
-            # Declare exchanges and queues
-            exchange_queue.declare_exchange()
-            exchange_queue.declare_queue()
-            exchange_queue.bind_queue_to_exchange()
-
-        except Exception as e:
-            message_broker = False
-            print(f"Error while connecting to rabbit_mq: {e}")
-
-        # Open a text file for writing tick data
-        with open(file_path, "a") as file:
-
-            # Define a callback function to be called when the websocket receives a tick message.
-            def on_ticks(ws, ticks):
+        # Declare exchanges and queues
+        exchange_queue.declare_exchange()
+        exchange_queue.declare_queue()
+        exchange_queue.bind_queue_to_exchange()
 
-                formatted_time = datetime.now().time().strftime("%H:%M:%S.%f")[:-3]
-                final_data = {formatted_time: str(ticks)}
+        # Binary broker messages use the columns of the exchange, decoded by consumer.decode_message
+        broker_layout = None
+        if self.broker_format == 'bin':
+            broker_layout = TickLayout.from_column_dict(self.__get_column(exchange))
 
-                # Method 01
-                # Serialize the data to JSON and write to the file
-                json.dump(final_data, file)
+        # Local spool of the batches the broker did not take, replayed first when it is back
+        spool = MessageSpool(f'{self.spool_folder}/{exchange}')
 
-                # Write a newline character to separate each JSON object
-                file.write('\n')
+        # Open the capture file for writing tick data
+        if column_dict is not None:
+            capture = TickFileWriter(file_path, column_dict)
+        else:
+            capture = open(file_path, "a")
 
-                # Insert message to rabbit_mq
-                if message_broker:
-                    try:
-                        exchange_queue.publish_message(json.dumps(final_data))
-
-                    except Exception as e:
-                        print(f"Error while connecting to rabbit_mq gg: {e}")
-
-                        print("Retrying to connect")
+        with capture as file:
 
-                        # Implementation of rabbit_mq
-                        exchange_queue_retry = RabbitMQQueue(exchange, f'{exchange}_queue')
+            # Sink run on the file worker thread
+            def write_ticks(ticks, received):
 
-                        # Declare exchanges and queues
-                        exchange_queue_retry.declare_exchange()
-                        exchange_queue_retry.declare_queue()
-                        exchange_queue_retry.bind_queue_to_exchange()
+                if column_dict is not None:
+                    # Method 02
+                    # Write the batch as a single binary record
+                    file.write_ticks(ticks, received)
 
-                        exchange_queue_retry.publish_message(json.dumps(final_data))
+                else:
+                    # Method 01
+                    # Serialize the data to JSON and write to the file
+                    formatted_time = received.time().strftime("%H:%M:%S.%f")[:-3]
+                    json.dump({formatted_time: str(ticks)}, file)
 
-            # Define a callback function to be called when the websocket connects to the Kite Connect server.
-            def on_connect(ws, response):
-                # Subscribe to the list of instruments passed in to the tcp_connection() method.
-                ws.subscribe(_tokens)
+                    # Write a newline character to separate each JSON object
+                    file.write('\n')
 
-                # Set the mode for the list of instruments to `full`.
-                ws.set_mode(ws.MODE_FULL, _tokens)
+            # Sink run on the rabbit_mq worker thread
+            def publish_ticks(ticks, received):
 
-            # Assign the callbacks to the corresponding methods on the KiteTicker class.
-            kws.on_ticks = on_ticks
-            kws.on_connect = on_connect
+                if broker_layout is not None:
+                    message = pack_message(broker_layout, ticks, received)
 
-            # Start the websocket connection and subscribe to the list of instruments.
-            kws.connect(threaded=True)
+                else:
+                    formatted_time = received.time().strftime("%H:%M:%S.%f")[:-3]
+                    message = json.dumps({formatted_time: str(ticks)})
+
+                # Insert message to rabbit_mq, on the persistent channel of the publisher.
+                # While the broker is unreachable the batches are spooled, then replayed in order.
+                # In the 'batch' confirm mode, the messages of a transaction lost before its commit are spooled again.
+                spool.send(message, exchange_queue.publish_message, errors=(pika.exceptions.AMQPError, OSError),
+                           commit=exchange_queue.flush, rolled_back=exchange_queue.take_rolled_back)
+
+            # Run on the rabbit_mq worker thread when no batch came, commits the open batch at its deadline
+            def commit_ticks():
+                try:
+                    exchange_queue.flush_due()
+
+                except (pika.exceptions.AMQPError, OSError) as e:
+                    print(f"{exchange}: batch commit failed, spooling it: {e}")
+
+                    for message in exchange_queue.take_rolled_back():
+                        spool.append(message)
+
+            # One queue per sink, a slow disk or broker only delays its own worker
+            sink_queues = [
+                TickQueue(write_ticks, f'{exchange}_file', maxsize=self.queue_size, overflow=self.overflow,
+                          spill_path=f'{self.spill_folder}/{exchange}_file_{self.today}.spill'),
+                TickQueue(publish_ticks, f'{exchange}_broker', maxsize=self.queue_size, overflow=self.overflow,
+                          spill_path=f'{self.spill_folder}/{exchange}_broker_{self.today}.spill',
+                          idle=commit_ticks, idle_ms=exchange_queue.batch_ms)
+            ]
+
+            # Rows of the tokens database and candle / day tables of the strikes added by the tracker
+            def register_contracts(changes):
+                models_list = [model for change in changes for model in tracker.contracts(change)]
+                tokens = [model.instrument_token for model in models_list]
+
+                try:
+                    token_diff.add_tokens(models_list)
+                    schema.ensure_tables('NFO', tokens)
+
+                except Exception as e:
+                    print(f"{exchange}: error registering {len(tokens)} new strikes, subscribed anyway: {e}")
+
+            # Incremental subscription changes of the tracker, run on the subscription worker thread, so the
+            # database writes of the new strikes never hold the websocket thread
+            def resubscribe(changes, received):
+                added = [token for change in changes for token in change['added']]
+                removed = [token for change in changes for token in change['removed']]
+
+                if added:
+                    # The new strikes are known to the consumer before their first tick
+                    register_contracts(changes)
+                    kws.subscribe(added, 'full')
+
+                if removed:
+                    kws.unsubscribe(removed)
+
+                tracker.record(changes)
+
+                for change in changes:
+                    print(f"{exchange}: {change['name']} ATM {change['previous_atm']} -> {change['atm']}, "
+                          f"{len(change['added'])} tokens subscribed, {len(change['removed'])} unsubscribed")
+
+            subscription_queue = TickQueue(resubscribe, f'{exchange}_subscriptions', maxsize=1_000) \
+                if tracker is not None else None
+
+            # Define a callback function to be called with the tick messages of every connection.
+            def on_ticks(ticks, received):
+
+                # Only enqueue here, the sinks run on their worker threads
+                if tracker is not None:
+                    # Index ticks only move the option windows
+                    ticks, changes = tracker.process(ticks)
+
+                    if changes:
+                        subscription_queue.put(changes)
+
+                    if not ticks:
+                        return
+
+                for sink_queue in sink_queues:
+                    sink_queue.put(ticks, received)
+
+            # Connections over the tokens split by a stable hash, each one subscribes its tokens in `full` mode
+            # and the watched indices in `ltp` mode on connect, and again with the current tokens on reconnect
+            kws = ShardedTicker(log.api_key, log.access_token, _tokens, on_ticks, shards=self.shards,
+                                processes=self.shard_processes,
+                                watch_tokens=tracker.watch_tokens() if tracker is not None else (), name=exchange)
+
+            # Start the websocket connections and subscribe to the list of instruments.
+            kws.connect()
             print(f'{exchange}: recording started')
 
             # Infinite loop on the main thread. Nothing after this will run.
@@ -317,25 +598,44 @@ class TickData:
                 # close the websocket connection and break out of the loop.
                 if current_time >= end_time.time():
 
-                    # Close connections
-                    exchange_queue.close_connection()
+                    # Apply the subscription changes still queued, then close kite connection
+                    if subscription_queue is not None:
+                        subscription_queue.close()
 
-                    # Close kite connection
                     kws.close()
 
+                    # Write the ticks still queued
+                    for sink_queue in sink_queues:
+                        sink_queue.close()
+
+                    # Last catch-up attempt, anything left stays in the spool for the next run
+                    try:
+                        exchange_queue.flush()
+                        spool.replay(exchange_queue.publish_message, commit=exchange_queue.flush,
+                                     rolled_back=exchange_queue.take_rolled_back)
+                    except (pika.exceptions.AMQPError, OSError) as e:
+                        print(f"{exchange}: broker unavailable at the close, spool kept: {e}")
+
+                        # Only a failed flush leaves messages to spool, the replayed ones are still in the spool
+                        for message in exchange_queue.take_rolled_back():
+                            spool.append(message)
+                    spool.close()
+
+                    # Close connections
+                    exchange_queue.close_connection()
+
                     break
 
-                # Otherwise, sleep for the difference between the current time and the end time.
+                # Otherwise, sleep till the end time, reporting the message rate of every connection meanwhile.
                 else:
                     time_diff = (end_time - datetime.today()).seconds
-                    time.sleep(time_diff + 1)
+                    time.sleep(min(time_diff + 1, self.shard_report_s))
+                    kws.report()
 
             # Print a message to indicate that the program has stopped.
             print(f"{exchange}: recording stopped at {current_time}")
 
-
-
-    def record(self, exchange: str):
+    def record(self, exchange: str, batch_ms: int = 0, layout: str = 'token'):
 
         # Initialise some parameters
         selection = exchange.upper()
@@ -364,8 +664,9 @@ class TickData:
 
         os.makedirs(folder, exist_ok=True)
 
-        # Initiate the SQL server.
-        server = Sqlite3Server(path, column_dict)
+        # Initiate the SQL server, writing every callback in a single transaction.
+        server = Sqlite3Server(path, column_dict, batched=True, batch_ms=batch_ms,
+                               journal_mode='WAL', synchronous='NORMAL', layout=layout)
 
         # Create the tables in the SQLite database.
         server.create_tables(tokens_)
@@ -373,21 +674,67 @@ class TickData:
         # Establish a TCP connection with the API.
         self.tcp_connection(tokens_, server.insert_ticks, end_time_str, exchange)
 
-    def record_beta(self, exchange: str):
+        # Write the ticks still buffered at the close.
+        server.close()
+
+    def planned_connections(self, watch_tokens: int = 3) -> dict:
+        """ Websocket connections of every recorded exchange, {exchange: connections}, all on the same api_key """
+
+        tokens = {'NSE': self.nse_tokens, 'NFO': self.nfo_tokens, 'INDEX': self.index_tokens}
+        planned = {}
+
+        for exchange in self.recorded_exchanges:
+            # The NFO recorder also watches the index tokens of the AtmTracker
+            extra = [None] * watch_tokens if exchange == 'NFO' and self.recenter_options else []
+            planned[exchange] = shards_needed(list(tokens[exchange]) + extra, self.shards)
+
+        return planned
+
+    def record_beta(self, exchange: str, file_format: str = 'txt'):
+        """Record the ticks of an exchange till the market close.
+
+        Args:
+            exchange: 'NSE', 'NFO' or 'INDEX'.
+            file_format: 'txt' for json lines of str(ticks), 'bin' for the binary format of tick_codec, opt-in: it
+                keeps only the column_dict fields of the exchange.
+        """
 
         end_time_str = f"{self.today} 15:31:00"
 
+        # Kite refuses the connections over its limit per api_key, stop here rather than during the day
+        check_connections(self.planned_connections())
+
         file_mapping = {
             "NSE": (self.nse_txt_file, self.nse_tokens),
             "NFO": (self.nfo_txt_file, self.nfo_tokens),
             "INDEX": (self.index_txt_file, self.index_tokens)
         }
 
+        binary_mapping = {
+            "NSE": (self.nse_bin_file, self.nse_column),
+            "NFO": (self.nfo_bin_file, self.nfo_column),
+            "INDEX": (self.index_bin_file, self.index_column)
+        }
+
         file_name = file_mapping.get(exchange)[0]
         tokens_ = file_mapping.get(exchange)[1]
+        column_dict = None
+
+        if file_format == 'bin':
+            file_name, column_dict = binary_mapping.get(exchange)
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+        # Option strikes of NFO re-centred on the ATM during the day
+        tracker = None
+        if exchange == 'NFO' and self.recenter_options:
+            try:
+                tracker = AtmTracker(load_chains(), tokens_, threshold=self.recenter_threshold,
+                                     log_path=f'{self.subscription_folder}/{exchange}/{self.today}.jsonl')
+            except (FileNotFoundError, KeyError) as e:
+                print(f"{exchange}: option windows kept fixed, instrument chains not loaded. Error: {e}")
 
         # Establish a TCP connection with the API.
-        self.tcp_connection_beta(tokens_, file_name, end_time_str, exchange)
+        self.tcp_connection_beta(tokens_, file_name, end_time_str, exchange, column_dict, tracker)
 
 
 if __name__ == '__main__':
@@ -7,23 +7,20 @@ from dataclasses import asdict
 import sqlalchemy
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.inspection import inspect
-from sqlalchemy import Column, Integer, String, Date, DateTime, Float, MetaData, JSON
 from sqlalchemy.orm.exc import NoResultFound
 
 # Local Library imports
 import models
+import schema
 import tables
+import token_diff
 from utility import Utility
-from kite_websocket import TickData
-from active_symbols import NseActiveSymbols, NfoActiveSymbols, IndexActiveSymbols
-from database import Base, SessionLocalTokens, engine_day_data_index, engine_candle_data_index
-from database import engine_candle_data_nse, engine_candle_data_nfo, engine_day_data_nse, engine_day_data_nfo
+from active_symbols import InstrumentUniverse, NseActiveSymbols, NfoActiveSymbols, IndexActiveSymbols
+from database import SessionLocalTokens, get_engine, candle_engine, day_engine
 
 # Parameters
 ut = Utility()
-tick = TickData()
 today = datetime.datetime.today().date()
-token_db = SessionLocalTokens()
 
 
 def add_token(model: models.NfoTokenModel | models.NseTokenModel | models.IndexTokenModel):
@@ -33,7 +30,7 @@ def add_token(model: models.NfoTokenModel | models.NseTokenModel | models.IndexT
     _token = None
 
     # Connect to the database
-    db = token_db
+    db = SessionLocalTokens()
 
     # Convert the model to a dictionary and delete the "exchange" key
     my_dict = asdict(model)
@@ -142,6 +139,7 @@ def get_tokens(exchange: str) -> list:
         token_table = tables.IndexTokenTable
 
     # Query the database for token numbers.
+    token_db = SessionLocalTokens()
     tokens_data = token_db.query(token_table).filter(token_table.last_update == today)
 
     # Convert the query results to a list of token numbers.
@@ -154,209 +152,45 @@ def get_tokens(exchange: str) -> list:
     return result
 
 
-def create_table_in_candle_data_db(exchange: str):
-
-    """ Because this directory is under progress the table schema for NSE and NFO are kept differently,
-        In future iteration this issue will be resolved."""
+def create_table_in_candle_data_db(exchange: str, tokens: list = None):
+    """ Create the missing per-token tables of the candle database, tokens updated today by default """
 
     # Parameters
-    _engine_ = None
-    _tokens_ = None  # [256265, 257801, 260105]
-    _token_names = None  # ['token_256265', 'token_257801', 'token_260105']
     exchange = exchange.upper()  # 'NSE', 'NFO', 'INDEX'
 
-    if exchange == 'NSE':
-        _tokens_ = get_tokens('NSE')
-        _engine_ = engine_candle_data_nse
-        _token_names = [f"token_{token}" for token in _tokens_]
+    _tokens_ = get_tokens(exchange) if tokens is None else tokens
 
-    elif exchange == 'NFO':
-        _tokens_ = get_tokens('NFO')
-        _engine_ = engine_candle_data_nfo
-        _token_names = [f"token_{token}" for token in _tokens_]
-
-    elif exchange == 'INDEX':
-        _tokens_ = get_tokens('INDEX')
-        _engine_ = engine_candle_data_index
-        _token_names = [f"token_{token}" for token in _tokens_]
-
-    # Get a list of all the table names
-    with _engine_.connect() as conn:
-        inspector = inspect(_engine_)
-        table_names = inspector.get_table_names()
-
-    # Create a list of tables for the tokens
-    tables_list = []
-    for token in _token_names:
-        if token not in table_names:
-            if exchange == 'NSE':
-                # Define the table for the NSE token
-                class NseInstrumentTable(Base):
-                    __tablename__ = f"{token}"
-
-                    time_stamp = Column(DateTime, primary_key=True)
-                    open = Column(Float)
-                    high = Column(Float)
-                    low = Column(Float)
-                    close = Column(Float)
-                    volume = Column(Integer)
-                    liquidity_profile = Column(JSON)
-                    volume_profile = Column(JSON)
-                    order_profile = Column(JSON)
-                    candle_data = Column(JSON)
-
-                # Create the table in the database
-                tables_list.append(NseInstrumentTable.__table__)
-
-            elif exchange == 'NFO':
-                # Define the table for the NFO token
-                class NfoInstrumentTable(Base):
-                    __tablename__ = f"{token}"
-
-                    time_stamp = Column(DateTime, primary_key=True)
-                    open = Column(Float)
-                    high = Column(Float)
-                    low = Column(Float)
-                    close = Column(Float)
-                    volume = Column(Integer)
-                    liquidity_profile = Column(JSON)
-                    volume_profile = Column(JSON)
-                    order_profile = Column(JSON)
-                    candle_data = Column(JSON)
-
-                # Create the table in the database
-                tables_list.append(NfoInstrumentTable.__table__)
-
-            elif exchange == 'INDEX':
-                # Define the table for the NFO token
-                class IndexInstrumentTable(Base):
-                    __tablename__ = f"{token}"
-
-                    time_stamp = Column(DateTime, primary_key=True)
-                    open = Column(Float)
-                    high = Column(Float)
-                    low = Column(Float)
-                    close = Column(Float)
-                    candle_data = Column(JSON)
-                    cash_profile = Column(JSON)
-                    future_profile = Column(JSON)
-                    option_profile = Column(JSON)
-                    option_strike_data = Column(JSON)
-
-                # Create the table in the database
-                tables_list.append(IndexInstrumentTable.__table__)
-
-    # Create all the tables in the database
-    Base.metadata.create_all(_engine_, tables=tables_list)
+    # Create all the missing tables in one DDL pass
+    created = schema.create_token_tables(candle_engine(exchange), exchange, _tokens_)
 
     # Print a message for each table that was created
-    for table in tables_list:
-        print(f'Table for token {table.name} created')
+    for table_name in created:
+        print(f'Table for token {table_name} created')
 
 
-def create_table_in_day_data_db(exchange: str):
+def create_table_in_day_data_db(exchange: str, tokens: list = None):
+    """ Create the missing per-token tables of the day database, tokens updated today by default """
+
     # Parameters
-    _engine_ = None
-    _tokens_ = None  # [256265, 257801, 260105]
-    _token_names = None  # ['token_256265', 'token_257801', 'token_260105']
     exchange = exchange.upper()  # 'NSE', 'NFO', 'INDEX'
 
-    if exchange == 'NSE':
-        _tokens_ = get_tokens('NSE')
-        _engine_ = engine_day_data_nse
-        _token_names = [f"token_{token}" for token in _tokens_]
-
-    elif exchange == 'NFO':
-        _tokens_ = get_tokens('NFO')
-        _engine_ = engine_day_data_nfo
-        _token_names = [f"token_{token}" for token in _tokens_]
+    _tokens_ = get_tokens(exchange) if tokens is None else tokens
 
-    elif exchange == 'INDEX':
-        _tokens_ = get_tokens('INDEX')
-        _engine_ = engine_day_data_index
-        _token_names = [f"token_{token}" for token in _tokens_]
-
-    # Get a list of all the table names
-    with _engine_.connect() as conn:
-        inspector = inspect(_engine_)
-        table_names = inspector.get_table_names()
-
-    # Create a list of tables for the tokens
-    tables_list = []
-    for token in _token_names:
-        if token not in table_names:
-            if exchange == 'NSE':
-                # Define the table for the NSE token
-                class NseInstrumentTable(Base):
-                    __tablename__ = f"{token}"
-                    __table_args__ = {'extend_existing': True}
-
-                    time_stamp = Column(DateTime, primary_key=True)
-                    open = Column(Float)
-                    high = Column(Float)
-                    low = Column(Float)
-                    close = Column(Float)
-                    volume = Column(Integer)
-                    liquidity_profile = Column(JSON)
-                    volume_profile = Column(JSON)
-                    order_profile = Column(JSON)
-                    candle_data = Column(JSON)
-
-                # Create the table in the database
-                tables_list.append(NseInstrumentTable.__table__)
-
-            elif exchange == 'NFO':
-                # Define the table for the NFO token
-                class NfoInstrumentTable(Base):
-                    __tablename__ = f"{token}"
-                    __table_args__ = {'extend_existing': True}
-
-                    time_stamp = Column(DateTime, primary_key=True)
-                    open = Column(Float)
-                    high = Column(Float)
-                    low = Column(Float)
-                    close = Column(Float)
-                    volume = Column(Integer)
-                    liquidity_profile = Column(JSON)
-                    volume_profile = Column(JSON)
-                    order_profile = Column(JSON)
-                    candle_data = Column(JSON)
-
-                # Create the table in the database
-                tables_list.append(NfoInstrumentTable.__table__)
-
-            elif exchange == 'INDEX':
-                # Define the table for the NFO token
-                class IndexInstrumentTable(Base):
-                    __tablename__ = f"{token}"
-                    __table_args__ = {'extend_existing': True}
-
-                    time_stamp = Column(DateTime, primary_key=True)
-                    open = Column(Float)
-                    high = Column(Float)
-                    low = Column(Float)
-                    close = Column(Float)
-                    candle_data = Column(JSON)
-                    cash_profile = Column(JSON)
-                    future_profile = Column(JSON)
-                    option_profile = Column(JSON)
-                    option_strike_data = Column(JSON)
-
-                # Create the table in the database
-                tables_list.append(IndexInstrumentTable.__table__)
-
-    # Create all the tables in the database
-    Base.metadata.create_all(_engine_, tables=tables_list)
+    # Create all the missing tables in one DDL pass
+    created = schema.create_token_tables(day_engine(exchange), exchange, _tokens_)
 
     # Print a message for each table that was created
-    for table in tables_list:
-        print(f'Table for token {table.name} created')
+    for table_name in created:
+        print(f'Table for token {table_name} created')
 
 
 def preprocessing():
 
     print("Tokens data preprocessing started")
 
+    # Token tables of the tokens database, created once per process
+    tables.create_tables()
+
     # Get the current time.
     time_live = datetime.datetime.now().time().replace(microsecond=0)
 
@@ -368,29 +202,57 @@ def preprocessing():
         print(f"Waiting {time_diff} seconds.")
         time.sleep(time_diff + 1)
 
-    nse_tokens = NseActiveSymbols()
-    nfo_tokens = NfoActiveSymbols()
-    index_tokens = IndexActiveSymbols()
+    # Instrument masters are loaded once, the selectors are views over them
+    universe = InstrumentUniverse()
+
+    nse_tokens = NseActiveSymbols(universe)
+    nfo_tokens = NfoActiveSymbols(universe)
+    index_tokens = IndexActiveSymbols(universe)
 
     # Merge all tokens into a single list
     tokens_combined = nse_tokens.to_tokens() + nfo_tokens.to_tokens() + index_tokens.to_tokens()
 
-    # add the tokens to the database
-    for token_item in tokens_combined:
-        add_token(token_item)
+    # Compare with the universe stored on the previous day and keep the diff for auditing
+    diffs = token_diff.diff_universe(tokens_combined)
+    print(f"Token diff recorded in {token_diff.record_diff(diffs)}")
 
-    # Create missing tables of candles database
-    create_table_in_candle_data_db(exchange='NSE')
-    create_table_in_candle_data_db(exchange='NFO')
-    create_table_in_candle_data_db(exchange='INDEX')
+    for exchange, diff in diffs.items():
+        print(f"{exchange}: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+              f"{len(diff['removed'])} removed, {len(diff['unchanged'])} unchanged")
 
-    # Create missing tables of day database
-    create_table_in_day_data_db(exchange='NSE')
-    create_table_in_day_data_db(exchange='NFO')
-    create_table_in_day_data_db(exchange='INDEX')
+        # Only the added and changed tokens are written, the unchanged ones just get today's last_update
+        token_diff.add_tokens(diff['added'] + diff['changed'])
+        token_diff.touch_tokens(exchange, diff['unchanged'])
+
+        # Create missing tables of the candles and day databases for the new tokens only
+        new_tokens = token_diff.new_instrument_tokens(exchange, diff)
+        create_table_in_candle_data_db(exchange=exchange, tokens=new_tokens)
+        create_table_in_day_data_db(exchange=exchange, tokens=new_tokens)
 
 
 if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] == ['benchmark']:
+        # Timing of the per-row add_token loop against the bulk add_tokens, on today's tokens
+        tables.create_tables()
+        universe = InstrumentUniverse()
+        tokens_combined = NseActiveSymbols(universe).to_tokens() + NfoActiveSymbols(universe).to_tokens() + \
+            IndexActiveSymbols(universe).to_tokens()
+
+        begin = time.perf_counter()
+        for token_item in tokens_combined:
+            add_token(token_item)
+        loop_time = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        counts = token_diff.add_tokens(tokens_combined)
+        bulk_time = time.perf_counter() - begin
+
+        print(f"{len(tokens_combined)} tokens: add_token loop {loop_time:.3f}s, add_tokens {bulk_time:.3f}s, "
+              f"{loop_time / bulk_time:.1f}x faster. {counts}")
+        sys.exit()
+
     # Use this to create missing tables daily
     preprocessing()
 
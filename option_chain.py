@@ -0,0 +1,393 @@
+# Python Standard Library
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Local Library imports
+import tables
+from consumer import TickHandler
+from database import SessionLocalTokens, candle_engine
+from candle_aggregator import upsert_rows
+
+# Parameters
+EPOCH = datetime(1970, 1, 1)
+today = datetime.today().date()
+
+# Underlying name of the NFO contracts -> tradingsymbol of the index
+INDEX_SYMBOLS = {'NIFTY': 'NIFTY 50', 'BANKNIFTY': 'NIFTY BANK', 'FINNIFTY': 'NIFTY FIN SERVICE'}
+
+
+def load_contracts(names: list = tuple(INDEX_SYMBOLS)) -> tuple:
+    """Read the index derivatives and the index tokens from the tokens database.
+
+    Args:
+        names: underlying names of the NFO contracts.
+
+    Returns:
+        (contracts, index_tokens): the NfoTokenTable rows not expired yet, and {name: index instrument_token}.
+    """
+
+    db = SessionLocalTokens()
+
+    try:
+        contracts = db.query(tables.NfoTokenTable) \
+            .filter(tables.NfoTokenTable.name.in_(names), tables.NfoTokenTable.expiry >= today).all()
+
+        symbols = {symbol: name for name, symbol in INDEX_SYMBOLS.items() if name in names}
+        indices = db.query(tables.IndexTokenTable) \
+            .filter(tables.IndexTokenTable.tradingsymbol.in_(list(symbols))).all()
+
+        index_tokens = {symbols[index.tradingsymbol]: index.instrument_token for index in indices}
+
+    finally:
+        db.close()
+
+    return contracts, index_tokens
+
+
+def find_contracts(tokens: list, names: list = tuple(INDEX_SYMBOLS)) -> list:
+    """ NfoTokenTable rows of tokens, index derivatives not expired yet, e.g. strikes subscribed during the day """
+
+    db = SessionLocalTokens()
+
+    try:
+        return db.query(tables.NfoTokenTable) \
+            .filter(tables.NfoTokenTable.instrument_token.in_(list(tokens)), tables.NfoTokenTable.name.in_(names),
+                    tables.NfoTokenTable.expiry >= today).all()
+
+    finally:
+        db.close()
+
+
+def max_pain(call_strikes, call_oi, put_strikes, put_oi):
+    """ Strike at which the option writers pay the least: the total intrinsic value of the open interest """
+
+    candidates = np.unique(np.concatenate([call_strikes, put_strikes]))
+    if len(candidates) == 0:
+        return None
+
+    pain = (np.maximum(candidates[:, None] - call_strikes[None, :], 0) * call_oi[None, :]).sum(axis=1) \
+        + (np.maximum(put_strikes[None, :] - candidates[:, None], 0) * put_oi[None, :]).sum(axis=1)
+
+    strike = candidates[np.argmin(pain)].item()
+    return int(strike) if float(strike).is_integer() else strike
+
+
+class OptionChainEngine(TickHandler):
+    """
+    Live option chain of the indices, written into the index candle rows.
+
+    Every NFO contract (NfoTokenTable row or NfoTokenModel) gets a slot once, with a precomputed
+    token -> (underlying, strike, CE / PE / FUT) lookup, so routing a tick is a dictionary lookup and a few
+    scalar writes. Once the exchange time moves to a new minute, the chain of every underlying is summarised with
+    vectorized operations into:
+        - option_strike_data: {strike: {'CE': {...}, 'PE': {...}}} with ltp, oi, oi_change and volume,
+        - option_profile: call / put oi, oi change and volume, put-call ratios and the max pain strike,
+        - future_profile: {expiry: {...}} with ltp, oi, oi_change and volume of the futures.
+
+    Changes and volumes are taken over the minute. Only the nearest option expiry of an underlying makes the chain.
+    """
+
+    def __init__(self, contracts: list, index_tokens: dict, engine=None, flush_seconds: float = 5.0,
+                 lookup=find_contracts):
+        """
+        Args:
+            contracts: NfoTokenTable rows or NfoTokenModel objects known at the start.
+            index_tokens: {underlying name: index instrument_token}.
+            lookup: function giving the contracts of unknown tokens, called at every flush with the tokens seen
+                since the previous one, e.g. the strikes subscribed when the ATM moved. None ignores them.
+        """
+
+        self.engine = candle_engine('INDEX') if engine is None else engine
+        self.index_tokens = index_tokens
+        self.flush_seconds = flush_seconds
+        self.last_flush = time.monotonic()
+        self.unflushed = 0  # batches handled since the last successful flush
+        self.lookup = lookup
+
+        # token -> slot, the O(1) routing table
+        self.slots = {}
+        self.underlying = np.zeros(0, dtype=object)
+        self.strike = np.zeros(0, dtype=np.float64)
+        self.kind = np.zeros(0, dtype=object)
+        self.expiry = []
+
+        # Live state, one entry per slot
+        self.ltp = np.zeros(0, dtype=np.float64)
+        self.oi = np.zeros(0, dtype=np.int64)
+        self.volume = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros(0, dtype=bool)
+
+        # State at the end of the previous minute
+        self.oi_start = np.zeros(0, dtype=np.int64)
+        self.volume_start = np.zeros(0, dtype=np.int64)
+        self.started = np.zeros(0, dtype=bool)
+
+        # Nearest option expiry of every underlying, and the tokens already looked up or waiting for it
+        self.nearest = {}
+        self.checked = set()
+        self.unknown = set()
+
+        self.chains = {}
+        self.minute = -1
+        self.rows = []
+
+        self.add_contracts(contracts)
+
+    def add_contracts(self, contracts: list) -> int:
+        """ Give a slot to the contracts not known yet, returns the number of slots added """
+
+        contracts = [contract for contract in contracts
+                     if contract.instrument_token not in self.slots and contract.name in self.index_tokens]
+
+        # Nearest option expiry of the underlyings seen for the first time
+        nearest = {}
+        for contract in contracts:
+            if contract.instrument_type in ('CE', 'PE') and contract.name not in self.nearest:
+                nearest[contract.name] = min(contract.expiry, nearest.get(contract.name, contract.expiry))
+        self.nearest.update(nearest)
+
+        selected = [contract for contract in contracts
+                    if contract.instrument_type == 'FUT' or contract.expiry == self.nearest.get(contract.name)]
+
+        self.checked.update(contract.instrument_token for contract in contracts)
+
+        if not selected:
+            return 0
+
+        first = len(self.slots)
+        self.slots.update({contract.instrument_token: first + number for number, contract in enumerate(selected)})
+        self.underlying = np.concatenate([self.underlying, np.array([contract.name for contract in selected],
+                                                                    dtype=object)])
+        self.strike = np.concatenate([self.strike, np.array([contract.strike or 0 for contract in selected],
+                                                            dtype=np.float64)])
+        self.kind = np.concatenate([self.kind, np.array([contract.instrument_type for contract in selected],
+                                                        dtype=object)])
+        self.expiry += [str(contract.expiry) for contract in selected]
+
+        size = len(selected)
+        for state in ('ltp', 'oi', 'volume', 'seen', 'oi_start', 'volume_start', 'started'):
+            array = getattr(self, state)
+            setattr(self, state, np.concatenate([array, np.zeros(size, dtype=array.dtype)]))
+
+        # Slots of every underlying, calls and puts sorted by strike
+        order = np.argsort(self.strike, kind='stable')
+        for name in self.index_tokens:
+            in_chain = self.underlying == name
+            self.chains[name] = {kind: order[(in_chain & (self.kind == kind))[order]] for kind in ('CE', 'PE', 'FUT')}
+
+        return size
+
+    def __add_unknown(self):
+        # Contracts of the tokens seen without a slot, looked up once per token
+        tokens, self.unknown = list(self.unknown), set()
+        self.checked.update(tokens)
+
+        try:
+            added = self.add_contracts(self.lookup(tokens))
+
+        except Exception as e:
+            print(f"Error looking up {len(tokens)} new NFO tokens: {e}")
+            return
+
+        if added:
+            print(f"Option chain: {added} contracts added")
+
+    def update(self, ticks: list):
+        """ Route a batch of NFO ticks to their slots, ticks of other tokens are ignored """
+
+        slots = self.slots
+
+        for tick in ticks:
+            slot = slots.get(tick['instrument_token'])
+            if slot is None:
+                # Looked up at the next flush, e.g. a strike subscribed when the ATM moved
+                if tick['instrument_token'] not in self.checked:
+                    self.unknown.add(tick['instrument_token'])
+                continue
+
+            timestamp = tick.get('exchange_timestamp')
+            if timestamp is not None:
+                minute = int((timestamp - EPOCH).total_seconds()) // 60
+
+                # Exchange time moved on: the previous minute is complete
+                if minute > self.minute:
+                    if self.minute >= 0:
+                        self.__emit()
+                    self.minute = minute
+
+            self.ltp[slot] = tick['last_price']
+            self.oi[slot] = tick.get('oi') or 0
+            self.volume[slot] = tick.get('volume_traded') or 0
+            self.seen[slot] = True
+
+    def __emit(self):
+        """ Summarise the chains at the end of the current minute, then start the next one """
+
+        time_stamp = EPOCH + timedelta(minutes=self.minute)
+
+        # The first tick of a contract is its own reference, its change over the minute is not known
+        first = self.seen & ~self.started
+        self.oi_start[first] = self.oi[first]
+        self.volume_start[first] = self.volume[first]
+        self.started |= self.seen
+
+        oi_change = self.oi - self.oi_start
+        volume = np.maximum(self.volume - self.volume_start, 0)
+
+        for name, chain in self.chains.items():
+            calls = chain['CE'][self.seen[chain['CE']]]
+            puts = chain['PE'][self.seen[chain['PE']]]
+            futures = chain['FUT'][self.seen[chain['FUT']]]
+
+            if len(calls) == 0 and len(puts) == 0 and len(futures) == 0:
+                continue
+
+            strike_data = {}
+            for kind, slots in (('CE', calls), ('PE', puts)):
+                for strike, ltp, oi, change, traded in zip(self.strike[slots].tolist(), self.ltp[slots].tolist(),
+                                                           self.oi[slots].tolist(), oi_change[slots].tolist(),
+                                                           volume[slots].tolist()):
+                    strike = int(strike) if strike.is_integer() else strike
+                    strike_data.setdefault(strike, {})[kind] = {'ltp': ltp, 'oi': oi, 'oi_change': change,
+                                                                'volume': traded}
+
+            call_oi, put_oi = int(self.oi[calls].sum()), int(self.oi[puts].sum())
+            call_volume, put_volume = int(volume[calls].sum()), int(volume[puts].sum())
+
+            option_profile = {
+                'call_oi': call_oi,
+                'put_oi': put_oi,
+                'call_oi_change': int(oi_change[calls].sum()),
+                'put_oi_change': int(oi_change[puts].sum()),
+                'call_volume': call_volume,
+                'put_volume': put_volume,
+                'pcr': round(put_oi / call_oi, 4) if call_oi else None,
+                'pcr_volume': round(put_volume / call_volume, 4) if call_volume else None,
+                'max_pain': max_pain(self.strike[calls], self.oi[calls], self.strike[puts], self.oi[puts]),
+            }
+
+            future_profile = {self.expiry[slot]: {'ltp': self.ltp[slot].item(), 'oi': self.oi[slot].item(),
+                                                  'oi_change': oi_change[slot].item(),
+                                                  'volume': volume[slot].item()}
+                              for slot in futures.tolist()}
+
+            self.rows.append({'instrument_token': self.index_tokens[name], 'time_stamp': time_stamp,
+                              'option_strike_data': json.dumps(strike_data),
+                              'option_profile': json.dumps(option_profile),
+                              'future_profile': json.dumps(future_profile)})
+
+        # Next minute starts from the current state
+        self.oi_start[:] = self.oi
+        self.volume_start[:] = self.volume
+
+    def finish(self):
+        """ Summarise the last minute, at the market close """
+
+        if self.minute >= 0:
+            self.__emit()
+            self.minute = -1
+
+    def completed_rows(self) -> list:
+        rows, self.rows = self.rows, []
+        return rows
+
+    def flush(self) -> int:
+        """ Write the completed minutes into the index candle rows, only the chain columns are updated """
+
+        rows = self.completed_rows()
+        self.last_flush = time.monotonic()
+
+        if self.unknown and self.lookup is not None:
+            self.__add_unknown()
+
+        if not rows:
+            self.unflushed = 0
+            return 0
+
+        try:
+            written = upsert_rows(self.engine, rows)
+
+        except Exception:
+            # Kept for the next flush
+            self.rows = rows + self.rows
+            raise
+
+        self.unflushed = 0
+        return written
+
+    # TickHandler interface, to consume the NFO queue directly
+    def handle(self, received, ticks: list):
+        self.update(ticks)
+        self.unflushed += 1
+
+        if time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def pending(self) -> bool:
+        return self.unflushed > 0
+
+    def idle(self):
+        if self.unflushed and time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def close(self):
+        self.finish()
+        self.flush()
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    from models import NfoTokenModel
+
+    if len(sys.argv) == 2 and sys.argv[1] == 'live':
+        # NFO candles and the index option chain from the same queue: python option_chain.py live
+        from consumer import RabbitMQConsumer, MultiHandler
+        from candle_aggregator import CandleAggregator, CandleHandler
+
+        chain = OptionChainEngine(*load_contracts())
+        handler = MultiHandler([CandleHandler(CandleAggregator('NFO')), chain])
+
+        consumer = RabbitMQConsumer('NFO_queue')
+        consumer.consume_messages(handler)
+        consumer.close_connection()
+        sys.exit()
+
+    # Benchmark: BANKNIFTY chain of 50 strikes and the future, one hour of 1 second batches
+    expiry = datetime(2023, 12, 20).date()
+    contracts = [NfoTokenModel(instrument_token=20_000_000 + index, name='BANKNIFTY', strike=strike,
+                               instrument_type=kind, expiry=expiry)
+                 for index, (strike, kind) in enumerate((strike, kind) for strike in range(45_000, 50_000, 100)
+                                                        for kind in ('CE', 'PE'))]
+    contracts.append(NfoTokenModel(instrument_token=30_000_000, name='BANKNIFTY', strike=0, instrument_type='FUT',
+                                   expiry=datetime(2023, 12, 28).date()))
+
+    chain = OptionChainEngine(contracts, {'BANKNIFTY': 260105}, engine=object())
+    market_open = datetime(2023, 12, 18, 9, 15)
+    state = {contract.instrument_token: [100.0, 0, 10_000] for contract in contracts}
+
+    batches = []
+    for second in range(3_600):
+        batch = []
+        for token in random.sample(list(state), 60):
+            state[token][1] += random.randint(0, 500)
+            state[token][2] += random.randint(-50, 60)
+            batch.append({'instrument_token': token, 'exchange_timestamp': market_open + timedelta(seconds=second),
+                          'last_price': state[token][0], 'volume_traded': state[token][1], 'oi': state[token][2]})
+        batches.append(batch)
+
+    begin = time.perf_counter()
+    for batch in batches:
+        chain.update(batch)
+    chain.finish()
+    elapsed = time.perf_counter() - begin
+
+    rows = chain.completed_rows()
+    total = sum(len(batch) for batch in batches)
+    print(f"{total:,} ticks, {len(rows)} index rows, {elapsed / total * 1e6:.2f} us per tick "
+          f"including the minute summaries")
+    print(rows[-1]['option_profile'])
+    print(rows[-1]['future_profile'])
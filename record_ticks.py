@@ -2,6 +2,7 @@
 import time
 import datetime
 import multiprocessing
+from functools import lru_cache
 
 print("Recording preprocessing started")
 
@@ -18,19 +19,27 @@ if time_live < start_time.time():
 
 from kite_websocket import TickData
 
-tick = TickData()
+# Capture format of the daily tick files: 'txt' keeps every tick field, 'bin' (tick_codec) is smaller and faster
+# to read but keeps only the column_dict fields, no depth, ohlc, last_quantity, last_trade_time or oi high / low
+FILE_FORMAT = 'txt'
+
+
+@lru_cache(maxsize=None)
+def tick_data() -> TickData:
+    # Built in the recorder process on first use, not when the module is imported by every child process
+    return TickData()
 
 
 def record_nse():
-    tick.record_beta('NSE')
+    tick_data().record_beta('NSE', file_format=FILE_FORMAT)
 
 
 def record_nfo():
-    tick.record_beta('NFO')
+    tick_data().record_beta('NFO', file_format=FILE_FORMAT)
 
 
 def record_index():
-    tick.record_beta('INDEX')
+    tick_data().record_beta('INDEX', file_format=FILE_FORMAT)
 
 
 if __name__ == '__main__':
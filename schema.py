@@ -0,0 +1,172 @@
+# Python Standard Library
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import Table, Column, MetaData, Integer, DateTime, Float, JSON, inspect
+
+# Local Library imports
+from database import candle_engine, day_engine
+from candle_aggregator import CANDLE_LAYOUT
+
+# Parameters
+today = datetime.today().date()
+
+# Columns of the per-token candle and day tables, the same in both databases
+COLUMN_SPECS = {
+    'NSE': [('time_stamp', DateTime), ('open', Float), ('high', Float), ('low', Float), ('close', Float),
+            ('volume', Integer), ('liquidity_profile', JSON), ('volume_profile', JSON), ('order_profile', JSON),
+            ('candle_data', JSON)],
+    'NFO': [('time_stamp', DateTime), ('open', Float), ('high', Float), ('low', Float), ('close', Float),
+            ('volume', Integer), ('liquidity_profile', JSON), ('volume_profile', JSON), ('order_profile', JSON),
+            ('candle_data', JSON)],
+    'INDEX': [('time_stamp', DateTime), ('open', Float), ('high', Float), ('low', Float), ('close', Float),
+              ('candle_data', JSON), ('cash_profile', JSON), ('future_profile', JSON), ('option_profile', JSON),
+              ('option_strike_data', JSON)],
+}
+
+# Existing table names of every engine, read once per process
+_table_names = {}
+# Engines whose 'candles' partitions were checked by this process
+_partitioned = set()
+
+
+def token_table(exchange: str, token: int, metadata: MetaData = None) -> Table:
+    """ Core Table of a token from the column spec of its exchange, 'time_stamp' is the primary key """
+
+    metadata = MetaData() if metadata is None else metadata
+
+    return Table(f"token_{token}", metadata,
+                 *[Column(name, column_type, primary_key=(name == 'time_stamp'))
+                   for name, column_type in COLUMN_SPECS[exchange.upper()]])
+
+
+def table_names(engine, refresh: bool = False) -> set:
+    """ Cached names of the tables of a database, inspected on first use or on refresh """
+
+    if refresh or engine not in _table_names:
+        _table_names[engine] = set(inspect(engine).get_table_names())
+
+    return _table_names[engine]
+
+
+def create_token_tables(engine, exchange: str, tokens: list) -> list:
+    """Create the missing token tables of a database in one DDL pass over a single connection.
+
+    Args:
+        engine: candle or day database engine.
+        exchange: 'NSE', 'NFO' or 'INDEX', selects the column spec.
+        tokens: instrument tokens.
+
+    Returns:
+        The names of the tables created, in the 'long' CANDLE_LAYOUT ['candles'] when it was created.
+    """
+
+    # The long layout keeps every token in the 'candles' table, see candle_store.py
+    if CANDLE_LAYOUT != 'token':
+        return create_long_table(engine, exchange)
+
+    existing = table_names(engine)
+    missing = [token for token in dict.fromkeys(tokens) if f"token_{token}" not in existing]
+
+    if not missing:
+        return []
+
+    # A throw-away MetaData, the tables are not kept alive after the DDL
+    metadata = MetaData()
+    new_tables = [token_table(exchange, token, metadata) for token in missing]
+
+    with engine.begin() as conn:
+        metadata.create_all(conn, tables=new_tables, checkfirst=False)
+
+    existing.update(table.name for table in new_tables)
+
+    return [table.name for table in new_tables]
+
+
+def create_long_table(engine, exchange: str) -> list:
+    """ Create the partitioned 'candles' table of the long layout, or add its partitions ahead once per process """
+
+    # candle_store imports this module
+    import candle_store
+
+    existing = table_names(engine)
+
+    if candle_store.LONG_TABLE not in existing:
+        candle_store.create_long_table(engine, exchange, today)
+        existing.add(candle_store.LONG_TABLE)
+        _partitioned.add(engine)
+        return [candle_store.LONG_TABLE]
+
+    if engine not in _partitioned:
+        added = candle_store.add_partitions(engine)
+        _partitioned.add(engine)
+
+        if added:
+            print(f"{engine.url.database}.{candle_store.LONG_TABLE}: {added} partitions added")
+
+    return []
+
+
+def ensure_tables(exchange: str, tokens: list) -> dict:
+    """ Create the missing candle and day tables of tokens, returns {'candle': [names], 'day': [names]} """
+
+    exchange = exchange.upper()
+    created = {'candle': create_token_tables(candle_engine(exchange), exchange, tokens),
+               'day': create_token_tables(day_engine(exchange), exchange, tokens)}
+
+    for database, names in created.items():
+        if names:
+            print(f"{exchange}: {len(names)} {database} tables created")
+
+    return created
+
+
+def upcoming_expiry_tokens(path: str = None, names: list = ('NIFTY', 'BANKNIFTY', 'FINNIFTY'),
+                           days_ahead: int = 7) -> list:
+    """Instrument tokens of every strike and future of the index expiries in the next days.
+
+    Args:
+        path: NFO instrument dump, 'InstrumentToken/NFO/{today}_NFO.csv' by default.
+        names: underlying names.
+        days_ahead: expiries from tomorrow up to this many days ahead.
+    """
+
+    path = f"InstrumentToken/NFO/{today}_NFO.csv" if path is None else path
+    data_frame = pd.read_csv(path, usecols=['instrument_token', 'name', 'expiry', 'segment'])
+
+    expiry = pd.to_datetime(data_frame['expiry']).dt.date
+    condition = data_frame['name'].isin(names) & data_frame['segment'].isin(['NFO-OPT', 'NFO-FUT']) \
+        & (expiry > today) & (expiry <= today + timedelta(days=days_ahead))
+
+    return data_frame.loc[condition, 'instrument_token'].astype(int).tolist()
+
+
+def precreate_expiry_tables(path: str = None, days_ahead: int = 7) -> dict:
+    """ Evening job: create the NFO tables of all the strikes of the upcoming expiries before the next open """
+
+    return ensure_tables('NFO', upcoming_expiry_tokens(path, days_ahead=days_ahead))
+
+
+if __name__ == '__main__':
+    import sys
+    from sqlalchemy import create_engine
+
+    if sys.argv[1:] == ['precreate']:
+        # Run the day before: python schema.py precreate
+        precreate_expiry_tables()
+        sys.exit()
+
+    # Benchmark: 2,000 token tables in an in-memory database
+    engine = create_engine("sqlite://")
+    tokens = list(range(10_000_000, 10_002_000))
+
+    begin = time.perf_counter()
+    created = create_token_tables(engine, 'NFO', tokens)
+    elapsed = time.perf_counter() - begin
+    print(f"{len(created)} tables created in {elapsed:.2f}s")
+
+    begin = time.perf_counter()
+    created = create_token_tables(engine, 'NFO', tokens)
+    elapsed = time.perf_counter() - begin
+    print(f"second pass: {len(created)} tables created, {elapsed * 1000:.2f} ms with the cached table names")
@@ -1,6 +1,8 @@
 # STD library
 import os
+import time
 import sqlite3
+import threading
 from datetime import datetime
 
 # local library
@@ -12,13 +14,55 @@ today = datetime.today().date()
 
 class Sqlite3Server:
 
-    def __init__(self, path, column_dict):
+    def __init__(self, path, column_dict, batched=False, batch_ms=0, journal_mode=None, synchronous=None,
+                 layout='token'):
+        """SQLite tick store.
+
+        Args:
+            path: database file path.
+            column_dict: {column: (sql_type, tick_key)}.
+            layout: 'token' for one TOKEN{token} table per instrument, 'long' for a single 'ticks' table
+                keyed by (instrument_token, time_stamp) with TOKEN{token} views for the existing queries.
+            batched: when True, insert_ticks groups ticks by token, inserts them with executemany
+                and commits once per batch instead of once per tick.
+            batch_ms: in batched mode, keep buffering callbacks until this many milliseconds have passed
+                since the first buffered tick. 0 writes every callback as its own batch. A timer writes the
+                batch at the deadline when no callback comes, e.g. on a quiet feed.
+            journal_mode: optional 'PRAGMA journal_mode' value, e.g. 'WAL'.
+            synchronous: optional 'PRAGMA synchronous' value, e.g. 'NORMAL'.
+        """
+
         self.path = path
         self.data_base = sqlite3.connect(path, check_same_thread=False)
         self.column_dict = column_dict
         self.column_list = list(column_dict.keys())
 
+        # Batched writer parameters
+        self.batched = batched
+        self.batch_ms = batch_ms
+        self.pending = []
+        self.pending_since = None
+        self.insert_queries = {}
+        self.lock = threading.Lock()
+        self.timer = None
+
+        if layout not in ('token', 'long'):
+            raise ValueError("Invalid layout. Valid options are 'token' or 'long'.")
+
+        self.layout = layout
+
+        if journal_mode is not None:
+            self.data_base.execute(f"PRAGMA journal_mode={journal_mode}")
+
+        if synchronous is not None:
+            self.data_base.execute(f"PRAGMA synchronous={synchronous}")
+
     def create_tables(self, tokens):
+
+        if self.layout == 'long':
+            self.__create_long_table(tokens)
+            return
+
         cursor = self.data_base.cursor()
 
         for token in tokens:
@@ -33,7 +77,38 @@ class Sqlite3Server:
             except Exception as message:
                 print(message)
 
+    def __create_long_table(self, tokens, views=True):
+        """ Create the single 'ticks' table, its time index and one TOKEN{token} view per token in one transaction """
+
+        column_string = ", ".join(f"{column} {sql_type.replace('primary key', '').strip()}"
+                                  for column, (sql_type, _) in self.column_dict.items())
+        columns = ", ".join(self.column_list)
+
+        statements = [
+            f"CREATE TABLE IF NOT EXISTS ticks (instrument_token integer not null, {column_string}, "
+            f"PRIMARY KEY (instrument_token, time_stamp)) WITHOUT ROWID",
+            "CREATE INDEX IF NOT EXISTS ticks_time_stamp ON ticks (time_stamp, instrument_token)",
+        ]
+
+        # Compatibility views, so 'SELECT * FROM TOKEN{token}' keeps working on the long layout
+        if views:
+            statements += [f"CREATE VIEW IF NOT EXISTS TOKEN{token} AS "
+                           f"SELECT {columns} FROM ticks WHERE instrument_token = {int(token)}" for token in tokens]
+
+        try:
+            with self.data_base:
+                for statement in statements:
+                    self.data_base.execute(statement)
+
+        except Exception as message:
+            print(message)
+
     def insert_ticks(self, ticks):
+
+        if self.batched or self.layout == 'long':
+            self.__insert_ticks_batched(ticks)
+            return
+
         cursor = self.data_base.cursor()
 
         for tick in ticks:
@@ -55,12 +130,217 @@ class Sqlite3Server:
                 print(e)
                 pass
 
+    def __insert_query(self, token):
+        """ Parameterized insert statement of a token table, built once per token """
+
+        if self.layout == 'long':
+            token = 'ticks'
+
+        query = self.insert_queries.get(token)
+
+        if query is None and token == 'ticks':
+            placeholders = ", ".join("?" * (len(self.column_list) + 1))
+            query = f"INSERT or IGNORE INTO ticks (instrument_token, {', '.join(self.column_list)}) " \
+                    f"VALUES ({placeholders})"
+            self.insert_queries[token] = query
+
+        elif query is None:
+            placeholders = ", ".join("?" * len(self.column_list))
+            query = f"INSERT or IGNORE INTO TOKEN{token} ({', '.join(self.column_list)}) VALUES ({placeholders})"
+            self.insert_queries[token] = query
+
+        return query
+
+    def __insert_ticks_batched(self, ticks):
+
+        with self.lock:
+            # Buffer the callback, and wait for more when a time window is configured
+            if not self.pending:
+                self.pending_since = time.monotonic()
+
+                # Deadline of the new batch, met by the timer when no other callback comes
+                if self.batch_ms > 0:
+                    self.timer = threading.Timer(self.batch_ms / 1000, self.__flush_due)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+            self.pending.extend(ticks)
+
+            if (time.monotonic() - self.pending_since) * 1000 >= self.batch_ms:
+                self.__write_pending()
+
+    def __flush_due(self):
+        # Timer thread: write the buffered batch once its deadline has passed
+        with self.lock:
+            if not self.pending:
+                return
+
+            remaining = self.batch_ms / 1000 - (time.monotonic() - self.pending_since)
+
+            if remaining <= 0:
+                self.__write_pending()
+            else:
+                # A newer batch than the one of this timer, wait for its own deadline
+                self.timer = threading.Timer(remaining, self.__flush_due)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def __write_pending(self):
+
+        ticks = self.pending
+        self.pending = []
+        self.pending_since = None
+
+        if not ticks:
+            return
+
+        keys = [self.column_dict[column][1] for column in self.column_list]
+
+        # Group the rows of the batch by instrument token, keeping the arrival order inside a token
+        rows_by_token = {}
+        for tick in ticks:
+            try:
+                row = tuple(str(tick[key]) if key == 'exchange_timestamp' else tick[key] for key in keys)
+                rows_by_token.setdefault(tick['instrument_token'], []).append(row)
+
+            except KeyError as e:
+                print(f"Missing {e} in tick {tick.get('instrument_token')}")
+
+        cursor = self.data_base.cursor()
+
+        # The long layout writes the whole batch with one statement
+        if self.layout == 'long':
+            rows_by_token = {'ticks': [(token,) + row for token, rows in rows_by_token.items() for row in rows]}
+
+        # Write every token of the batch inside a single transaction
+        for token, rows in rows_by_token.items():
+            try:
+                cursor.executemany(self.__insert_query(token), rows)
+
+            except Exception as e:
+                print(e)
+
+        self.data_base.commit()
+
+    def read_token(self, token, start=None, end=None):
+        """Read the ticks of a single token, in time order.
+
+        Args:
+            token: instrument token.
+            start: optional first time stamp, datetime or 'YYYY-mm-dd HH:MM:SS' string.
+            end: optional last time stamp (included).
+
+        Returns:
+            A list of row tuples in the column_dict order.
+        """
+
+        table = "ticks" if self.layout == 'long' else f"TOKEN{int(token)}"
+        conditions = ["instrument_token = ?"] if self.layout == 'long' else []
+        parameters = [token] if self.layout == 'long' else []
+
+        if start is not None:
+            conditions.append("time_stamp >= ?")
+            parameters.append(str(start))
+
+        if end is not None:
+            conditions.append("time_stamp <= ?")
+            parameters.append(str(end))
+
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT {', '.join(self.column_list)} FROM {table}{where} ORDER BY time_stamp"
+
+        return self.data_base.execute(query, parameters).fetchall()
+
+    def read_range(self, start, end, tokens=None):
+        """Read the ticks of many tokens between two time stamps with one indexed scan, long layout only.
+
+        Args:
+            start: first time stamp, datetime or 'YYYY-mm-dd HH:MM:SS' string.
+            end: last time stamp (included).
+            tokens: optional list of instrument tokens, all tokens when None.
+
+        Returns:
+            A list of (instrument_token, *columns) tuples ordered by time stamp.
+        """
+
+        if self.layout != 'long':
+            raise ValueError("read_range needs the 'long' layout")
+
+        query = f"SELECT instrument_token, {', '.join(self.column_list)} FROM ticks " \
+                f"WHERE time_stamp BETWEEN ? AND ?"
+        parameters = [str(start), str(end)]
+
+        if tokens:
+            query += f" AND instrument_token IN ({', '.join('?' * len(tokens))})"
+            parameters += list(tokens)
+
+        return self.data_base.execute(query + " ORDER BY time_stamp", parameters).fetchall()
+
+    def flush(self):
+        """ Write the buffered ticks of the batched mode """
+
+        with self.lock:
+            self.__write_pending()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+        self.flush()
+        self.data_base.close()
+
 
 if __name__ == "__main__":
 
+    import random
+    import tempfile
+    from datetime import timedelta
+
     path = os.getcwd() + f"/{today}.db"
     print(path)
 
+    # Benchmark: sustained ticks/sec of the per-tick commit against the batched writer on a synthetic day
+    nfo_column = {'time_stamp': ('datetime primary key', 'exchange_timestamp'),
+                  'price': ('real(15,5)', 'last_price'),
+                  'average_price': ('real(15,5)', 'average_traded_price'),
+                  'total_buy_qty': ('integer', 'total_buy_quantity'),
+                  'total_sell_qty': ('integer', 'total_sell_quantity'),
+                  'volume': ('integer', 'volume_traded'),
+                  'open_interest': ('integer', 'oi')}
+
+    tokens = list(range(10_000_000, 10_000_200))
+    market_open = datetime(2023, 12, 18, 9, 15)
+
+    def synthetic_day(seconds, ticks_per_second):
+        for second in range(seconds):
+            moment = market_open + timedelta(seconds=second)
+            yield [{'instrument_token': token, 'exchange_timestamp': moment, 'last_price': 100.05,
+                    'average_traded_price': 100.0, 'total_buy_quantity': 5000, 'total_sell_quantity': 4000,
+                    'volume_traded': second, 'oi': 1000}
+                   for token in random.sample(tokens, ticks_per_second)]
+
+    def benchmark(label, seconds, **kwargs):
+        folder = tempfile.mkdtemp()
+        server = Sqlite3Server(os.path.join(folder, 'bench.db'), nfo_column, **kwargs)
+        server.create_tables(tokens)
+
+        count = 0
+        begin = time.perf_counter()
+        for batch in synthetic_day(seconds, 150):
+            server.insert_ticks(batch)
+            count += len(batch)
+        server.close()
+        elapsed = time.perf_counter() - begin
+
+        print(f"{label:<32} {count:>8} ticks {elapsed:8.2f}s {count / elapsed:>12,.0f} ticks/sec")
+
+    benchmark("per tick commit", 20)
+    benchmark("batched", 600, batched=True)
+    benchmark("batched, WAL + NORMAL", 600, batched=True, journal_mode='WAL', synchronous='NORMAL')
+    benchmark("batched 500ms, WAL + NORMAL", 600, batched=True, batch_ms=500, journal_mode='WAL',
+              synchronous='NORMAL')
+    benchmark("long layout, WAL + NORMAL", 600, batched=True, journal_mode='WAL', synchronous='NORMAL',
+              layout='long')
 
 #
 # c = db.cursor()
@@ -1,5 +1,7 @@
 from sqlalchemy import Column, Integer, String, Date, DateTime, Float
-from database import Base, engine_tokens
+from functools import lru_cache
+
+from database import Base, get_engine
 from datetime import datetime
 
 
@@ -43,6 +45,9 @@ class IndexTokenTable(Base):
     last_update = Column(Date)
 
 
-# create tables in respective databases
-Base.metadata.create_all(bind=engine_tokens, tables=[NseTokenTable.__table__, NseTokenTable.__table__,
-                                                     IndexTokenTable.__table__])
+@lru_cache(maxsize=None)
+def create_tables():
+    """ Create the token tables in the tokens database, once per process """
+
+    Base.metadata.create_all(bind=get_engine('tokens'), tables=[NfoTokenTable.__table__, NseTokenTable.__table__,
+                                                                IndexTokenTable.__table__])
@@ -0,0 +1,389 @@
+"""
+Binary tick capture format (version 1)
+
+A capture file starts with a self-describing header followed by any number of batch records.
+All integers are little-endian.
+
+    header  := magic(4s = b'KTCK') version(B) field_count(B) names_length(H) names(utf-8, comma separated)
+    record  := payload_length(I) received_us(q) payload
+    payload := tick * (payload_length // tick_size)
+
+'received_us' is the local receive time of the batch in microseconds since 1970-01-01 (naive, no
+timezone conversion). Each tick is a fixed-width struct whose fields follow the header 'names' order,
+'instrument_token' always being the first field. The struct code of every field comes from FIELD_FORMATS:
+
+    instrument_token      I  (uint32)
+    exchange_timestamp    I  (uint32, seconds since 1970-01-01, naive exchange time, 0 when missing)
+    last_price            i  (int32, paise)
+    average_traded_price  i  (int32, paise)
+    total_buy_quantity    Q  (uint64)
+    total_sell_quantity   Q  (uint64)
+    volume_traded         Q  (uint64)
+    oi                    Q  (uint64)
+
+The column layout is taken from the same column_dict used by Sqlite3Server, so an NFO tick takes 48 bytes,
+an NSE tick 40 bytes and an INDEX tick 12 bytes, instead of the ~600 byte python repr written to the txt files.
+"""
+
+# STD library
+import re
+import ast
+import json
+import time
+import struct
+from datetime import datetime, timedelta
+
+# Parameters
+MAGIC = b'KTCK'
+VERSION = 1
+EPOCH = datetime(1970, 1, 1)
+
+FIELD_FORMATS = {
+    'instrument_token': 'I',
+    'exchange_timestamp': 'I',
+    'last_price': 'i',
+    'average_traded_price': 'i',
+    'total_buy_quantity': 'Q',
+    'total_sell_quantity': 'Q',
+    'volume_traded': 'Q',
+    'oi': 'Q',
+}
+
+PRICE_FIELDS = ('last_price', 'average_traded_price')
+TIME_FIELDS = ('exchange_timestamp',)
+
+HEADER = struct.Struct('<4sBBH')
+RECORD = struct.Struct('<Iq')
+
+
+class TickLayout:
+    """ Fixed-width struct layout of a single tick, built from the ordered list of tick keys """
+
+    def __init__(self, fields: list):
+
+        # 'instrument_token' is always stored first, it is the key every reader routes on
+        fields = ['instrument_token'] + [name for name in fields if name != 'instrument_token']
+
+        unknown = [name for name in fields if name not in FIELD_FORMATS]
+        if unknown:
+            raise ValueError(f"No fixed-width format defined for tick fields: {unknown}")
+
+        self.fields = fields
+        self.struct = struct.Struct('<' + ''.join(FIELD_FORMATS[name] for name in fields))
+        self.size = self.struct.size
+
+        self.price_index = [index for index, name in enumerate(fields) if name in PRICE_FIELDS]
+        self.time_index = [index for index, name in enumerate(fields) if name in TIME_FIELDS]
+
+    @classmethod
+    def from_column_dict(cls, column_dict: dict):
+        """ Build the layout from a column_dict of the form {column: (sql_type, tick_key)} """
+
+        return cls([value[1] for value in column_dict.values()])
+
+    def pack(self, ticks: list) -> bytes:
+        """ Convert a list of kite tick dictionaries into the packed payload of one record """
+
+        pack = self.struct.pack
+        rows = []
+
+        for tick in ticks:
+            values = []
+            for name in self.fields:
+                value = tick.get(name)
+
+                if value is None:
+                    value = 0
+                elif name in PRICE_FIELDS:
+                    value = round(value * 100)
+                elif name in TIME_FIELDS:
+                    value = int((value - EPOCH).total_seconds())
+
+                values.append(value)
+
+            rows.append(pack(*values))
+
+        return b''.join(rows)
+
+    def unpack_raw(self, payload: bytes) -> list:
+        """ Convert a packed payload into tuples of stored integers (paise, epoch seconds), without conversion """
+
+        return list(self.struct.iter_unpack(payload))
+
+    def unpack(self, payload: bytes) -> list:
+        """ Convert a packed payload back into kite style tick dictionaries """
+
+        fields = self.fields
+        price_index = self.price_index
+        time_index = self.time_index
+        ticks = []
+
+        for row in self.struct.iter_unpack(payload):
+            row = list(row)
+
+            for index in price_index:
+                row[index] = row[index] / 100
+
+            for index in time_index:
+                row[index] = EPOCH + timedelta(seconds=row[index]) if row[index] else None
+
+            ticks.append(dict(zip(fields, row)))
+
+        return ticks
+
+    def header(self) -> bytes:
+        names = ','.join(self.fields).encode()
+        return HEADER.pack(MAGIC, VERSION, len(self.fields), len(names)) + names
+
+    @classmethod
+    def read_header(cls, buffer: bytes, offset: int = 0):
+        """ Parse a header at 'offset' of 'buffer', returns the layout and the offset just after the header """
+
+        magic, version, field_count, names_length = HEADER.unpack_from(buffer, offset)
+
+        if magic != MAGIC:
+            raise ValueError("Not a binary tick capture, magic bytes do not match")
+
+        if version != VERSION:
+            raise ValueError(f"Unsupported tick capture version: {version}")
+
+        start = offset + HEADER.size
+        names = bytes(buffer[start:start + names_length]).decode().split(',')
+
+        if len(names) != field_count:
+            raise ValueError("Corrupted tick capture header")
+
+        return cls(names), start + names_length
+
+
+def to_micro_seconds(moment: datetime) -> int:
+    return round((moment - EPOCH).total_seconds() * 1_000_000)
+
+
+def from_micro_seconds(value: int) -> datetime:
+    return EPOCH + timedelta(microseconds=value)
+
+
+class TickFileWriter:
+    """ Appends tick batches to a binary capture file, one length-prefixed record per 'on_ticks' callback """
+
+    def __init__(self, path: str, column_dict: dict):
+        self.path = path
+        self.layout = TickLayout.from_column_dict(column_dict)
+        self.file = open(path, 'ab')
+
+        # A new file gets the header, an existing file must have been written with the same layout
+        if self.file.tell() == 0:
+            self.file.write(self.layout.header())
+
+        else:
+            with open(path, 'rb') as existing:
+                layout, _ = TickLayout.read_header(existing.read(HEADER.size + 1024))
+
+            if layout.fields != self.layout.fields:
+                self.file.close()
+                raise ValueError(f"{path} was recorded with fields {layout.fields}, not {self.layout.fields}")
+
+    def write_ticks(self, ticks: list, received: datetime = None):
+        """ Write one batch of ticks as a single record """
+
+        received = datetime.now() if received is None else received
+        payload = self.layout.pack(ticks)
+
+        self.file.write(RECORD.pack(len(payload), to_micro_seconds(received)) + payload)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TickFileReader:
+    """ Streams batches back from a binary capture file without loading the whole file in memory """
+
+    def __init__(self, path: str, raw: bool = False, chunk_size: int = 1 << 20):
+        self.path = path
+        self.raw = raw
+        self.chunk_size = chunk_size
+
+        with open(path, 'rb') as file:
+            self.layout, self.data_offset = TickLayout.read_header(file.read(HEADER.size + 1024))
+
+    def __iter__(self):
+        """ Yields (received datetime, ticks) for every record, ticks as tuples when 'raw' is set """
+
+        unpack = self.layout.unpack_raw if self.raw else self.layout.unpack
+
+        with open(self.path, 'rb') as file:
+            file.seek(self.data_offset)
+
+            buffer = b''
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                buffer += chunk
+                view = memoryview(buffer)
+                offset = 0
+
+                # Decode every complete record inside the buffer, keep the tail for the next chunk
+                while len(buffer) - offset >= RECORD.size:
+                    length, received = RECORD.unpack_from(view, offset)
+                    end = offset + RECORD.size + length
+
+                    if end > len(buffer):
+                        break
+
+                    yield from_micro_seconds(received), unpack(view[offset + RECORD.size:end])
+                    offset = end
+
+                view.release()
+                buffer = buffer[offset:]
+
+            if buffer:
+                print(f"{self.path}: ignored {len(buffer)} bytes of a truncated record")
+
+    def ticks(self):
+        """ Yields every tick of the file in recorded order """
+
+        for _, ticks in self:
+            yield from ticks
+
+
+# Layouts of the broker messages, keyed on their header bytes
+_message_layouts = {}
+
+
+def pack_message(layout: TickLayout, ticks: list, received: datetime = None) -> bytes:
+    """ Encode one batch as a standalone broker message: the capture header followed by a single record """
+
+    received = datetime.now() if received is None else received
+    payload = layout.pack(ticks)
+
+    return layout.header() + RECORD.pack(len(payload), to_micro_seconds(received)) + payload
+
+
+def is_binary_message(body: bytes) -> bool:
+    return body[:len(MAGIC)] == MAGIC
+
+
+def unpack_message(body: bytes, raw: bool = False):
+    """ Decode a message made by pack_message, returns (received datetime, ticks) """
+
+    names_length = HEADER.unpack_from(body)[3]
+    header_size = HEADER.size + names_length
+    header = bytes(body[:header_size])
+
+    layout = _message_layouts.get(header)
+    if layout is None:
+        layout = _message_layouts[header] = TickLayout.read_header(header)[0]
+
+    length, received = RECORD.unpack_from(body, header_size)
+    start = header_size + RECORD.size
+    payload = body[start:start + length]
+
+    return from_micro_seconds(received), layout.unpack_raw(payload) if raw else layout.unpack(payload)
+
+
+# Matches the repr of datetime objects inside str(ticks), i.e. 'datetime.datetime(2023, 12, 18, 9, 15, 1)'
+_DATETIME_REPR = re.compile(r"datetime\.datetime\(([\d,\s]+)\)")
+
+
+def parse_legacy_ticks(text: str) -> list:
+    """ Parse the str(ticks) text of the txt capture files without eval(), restoring datetime values """
+
+    marked = _DATETIME_REPR.sub(lambda match: f"('__datetime__', {match.group(1)})", text)
+    ticks = ast.literal_eval(marked)
+
+    def restore(value):
+        if isinstance(value, tuple) and value and value[0] == '__datetime__':
+            return datetime(*value[1:])
+        if isinstance(value, dict):
+            return {key: restore(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [restore(item) for item in value]
+        return value
+
+    return restore(ticks)
+
+
+def read_legacy_file(path: str):
+    """ Yields (received time string, ticks) for every line of a txt capture file """
+
+    with open(path, 'r') as file:
+        for line in file:
+            for received, text in json.loads(line).items():
+                yield received, parse_legacy_ticks(text)
+
+
+if __name__ == '__main__':
+
+    import os
+    import random
+    import tempfile
+
+    # Benchmark: one synthetic NFO capture written in both formats
+    nfo_column = {'time_stamp': ('datetime primary key', 'exchange_timestamp'),
+                  'price': ('real(15,5)', 'last_price'),
+                  'average_price': ('real(15,5)', 'average_traded_price'),
+                  'total_buy_qty': ('integer', 'total_buy_quantity'),
+                  'total_sell_qty': ('integer', 'total_sell_quantity'),
+                  'volume': ('integer', 'volume_traded'),
+                  'open_interest': ('integer', 'oi')}
+
+    def full_mode_tick(token, moment):
+        price = round(random.uniform(50, 500) * 20) / 20
+        depth = [{'quantity': random.randint(50, 5000), 'price': price, 'orders': random.randint(1, 20)}
+                 for _ in range(5)]
+        return {'tradable': True, 'mode': 'full', 'instrument_token': token, 'last_price': price,
+                'last_traded_quantity': 50, 'average_traded_price': price, 'volume_traded': random.randint(0, 10**8),
+                'total_buy_quantity': random.randint(0, 10**7), 'total_sell_quantity': random.randint(0, 10**7),
+                'ohlc': {'open': price, 'high': price, 'low': price, 'close': price}, 'change': 0.5,
+                'last_trade_time': moment, 'oi': random.randint(0, 10**7), 'oi_day_high': 0, 'oi_day_low': 0,
+                'exchange_timestamp': moment, 'depth': {'buy': depth, 'sell': depth}}
+
+    tokens = list(range(10_000_000, 10_000_080))
+    start = datetime(2023, 12, 18, 9, 15)
+    batches = [[full_mode_tick(token, start + timedelta(seconds=second)) for token in random.sample(tokens, 20)]
+               for second in range(2_000)]
+
+    folder = tempfile.mkdtemp()
+    txt_path = os.path.join(folder, 'ticks.txt')
+    bin_path = os.path.join(folder, 'ticks.bin')
+
+    with open(txt_path, 'w') as txt_file:
+        for batch in batches:
+            txt_file.write(json.dumps({'09:15:00.000': str(batch)}) + '\n')
+
+    with TickFileWriter(bin_path, nfo_column) as writer:
+        for batch in batches:
+            writer.write_ticks(batch)
+
+    txt_size = os.path.getsize(txt_path)
+    bin_size = os.path.getsize(bin_path)
+
+    begin = time.perf_counter()
+    txt_count = sum(len(ticks) for _, ticks in read_legacy_file(txt_path))
+    txt_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    bin_count = sum(len(ticks) for _, ticks in TickFileReader(bin_path))
+    bin_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    raw_count = sum(len(ticks) for _, ticks in TickFileReader(bin_path, raw=True))
+    raw_time = time.perf_counter() - begin
+
+    print(f"ticks: {txt_count} txt / {bin_count} bin / {raw_count} raw")
+    print(f"size: txt {txt_size / 1e6:.2f} MB, bin {bin_size / 1e6:.2f} MB ({txt_size / bin_size:.1f}x smaller)")
+    print(f"decode: txt {txt_time:.3f}s, bin {bin_time:.3f}s ({txt_time / bin_time:.1f}x), "
+          f"raw {raw_time:.3f}s ({txt_time / raw_time:.1f}x)")
@@ -0,0 +1,315 @@
+# Python Standard Library
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Local Library imports
+from tick_codec import TickFileReader, read_legacy_file
+from database import candle_engine
+from candle_aggregator import upsert_rows
+
+# Parameters
+EPOCH = datetime(1970, 1, 1)
+
+
+def group_starts(*keys):
+    """ Start index of every run of equal keys in arrays already sorted by those keys """
+
+    boundary = np.zeros(len(keys[0]), dtype=bool)
+    boundary[:1] = True
+    for key in keys:
+        boundary[1:] |= key[1:] != key[:-1]
+
+    return np.flatnonzero(boundary)
+
+
+def volume_profiles(slots, minutes, prices, deltas) -> dict:
+    """Volume traded at every price level of every token-minute.
+
+    Args:
+        slots, minutes, prices, deltas: one entry per tick, 'deltas' being the volume traded since the previous tick
+            of the same token.
+
+    Returns:
+        {(slot, minute): {price: volume}}, levels without traded volume are left out.
+    """
+
+    traded = deltas > 0
+    slots, minutes, prices, deltas = slots[traded], minutes[traded], prices[traded], deltas[traded]
+
+    if len(slots) == 0:
+        return {}
+
+    # One entry per (slot, minute, price) level
+    order = np.lexsort((prices, minutes, slots))
+    slots, minutes, prices, deltas = slots[order], minutes[order], prices[order], deltas[order]
+
+    starts = group_starts(slots, minutes, prices)
+    level_slot, level_minute, level_price = slots[starts], minutes[starts], prices[starts]
+    level_volume = np.add.reduceat(deltas, starts)
+
+    # Split the levels into bars
+    bar_starts = group_starts(level_slot, level_minute)
+    bar_ends = np.append(bar_starts[1:], len(level_slot))
+
+    level_price = level_price.tolist()
+    level_volume = level_volume.tolist()
+
+    return {(slot, minute): dict(zip(level_price[start:end], level_volume[start:end]))
+            for slot, minute, start, end in zip(level_slot[bar_starts].tolist(), level_minute[bar_starts].tolist(),
+                                                bar_starts.tolist(), bar_ends.tolist())}
+
+
+def liquidity_profiles(slots, minutes, buy, sell) -> dict:
+    """Open, high, low, close and mean of the total buy and sell quantity of every token-minute.
+
+    Args:
+        slots, minutes, buy, sell: one entry per tick, in arrival order.
+
+    Returns:
+        {(slot, minute): {'buy': {...}, 'sell': {...}}}
+    """
+
+    if len(slots) == 0:
+        return {}
+
+    order = np.lexsort((minutes, slots))
+    slots, minutes, buy, sell = slots[order], minutes[order], buy[order], sell[order]
+
+    starts = group_starts(slots, minutes)
+    ends = np.append(starts[1:], len(slots)) - 1
+    counts = ends - starts + 1
+
+    def snapshot(values):
+        return {'open': values[starts].tolist(), 'high': np.maximum.reduceat(values, starts).tolist(),
+                'low': np.minimum.reduceat(values, starts).tolist(), 'close': values[ends].tolist(),
+                'mean': np.round(np.add.reduceat(values, starts) / counts, 2).tolist()}
+
+    buy_stats, sell_stats = snapshot(buy), snapshot(sell)
+    names = ('open', 'high', 'low', 'close', 'mean')
+
+    return {(slot, minute): {'buy': {name: buy_stats[name][index] for name in names},
+                             'sell': {name: sell_stats[name][index] for name in names}}
+            for index, (slot, minute) in enumerate(zip(slots[starts].tolist(), minutes[starts].tolist()))}
+
+
+class ProfileBuilder:
+    """
+    Streaming volume_profile and liquidity_profile of the candle tables.
+
+    Ticks are buffered as arrays until the exchange time moves past their minute, then all the completed
+    token-minutes are profiled at once with vectorized operations. The traded volume of a tick is the change of the
+    cumulative 'volume_traded' since the previous tick of the token, and is attributed to its 'last_price'.
+    A tick arriving after its token-minute was profiled is dropped and counted in 'late_ticks'.
+    """
+
+    def __init__(self, exchange: str, tokens: list = (), engine=None):
+
+        self.exchange = exchange.upper()
+        self.engine = candle_engine(exchange) if engine is None else engine
+
+        self.slots = {}
+        self.tokens = []
+        self.last_volume = np.zeros(0, dtype=np.int64)
+        self.profiled = np.zeros(0, dtype=np.int64)  # last profiled minute of every token
+
+        # Buffered ticks of the minutes not completed yet
+        self.buffer = None
+        self.last_minute = -1
+        self.late_ticks = 0
+        self.rows = []
+
+        self.add_tokens(tokens)
+
+    def add_tokens(self, tokens):
+        new_tokens = [token for token in dict.fromkeys(tokens) if token not in self.slots]
+
+        for token in new_tokens:
+            self.slots[token] = len(self.tokens)
+            self.tokens.append(token)
+
+        self.last_volume = np.concatenate([self.last_volume, np.zeros(len(new_tokens), dtype=np.int64)])
+        self.profiled = np.concatenate([self.profiled, np.full(len(new_tokens), -1, dtype=np.int64)])
+
+    def update(self, ticks: list):
+        """ Add a batch of kite tick dictionaries """
+
+        ticks = [tick for tick in ticks if tick.get('exchange_timestamp') is not None]
+        if not ticks:
+            return
+
+        self.add_tokens(tick['instrument_token'] for tick in ticks)
+
+        count = len(ticks)
+        slots = self.slots
+        self.update_arrays(
+            np.fromiter((slots[tick['instrument_token']] for tick in ticks), dtype=np.int64, count=count),
+            np.fromiter((int((tick['exchange_timestamp'] - EPOCH).total_seconds()) for tick in ticks),
+                        dtype=np.int64, count=count),
+            np.fromiter((tick['last_price'] for tick in ticks), dtype=np.float64, count=count),
+            np.fromiter((tick.get('volume_traded') or 0 for tick in ticks), dtype=np.int64, count=count),
+            np.fromiter((tick.get('total_buy_quantity') or 0 for tick in ticks), dtype=np.int64, count=count),
+            np.fromiter((tick.get('total_sell_quantity') or 0 for tick in ticks), dtype=np.int64, count=count))
+
+    def update_arrays(self, slots, seconds, prices, volumes, buy, sell):
+        """ Add ticks given as arrays in arrival order, cumulative volumes are turned into per-tick deltas """
+
+        # Previous cumulative volume of every tick, within the batch and from the earlier batches
+        order = np.argsort(slots, kind='stable')
+        sorted_slots, sorted_volumes = slots[order], volumes[order]
+
+        previous = np.empty_like(sorted_volumes)
+        previous[1:] = sorted_volumes[:-1]
+        first = group_starts(sorted_slots)
+        previous[first] = self.last_volume[sorted_slots[first]]
+
+        deltas = np.empty_like(volumes)
+        deltas[order] = np.maximum(sorted_volumes - previous, 0)
+
+        last = np.append(first[1:], len(sorted_slots)) - 1
+        self.last_volume[sorted_slots[last]] = np.maximum(self.last_volume[sorted_slots[last]], sorted_volumes[last])
+
+        batch = (slots, seconds // 60, np.round(prices, 2), deltas, buy, sell)
+
+        # Late tick of a minute already profiled for its token: dropped and counted, the row is not written again
+        late = batch[1] <= self.profiled[slots]
+        if late.any():
+            self.late_ticks += int(late.sum())
+            batch = tuple(column[~late] for column in batch)
+
+            if len(batch[0]) == 0:
+                return
+
+        self.buffer = batch if self.buffer is None else tuple(np.concatenate(pair) for pair in zip(self.buffer, batch))
+
+        # Exchange time moved on: the earlier minutes are complete
+        self.last_minute = max(self.last_minute, int(batch[1].max()))
+        self.__profile(self.buffer[1] < self.last_minute)
+
+    def __profile(self, selected):
+        if self.buffer is None or not selected.any():
+            return
+
+        slots, minutes, prices, deltas, buy, sell = (column[selected] for column in self.buffer)
+        self.buffer = tuple(column[~selected] for column in self.buffer)
+        np.maximum.at(self.profiled, slots, minutes)
+
+        volume = volume_profiles(slots, minutes, prices, deltas)
+        liquidity = liquidity_profiles(slots, minutes, buy, sell)
+
+        for (slot, minute), profile in liquidity.items():
+            self.rows.append({'instrument_token': self.tokens[slot],
+                              'time_stamp': EPOCH + timedelta(minutes=minute),
+                              'volume_profile': json.dumps(volume.get((slot, minute), {})),
+                              'liquidity_profile': json.dumps(profile)})
+
+    def finish(self):
+        """ Profile every buffered minute, at the market close """
+
+        if self.buffer is not None:
+            self.__profile(np.ones(len(self.buffer[0]), dtype=bool))
+
+    def completed_rows(self) -> list:
+        rows, self.rows = self.rows, []
+        return rows
+
+    def flush(self) -> int:
+        rows = self.completed_rows()
+        return upsert_rows(self.engine, rows) if rows else 0
+
+
+def profile_file(exchange: str, path: str, engine=None, write: bool = True) -> list:
+    """End-of-day batch: profile a whole daily tick file in one vectorized pass.
+
+    Args:
+        exchange: 'NSE' or 'NFO'.
+        path: binary capture ('.bin') or json lines of str(ticks) ('.txt').
+        engine: optional engine, the candle database of the exchange by default.
+        write: write the profiles to the candle tables.
+
+    Returns:
+        The profile rows.
+    """
+
+    builder = ProfileBuilder(exchange, engine=engine)
+
+    if path.endswith('.bin'):
+        reader = TickFileReader(path, raw=True)
+        fields = reader.layout.fields
+        records = np.array([row for _, rows in reader for row in rows], dtype=np.int64).reshape(-1, len(fields))
+
+        def column(name):
+            return records[:, fields.index(name)] if name in fields else np.zeros(len(records), dtype=np.int64)
+
+        # ticks without an exchange timestamp, as skipped by update()
+        records = records[column('exchange_timestamp') != 0]
+
+        builder.add_tokens(np.unique(column('instrument_token')).tolist())
+        slot_of = np.vectorize(builder.slots.get, otypes=[np.int64])
+
+        builder.update_arrays(slot_of(column('instrument_token')), column('exchange_timestamp'),
+                              column('last_price') / 100, column('volume_traded'),
+                              column('total_buy_quantity'), column('total_sell_quantity'))
+
+    else:
+        for _, ticks in read_legacy_file(path):
+            builder.update(ticks)
+
+    builder.finish()
+    rows = builder.completed_rows()
+
+    if write and rows:
+        upsert_rows(builder.engine, rows)
+
+    return rows
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import random
+
+    if len(sys.argv) == 3:
+        # End-of-day batch: python tick_profiles.py NFO <path>
+        print(f"{len(profile_file(sys.argv[1], sys.argv[2]))} profiles written")
+        sys.exit()
+
+    # Benchmark: one synthetic NFO day, 300 tokens, 6.75 hours
+    tokens = 300
+    seconds_in_day = 6 * 3600 + 45 * 60
+    ticks_in_day = 2_000_000
+    start = int((datetime(2023, 12, 18, 9, 15) - EPOCH).total_seconds())
+
+    slots = np.random.randint(0, tokens, ticks_in_day)
+    seconds = np.sort(np.random.randint(0, seconds_in_day, ticks_in_day)) + start
+    prices = np.round(100 + np.random.randn(ticks_in_day).cumsum() * 0.05, 1)
+    volumes = np.zeros(ticks_in_day, dtype=np.int64)
+    for slot in range(tokens):
+        selected = slots == slot
+        volumes[selected] = np.cumsum(np.random.randint(0, 500, selected.sum()))
+    buy = np.random.randint(0, 10**6, ticks_in_day)
+    sell = np.random.randint(0, 10**6, ticks_in_day)
+
+    builder = ProfileBuilder('NFO', tokens=list(range(tokens)), engine=object())
+
+    begin = time.perf_counter()
+    builder.update_arrays(slots, seconds, prices, volumes, buy, sell)
+    builder.finish()
+    elapsed = time.perf_counter() - begin
+    rows = builder.completed_rows()
+    print(f"batch: {ticks_in_day:,} ticks, {len(rows):,} token-minutes profiled in {elapsed:.2f}s")
+
+    # Streaming: the same ticks in one second batches
+    builder = ProfileBuilder('NFO', tokens=list(range(tokens)), engine=object())
+    bounds = np.searchsorted(seconds, np.arange(start, start + seconds_in_day + 1))
+
+    begin = time.perf_counter()
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if last > first:
+            builder.update_arrays(slots[first:last], seconds[first:last], prices[first:last], volumes[first:last],
+                                  buy[first:last], sell[first:last])
+    builder.finish()
+    elapsed = time.perf_counter() - begin
+    print(f"streaming: {len(builder.completed_rows()):,} token-minutes, {elapsed / seconds_in_day * 1000:.3f} ms "
+          f"per one second batch")
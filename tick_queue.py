@@ -0,0 +1,225 @@
+# STD library
+import os
+import queue
+import pickle
+import struct
+import threading
+from datetime import datetime
+
+# local library
+
+
+# Parameters
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+LENGTH = struct.Struct('<I')
+_STOP = object()
+
+
+class TickQueue:
+    """ Bounded queue between a websocket 'on_ticks' callback and the worker threads running a sink """
+
+    def __init__(self, sink, name: str, maxsize: int = 10_000, workers: int = 1, overflow: str = 'block',
+                 spill_path: str = None, idle=None, idle_ms: int = 500):
+        """
+        Args:
+            sink: function called by the workers as sink(ticks, received) for every batch.
+            name: name used in the worker thread names and in the printed messages.
+            maxsize: maximum number of batches kept in memory.
+            workers: number of sink worker threads. Batches are written in order only with a single worker.
+            overflow: what put() does on a full queue.
+                'block': wait for a free slot.
+                'drop_oldest': drop the oldest batch in the queue and count it in 'dropped'.
+                'spill': append the batch to 'spill_path', the workers replay it once the queue is drained.
+            spill_path: file used by the 'spill' policy.
+            idle: optional function called by the workers when no batch came for 'idle_ms' milliseconds, e.g. to
+                commit a batch a sink keeps open on a quiet feed.
+        """
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy. Valid options are {OVERFLOW_POLICIES}.")
+
+        if overflow == 'spill' and spill_path is None:
+            raise ValueError("The 'spill' overflow policy needs a spill_path.")
+
+        self.sink = sink
+        self.name = name
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.idle = idle
+        self.idle_ms = idle_ms
+        self.queue = queue.Queue(maxsize=maxsize)
+
+        # Counters
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.errors = 0
+
+        # Spill state, every batch goes to the spill file while it is not replayed to keep the order
+        self.spilling = False
+        self.spill_file = None
+        self.spill_lock = threading.Lock()
+        self.replays = 0
+
+        self.threads = [threading.Thread(target=self.__work, name=f"{name}_sink_{number}", daemon=True)
+                        for number in range(workers)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, ticks, received: datetime = None):
+        """ Enqueue a batch, the only work done on the websocket thread """
+
+        item = (ticks, datetime.now() if received is None else received)
+        self.received += 1
+
+        if self.overflow == 'block':
+            self.queue.put(item)
+
+        elif self.overflow == 'drop_oldest':
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+        elif self.overflow == 'spill':
+            with self.spill_lock:
+                if not self.spilling:
+                    try:
+                        self.queue.put_nowait(item)
+                        return
+                    except queue.Full:
+                        self.spilling = True
+
+                self.__spill(item)
+
+    def __spill(self, item):
+
+        if self.spill_file is None:
+            os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+            self.spill_file = open(self.spill_path, 'ab')
+
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        self.spill_file.write(LENGTH.pack(len(data)) + data)
+        self.spilled += 1
+
+    def __read_spill(self):
+        """ Take the current spill file, new overflow goes to a fresh file while this one is replayed """
+
+        with self.spill_lock:
+            if self.spill_file is None:
+                self.spilling = False
+                return []
+
+            self.spill_file.close()
+            self.spill_file = None
+
+            self.replays += 1
+            replay_path = f"{self.spill_path}.{self.replays}.replay"
+            os.replace(self.spill_path, replay_path)
+
+        items = []
+        with open(replay_path, 'rb') as file:
+            while True:
+                header = file.read(LENGTH.size)
+                if len(header) < LENGTH.size:
+                    break
+                items.append(pickle.loads(file.read(LENGTH.unpack(header)[0])))
+
+        os.remove(replay_path)
+
+        return items
+
+    def __run_sink(self, item):
+        try:
+            self.sink(*item)
+            self.processed += 1
+
+        except Exception as e:
+            self.errors += 1
+            print(f"{self.name}: error in sink: {e}")
+
+    def __run_idle(self):
+        try:
+            self.idle()
+
+        except Exception as e:
+            self.errors += 1
+            print(f"{self.name}: error in idle: {e}")
+
+    def __work(self):
+
+        while True:
+            # Replay the spilled batches once everything older has been written
+            if self.spilling and self.queue.empty():
+                for spilled in self.__read_spill():
+                    self.__run_sink(spilled)
+                continue
+
+            try:
+                item = self.queue.get(timeout=self.idle_ms / 1000)
+
+            except queue.Empty:
+                if self.idle is not None:
+                    self.__run_idle()
+                continue
+
+            if item is _STOP:
+                self.queue.task_done()
+                break
+
+            self.__run_sink(item)
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {'name': self.name, 'depth': self.queue.qsize(), 'received': self.received,
+                'processed': self.processed, 'dropped': self.dropped, 'spilled': self.spilled,
+                'errors': self.errors}
+
+    def close(self):
+        """ Write everything still queued or spilled, then stop the workers """
+
+        for _ in self.threads:
+            self.queue.put(_STOP)
+
+        for thread in self.threads:
+            thread.join()
+
+        while self.spilling:
+            for spilled in self.__read_spill():
+                self.__run_sink(spilled)
+
+        print(f"{self.name}: {self.stats()}")
+
+
+if __name__ == '__main__':
+
+    import time
+    import tempfile
+
+    # Slow sink demonstration: the producer never waits, overflow is spilled and replayed in order
+    written = []
+
+    def slow_sink(ticks, received):
+        time.sleep(0.001)
+        written.append(ticks[0])
+
+    spill = os.path.join(tempfile.mkdtemp(), 'demo.spill')
+    tick_queue = TickQueue(slow_sink, 'demo', maxsize=100, overflow='spill', spill_path=spill)
+
+    begin = time.perf_counter()
+    for number in range(2_000):
+        tick_queue.put([number])
+    print(f"2000 puts in {(time.perf_counter() - begin) * 1000:.1f} ms, {tick_queue.stats()}")
+
+    tick_queue.close()
+    print(f"written in order: {written == list(range(2_000))}")
@@ -0,0 +1,298 @@
+# STD library
+import time
+import zlib
+import queue
+import threading
+import multiprocessing
+from datetime import datetime
+from kiteconnect import KiteTicker
+from twisted.internet import reactor
+
+# local library
+
+
+# Parameters
+MAX_TOKENS_PER_CONNECTION = 3000  # instruments per websocket connection allowed by kite
+MAX_CONNECTIONS_PER_KEY = 3  # websocket connections allowed by kite per api_key, across all the processes
+REACTOR_START_TIMEOUT = 10  # seconds
+MODES = {'full': KiteTicker.MODE_FULL, 'quote': KiteTicker.MODE_QUOTE, 'ltp': KiteTicker.MODE_LTP}
+
+
+def shard_of(token: int, shards: int) -> int:
+    """ Shard of a token, a hash of the token number that stays the same across runs and processes """
+
+    return zlib.crc32(str(int(token)).encode()) % shards
+
+
+def shard_tokens(tokens: list, shards: int) -> list:
+    """ Split tokens into 'shards' lists, keeping the order of the tokens in every list """
+
+    split = [[] for _ in range(shards)]
+    for token in tokens:
+        split[shard_of(token, shards)].append(token)
+
+    return split
+
+
+def shards_needed(tokens: list, shards: int = 1) -> int:
+    """ At least 'shards', and enough connections to stay under MAX_TOKENS_PER_CONNECTION each """
+
+    return max(shards, -(-len(tokens) // MAX_TOKENS_PER_CONNECTION), 1)
+
+
+def check_connections(connections: dict, limit: int = MAX_CONNECTIONS_PER_KEY):
+    """Fail fast when the recorders of one api_key would open more websocket connections than kite allows.
+
+    Args:
+        connections: {recorder name: connections}, every recorder sharing the api_key, e.g. the NSE, NFO and
+            INDEX processes of record_ticks.
+        limit: connections allowed per api_key.
+
+    Raises:
+        ValueError: the total is over the limit, kite would refuse the extra connections during the day.
+    """
+
+    total = sum(connections.values())
+
+    if total > limit:
+        raise ValueError(f"{total} websocket connections planned for one api_key {connections}, kite allows {limit}. "
+                         f"Lower the shards or record with another api_key.")
+
+
+def _subscribe(ws, modes: dict):
+    # One subscribe and one set_mode per mode, e.g. the options in 'full' and the watched indices in 'ltp'
+    grouped = {}
+    for token, mode in modes.items():
+        grouped.setdefault(mode, []).append(token)
+
+    for mode, tokens in grouped.items():
+        ws.subscribe(tokens)
+        ws.set_mode(MODES[mode], tokens)
+
+
+def _run_shard(api_key: str, access_token: str, shard: int, modes: dict, ticks_queue, commands):
+    """ Process of a shard: its own connection and parsing, the ticks go back to the parent through a queue """
+
+    kws = KiteTicker(api_key, access_token)
+
+    def on_ticks(ws, ticks):
+        ticks_queue.put((shard, ticks, datetime.now()))
+
+    def on_connect(ws, response):
+        _subscribe(ws, modes)
+
+    kws.on_ticks = on_ticks
+    kws.on_connect = on_connect
+    kws.connect(threaded=True)
+
+    # Subscription changes of the parent, applied on the reactor thread of the connection
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+
+        action, tokens, mode = command
+        if action == 'subscribe':
+            modes.update({token: mode for token in tokens})
+            reactor.callFromThread(_subscribe, kws, {token: mode for token in tokens})
+        else:
+            for token in tokens:
+                modes.pop(token, None)
+            reactor.callFromThread(kws.unsubscribe, tokens)
+
+    kws.close()
+    ticks_queue.put(None)
+
+
+class ShardedTicker:
+    """
+    Several KiteTicker connections over one token list, split by shard_of(), delivering to one callback.
+
+    With processes=False the connections run in this process; they share the twisted reactor thread, which
+    lifts the per-connection instrument cap but not the parsing load. With processes=True every connection
+    runs and parses in its own process and the ticks come back through a multiprocessing queue to a reader
+    thread, so the callback, and the sinks behind it, see a single merged stream in both cases.
+    """
+
+    def __init__(self, api_key: str, access_token: str, tokens: list, on_ticks, shards: int = 1,
+                 processes: bool = False, watch_tokens: list = (), name: str = ''):
+        """
+        Args:
+            tokens: tokens subscribed in 'full' mode.
+            on_ticks: callback called as on_ticks(ticks, received) for every batch of every shard.
+            shards: number of connections, raised to stay under MAX_TOKENS_PER_CONNECTION. More connections than
+                MAX_CONNECTIONS_PER_KEY raise a ValueError.
+            processes: one process per connection.
+            watch_tokens: tokens subscribed in 'ltp' mode, e.g. the indices followed by the AtmTracker.
+            name: name used in the printed messages.
+        """
+
+        self.api_key = api_key
+        self.access_token = access_token
+        self.on_ticks = on_ticks
+        self.shards = shards_needed(list(tokens) + list(watch_tokens), shards)
+
+        check_connections({name: self.shards})
+        self.processes = processes
+        self.name = name
+
+        # Current subscriptions of every shard, {token: mode}, used again on reconnections
+        self.modes = [{} for _ in range(self.shards)]
+        for token in tokens:
+            self.modes[shard_of(token, self.shards)][token] = 'full'
+        for token in watch_tokens:
+            self.modes[shard_of(token, self.shards)][token] = 'ltp'
+
+        # Counters of every shard
+        self.messages = [0] * self.shards
+        self.ticks = [0] * self.shards
+        self.last_report = (time.monotonic(), [0] * self.shards)
+
+        self.connections = []
+        self.commands = []
+        self.workers = []
+        self.ticks_queue = None
+        self.reader = None
+
+    def __deliver(self, shard: int, ticks: list, received: datetime):
+        self.messages[shard] += 1
+        self.ticks[shard] += len(ticks)
+        self.on_ticks(ticks, received)
+
+    def __read(self):
+        # Reader thread of the process mode, ends when every shard process has sent its end marker
+        running = self.shards
+        while running:
+            item = self.ticks_queue.get()
+            if item is None:
+                running -= 1
+                continue
+
+            self.__deliver(*item)
+
+    @staticmethod
+    def __wait_reactor():
+        deadline = time.monotonic() + REACTOR_START_TIMEOUT
+
+        while not reactor.running:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"twisted reactor not running after {REACTOR_START_TIMEOUT}s")
+            time.sleep(0.01)
+
+    def connect(self):
+        """ Open the connections, every shard subscribes its tokens on connect and on reconnect """
+
+        if self.processes:
+            self.ticks_queue = multiprocessing.Queue()
+
+            for shard in range(self.shards):
+                commands = multiprocessing.Queue()
+                worker = multiprocessing.Process(target=_run_shard, name=f"{self.name}_shard_{shard}", daemon=True,
+                                                 args=(self.api_key, self.access_token, shard, self.modes[shard],
+                                                       self.ticks_queue, commands))
+                worker.start()
+
+                self.commands.append(commands)
+                self.workers.append(worker)
+
+            self.reader = threading.Thread(target=self.__read, name=f"{self.name}_shard_reader", daemon=True)
+            self.reader.start()
+
+        else:
+            for shard in range(self.shards):
+                kws = KiteTicker(self.api_key, self.access_token)
+
+                kws.on_ticks = lambda ws, ticks, shard=shard: self.__deliver(shard, ticks, datetime.now())
+                kws.on_connect = lambda ws, response, shard=shard: _subscribe(ws, self.modes[shard])
+
+                # One reactor for all the connections: the first one starts its thread, the others are opened
+                # on it, a second threaded connect before the reactor runs would start a second reactor
+                if reactor.running:
+                    reactor.callFromThread(kws.connect)
+                else:
+                    kws.connect(threaded=True)
+                    self.__wait_reactor()
+
+                self.connections.append(kws)
+
+        print(f"{self.name}: {self.shards} connections, "
+              f"{[len(modes) for modes in self.modes]} tokens per connection")
+
+    def subscribe(self, tokens: list, mode: str = 'full'):
+        """ Subscribe tokens on the connections of their shards """
+
+        for shard, shard_tokens_ in enumerate(shard_tokens(tokens, self.shards)):
+            if not shard_tokens_:
+                continue
+
+            self.modes[shard].update({token: mode for token in shard_tokens_})
+
+            if self.processes:
+                self.commands[shard].put(('subscribe', shard_tokens_, mode))
+            else:
+                # Sent on the reactor thread of the connections, the caller can be any thread
+                reactor.callFromThread(_subscribe, self.connections[shard], {token: mode for token in shard_tokens_})
+
+    def unsubscribe(self, tokens: list):
+        """ Unsubscribe tokens from the connections of their shards """
+
+        for shard, shard_tokens_ in enumerate(shard_tokens(tokens, self.shards)):
+            if not shard_tokens_:
+                continue
+
+            for token in shard_tokens_:
+                self.modes[shard].pop(token, None)
+
+            if self.processes:
+                self.commands[shard].put(('unsubscribe', shard_tokens_, None))
+            else:
+                reactor.callFromThread(self.connections[shard].unsubscribe, shard_tokens_)
+
+    def stats(self) -> list:
+        """ Per shard: tokens, messages, ticks and messages per second since the previous call """
+
+        now = time.monotonic()
+        since, previous = self.last_report
+        elapsed = max(now - since, 1e-9)
+
+        stats = [{'shard': shard, 'tokens': len(self.modes[shard]), 'messages': self.messages[shard],
+                  'ticks': self.ticks[shard], 'rate': (self.messages[shard] - previous[shard]) / elapsed}
+                 for shard in range(self.shards)]
+
+        self.last_report = (now, list(self.messages))
+
+        return stats
+
+    def report(self):
+        """ Print the message rate of every shard """
+
+        rates = ", ".join(f"#{item['shard']} {item['rate']:.1f} msg/s ({item['tokens']} tokens)"
+                          for item in self.stats())
+        print(f"{self.name}: {rates}")
+
+    def close(self):
+        """ Close the connections, in process mode wait for the ticks already sent by the shards """
+
+        if self.processes:
+            for commands in self.commands:
+                commands.put(None)
+
+            self.reader.join(timeout=30)
+
+            for worker in self.workers:
+                worker.join(timeout=10)
+
+        else:
+            for kws in self.connections:
+                kws.close()
+
+
+if __name__ == '__main__':
+    # Balance of the stable hash on 8,000 consecutive tokens, the way option tokens are numbered
+    tokens = list(range(10_000_000, 10_008_000))
+
+    for shards in (2, 3, 4):
+        sizes = [len(part) for part in shard_tokens(tokens, shards)]
+        print(f"{shards} shards: {sizes}, largest {max(sizes) / (len(tokens) / shards) - 1:+.1%} over even")
+
+    print(f"{len(tokens)} tokens need {shards_needed(tokens)} connections")
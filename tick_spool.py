@@ -0,0 +1,263 @@
+# STD library
+import os
+import json
+import struct
+
+# local library
+
+
+# Parameters
+LENGTH = struct.Struct('<I')
+
+
+class MessageSpool:
+    """
+    Append-only local spool of broker messages, kept while the broker is unreachable.
+
+    Messages are appended to numbered segment files 'segment_000001.spool', ... as length-prefixed records.
+    The replay position (segment, offset) is kept in 'cursor.json', so a restarted recorder continues the
+    catch-up where the previous one stopped. Fully replayed segments are deleted. The cursor is saved every
+    'save_every' replayed messages, so a crash during a replay can send those messages a second time.
+    """
+
+    def __init__(self, folder: str, segment_bytes: int = 64 * 1024 * 1024, save_every: int = 500):
+        self.folder = folder
+        self.segment_bytes = segment_bytes
+        self.save_every = save_every
+        self.cursor_path = os.path.join(folder, 'cursor.json')
+
+        os.makedirs(folder, exist_ok=True)
+
+        # Segment numbers on disk, oldest first
+        segments = sorted(int(name[8:14]) for name in os.listdir(folder)
+                          if name.startswith('segment_') and name.endswith('.spool'))
+
+        self.read_segment, self.read_offset = segments[0] if segments else 1, 0
+
+        try:
+            with open(self.cursor_path, 'r') as file:
+                cursor = json.load(file)
+
+            if cursor['segment'] in segments:
+                self.read_segment, self.read_offset = cursor['segment'], cursor['offset']
+
+        except FileNotFoundError:
+            pass
+
+        self.write_segment = segments[-1] if segments else 1
+        self.write_offset = self.__repair(self.write_segment) if segments else 0
+        self.write_file = None
+
+    def __path(self, segment: int) -> str:
+        return os.path.join(self.folder, f'segment_{segment:06d}.spool')
+
+    def __repair(self, segment: int) -> int:
+        """ Cut a record left incomplete by a crash at the end of a segment, returns the valid size """
+
+        path = self.__path(segment)
+        offset = 0
+
+        with open(path, 'rb') as file:
+            size = os.path.getsize(path)
+
+            while offset + LENGTH.size <= size:
+                file.seek(offset)
+                length = LENGTH.unpack(file.read(LENGTH.size))[0]
+
+                if offset + LENGTH.size + length > size:
+                    break
+
+                offset += LENGTH.size + length
+
+        if offset != size:
+            print(f"{path}: dropped {size - offset} bytes of an incomplete record")
+            with open(path, 'r+b') as file:
+                file.truncate(offset)
+
+        return offset
+
+    def is_empty(self) -> bool:
+        return self.read_segment == self.write_segment and self.read_offset >= self.write_offset
+
+    def append(self, message):
+        """ Append a message (str or bytes) at the end of the spool """
+
+        if isinstance(message, str):
+            message = message.encode()
+
+        if self.write_offset >= self.segment_bytes:
+            self.__close_write_file()
+            self.write_segment += 1
+            self.write_offset = 0
+
+        if self.write_file is None:
+            self.write_file = open(self.__path(self.write_segment), 'ab')
+
+        self.write_file.write(LENGTH.pack(len(message)) + message)
+        self.write_offset += LENGTH.size + len(message)
+
+    def __close_write_file(self):
+        if self.write_file is not None:
+            self.write_file.close()
+            self.write_file = None
+
+    def __save_cursor(self):
+        with open(self.cursor_path + '.tmp', 'w') as file:
+            json.dump({'segment': self.read_segment, 'offset': self.read_offset}, file)
+
+        os.replace(self.cursor_path + '.tmp', self.cursor_path)
+
+    def replay(self, publish, commit=None, rolled_back=None) -> int:
+        """Send the spooled messages in order through 'publish' as fast as it accepts them.
+
+        Args:
+            publish: function called with every message (bytes), raising when the message was not sent.
+            commit: optional function making the published messages final, e.g. the commit of a broker
+                transaction. It is called every 'save_every' messages, before a segment is deleted and at the
+                end, and the replay position only moves past committed messages: those, and the ones for which
+                'publish' returned True, e.g. when it committed its own transaction. Without it every message
+                taken by 'publish' counts as sent, so a failed replay never sends a committed message again.
+            rolled_back: optional function taking the messages 'publish' hands back after a failure, see send().
+                They were replayed from the spool and are still in it after a failed replay, so they are dropped.
+
+        Returns:
+            The number of messages replayed. The exception of 'publish' or 'commit' is raised again after the
+            cursor is saved, the failed message and the uncommitted ones before it stay first in the spool.
+        """
+
+        if self.write_file is not None:
+            self.write_file.flush()
+
+        replayed = 0
+        committed = (self.read_segment, self.read_offset)
+
+        try:
+            while not self.is_empty():
+                path = self.__path(self.read_segment)
+                end = self.write_offset if self.read_segment == self.write_segment else os.path.getsize(path)
+
+                with open(path, 'rb') as file:
+                    file.seek(self.read_offset)
+
+                    while self.read_offset < end:
+                        length = LENGTH.unpack(file.read(LENGTH.size))[0]
+                        final = publish(file.read(length))
+
+                        self.read_offset += LENGTH.size + length
+                        replayed += 1
+
+                        if commit is None or final is True:
+                            committed = (self.read_segment, self.read_offset)
+
+                        elif replayed % self.save_every == 0:
+                            commit()
+                            committed = (self.read_segment, self.read_offset)
+
+                        if replayed % self.save_every == 0:
+                            self.__save_cursor()
+
+                if commit is not None:
+                    commit()
+                    committed = (self.read_segment, self.read_offset)
+
+                # Move to the next segment, the replayed one is not needed anymore
+                if self.read_segment < self.write_segment:
+                    os.remove(path)
+                    self.read_segment += 1
+                    self.read_offset = 0
+                    committed = (self.read_segment, self.read_offset)
+
+        except BaseException:
+            # Back to the last committed message, the broker dropped the ones after it
+            self.read_segment, self.read_offset = committed
+
+            if rolled_back is not None:
+                rolled_back()
+            raise
+
+        finally:
+            if replayed:
+                self.__save_cursor()
+
+        # Everything sent, start again from an empty segment
+        if replayed:
+            self.__reset()
+            print(f"{self.folder}: {replayed} spooled messages replayed")
+
+        return replayed
+
+    def send(self, message, publish, errors=(Exception,), commit=None, rolled_back=None) -> bool:
+        """Publish a message, or keep it in the spool when the broker is unreachable.
+
+        Messages go straight to 'publish' while the spool is empty. Otherwise they are appended behind the
+        spooled ones to keep the order, and a catch-up replay is attempted.
+
+        Args:
+            commit: passed to replay().
+            rolled_back: optional function returning the messages 'publish' took earlier but the broker did not
+                keep, e.g. an uncommitted transaction lost with its channel. They are spooled before the message.
+
+        Returns:
+            True when the message reached 'publish', False when it stays in the spool.
+        """
+
+        # Messages of a batch that failed outside of a send, e.g. on a timed commit
+        self.__append_rolled_back(rolled_back)
+
+        if self.is_empty():
+            try:
+                publish(message.encode() if isinstance(message, str) else message)
+                return True
+
+            except errors:
+                self.__append_rolled_back(rolled_back)
+
+        self.append(message)
+
+        try:
+            self.replay(publish, commit, rolled_back)
+            return True
+
+        except errors:
+            return False
+
+    def __append_rolled_back(self, rolled_back):
+        if rolled_back is not None:
+            for message in rolled_back():
+                self.append(message)
+
+    def __reset(self):
+        self.__close_write_file()
+
+        for name in os.listdir(self.folder):
+            if name.startswith('segment_'):
+                os.remove(os.path.join(self.folder, name))
+
+        self.read_segment = self.write_segment = 1
+        self.read_offset = self.write_offset = 0
+        self.__save_cursor()
+
+    def close(self):
+        self.__close_write_file()
+
+
+if __name__ == '__main__':
+
+    import tempfile
+
+    # Broker outage demonstration: batches are spooled, then replayed in order once the broker is back
+    spool = MessageSpool(tempfile.mkdtemp(), segment_bytes=1024)
+    delivered = []
+    broker_up = False
+
+    def publish(message):
+        if not broker_up:
+            raise ConnectionError("broker down")
+        delivered.append(message)
+
+    for number in range(1_000):
+        spool.send(f'batch {number}', publish, errors=(ConnectionError,))
+        broker_up = number >= 600
+
+    print(f"delivered {len(delivered)}, in order: {delivered == [f'batch {n}'.encode() for n in range(1_000)]}, "
+          f"spool empty: {spool.is_empty()}")
@@ -0,0 +1,203 @@
+# Python Standard Library
+import os
+import json
+from datetime import datetime
+from dataclasses import asdict
+
+import sqlalchemy
+from sqlalchemy.dialects.mysql import insert
+
+# Local Library imports
+import tables
+from database import get_engine
+
+# Parameters
+today = datetime.today().date()
+TOKEN_TABLES = {'NSE': tables.NseTokenTable, 'NFO': tables.NfoTokenTable, 'INDEX': tables.IndexTokenTable}
+
+
+def primary_key(exchange: str):
+    """ Primary key column of the token table of an exchange, 'tradingsymbol' for NFO, 'instrument_token' else """
+
+    return TOKEN_TABLES[exchange].__table__.primary_key.columns.values()[0]
+
+
+def stored_universe(exchange: str, before=None) -> dict:
+    """Latest universe stored before a day, i.e. the token rows with the most recent last_update before it.
+
+    Args:
+        exchange: 'NSE', 'NFO' or 'INDEX'.
+        before: today by default.
+
+    Returns:
+        {primary key: row dictionary without last_update}.
+    """
+
+    table = TOKEN_TABLES[exchange].__table__
+    before = today if before is None else before
+
+    with get_engine('tokens').connect() as conn:
+        last_day = conn.execute(sqlalchemy.select(sqlalchemy.func.max(table.c.last_update))
+                                .where(table.c.last_update < before)).scalar()
+
+        if last_day is None:
+            return {}
+
+        rows = conn.execute(sqlalchemy.select(table).where(table.c.last_update == last_day)).mappings()
+        key = primary_key(exchange).name
+
+        return {row[key]: {name: value for name, value in row.items() if name != 'last_update'} for row in rows}
+
+
+def diff_universe(models_list: list, stored: dict = None) -> dict:
+    """Compare today's token models with the stored universe, per exchange.
+
+    Args:
+        models_list: NfoTokenModel, NseTokenModel and IndexTokenModel objects, in any mix.
+        stored: {exchange: stored universe}, read with stored_universe() when not given.
+
+    Returns:
+        {exchange: {'added': [models], 'changed': [models], 'unchanged': [keys], 'removed': [keys]}}, a model is
+        changed when its key was stored with other values, e.g. a new 'position' of an option after an ATM move.
+    """
+
+    grouped = {}
+    for model in models_list:
+        grouped.setdefault(model.exchange, []).append(model)
+
+    diffs = {}
+    for exchange, exchange_models in grouped.items():
+        previous = stored[exchange] if stored is not None else stored_universe(exchange)
+        key = primary_key(exchange).name
+
+        diff = {'added': [], 'changed': [], 'unchanged': [], 'removed': []}
+        seen = set()
+
+        for model in exchange_models:
+            values = asdict(model)
+            del values['exchange'], values['last_update']
+            seen.add(values[key])
+
+            if values[key] not in previous:
+                diff['added'].append(model)
+            elif previous[values[key]] != values:
+                diff['changed'].append(model)
+            else:
+                diff['unchanged'].append(values[key])
+
+        diff['removed'] = [item for item in previous if item not in seen]
+        diffs[exchange] = diff
+
+    return diffs
+
+
+def touch_tokens(exchange: str, keys: list) -> int:
+    """ Set last_update to today for unchanged tokens, one UPDATE statement for the whole table """
+
+    if not keys:
+        return 0
+
+    table = TOKEN_TABLES[exchange].__table__
+    column = primary_key(exchange)
+
+    with get_engine('tokens').begin() as conn:
+        result = conn.execute(sqlalchemy.update(table).where(column.in_(keys)).values(last_update=today))
+
+    return result.rowcount
+
+
+def add_tokens(models_list: list) -> dict:
+    """Bulk insert or update token models, one INSERT ... ON DUPLICATE KEY UPDATE statement per exchange table.
+
+    Args:
+        models_list: NfoTokenModel, NseTokenModel and IndexTokenModel objects, in any mix.
+
+    Returns:
+        {exchange: {'inserted': n, 'updated': n}}, the existing rows are found with one primary key query per table.
+    """
+
+    counts = {}
+
+    # Group the models by exchange, the last model of a primary key wins
+    grouped = {}
+    for model in models_list:
+        model_dict = asdict(model)
+        exchange = model_dict.pop('exchange')
+
+        grouped.setdefault(exchange, {})[model_dict[primary_key(exchange).name]] = model_dict
+
+    if not grouped:
+        return counts
+
+    # One transaction for all the exchange tables
+    with get_engine('tokens').begin() as conn:
+        for exchange, rows in grouped.items():
+            table = TOKEN_TABLES[exchange].__table__
+            key = primary_key(exchange)
+
+            # Existing primary keys, to split the counts between inserted and updated rows
+            existing = set(conn.execute(sqlalchemy.select(key).where(key.in_(list(rows)))).scalars())
+
+            statement = insert(table).values(list(rows.values()))
+            statement = statement.on_duplicate_key_update(
+                {column.name: statement.inserted[column.name] for column in table.columns if not column.primary_key})
+
+            conn.execute(statement)
+
+            counts[exchange] = {'inserted': len(rows) - len(existing), 'updated': len(existing)}
+
+    return counts
+
+
+def new_instrument_tokens(exchange: str, diff: dict) -> list:
+    """ Instrument tokens that may not have candle and day tables yet: added ones and changed NFO tradingsymbols """
+
+    tokens = [model.instrument_token for model in diff['added']]
+
+    if exchange == 'NFO':
+        tokens += [model.instrument_token for model in diff['changed']]
+
+    return list(dict.fromkeys(tokens))
+
+
+def record_diff(diffs: dict, folder: str = "TokenDiff") -> str:
+    """ Keep the diff of the day for auditing, in TokenDiff/{today}.json """
+
+    os.makedirs(folder, exist_ok=True)
+
+    key_of = {exchange: primary_key(exchange).name for exchange in diffs}
+    audit = {'date': str(today), 'exchanges': {}}
+
+    for exchange, diff in diffs.items():
+        audit['exchanges'][exchange] = {
+            'added': [getattr(model, key_of[exchange]) for model in diff['added']],
+            'changed': [getattr(model, key_of[exchange]) for model in diff['changed']],
+            'removed': diff['removed'],
+            'unchanged': len(diff['unchanged']),
+        }
+
+    path = f"{folder}/{today}.json"
+    with open(path, "w") as json_file:
+        json.dump(audit, json_file, indent=2, default=str)
+
+    return path
+
+
+if __name__ == '__main__':
+    from models import NseTokenModel
+
+    # Diff of a small universe against a stored one
+    stored = {'NSE': {1: {'instrument_token': 1, 'tradingsymbol': 'A', 'name': 'A', 'bank_nifty': 0.0,
+                          'nifty': 1.0, 'fin_nifty': 0.0},
+                      2: {'instrument_token': 2, 'tradingsymbol': 'B', 'name': 'B', 'bank_nifty': 0.0,
+                          'nifty': 2.0, 'fin_nifty': 0.0},
+                      3: {'instrument_token': 3, 'tradingsymbol': 'C', 'name': 'C', 'bank_nifty': 0.0,
+                          'nifty': 3.0, 'fin_nifty': 0.0}}}
+
+    universe = [NseTokenModel(instrument_token=1, tradingsymbol='A', name='A', nifty=1.0),
+                NseTokenModel(instrument_token=2, tradingsymbol='B', name='B', nifty=2.5),
+                NseTokenModel(instrument_token=4, tradingsymbol='D', name='D', nifty=4.0)]
+
+    for exchange, diff in diff_universe(universe, stored).items():
+        print(exchange, {name: [getattr(item, 'instrument_token', item) for item in items]
+                         for name, items in diff.items()})